@@ -0,0 +1,147 @@
+"""
+压测：同步 graph.stream (WSGI 线程模型) vs 异步 graph.astream (ASGI 协程模型)
+
+用 StubChatModel 固定 LLM 的首 token 延迟和吐字速度，对比同一个 worker 在 N 条并发流下：
+  * 同时在途的流数量 (peak concurrent streams)
+  * 首 token 延迟 TTFT 的 p50 / p99
+
+同步链路模拟一个 gthread worker (固定线程数)，异步链路模拟一个 uvicorn worker (单事件循环)。
+
+运行:
+    python -m benchmarks.bench_async_stream --streams 500 --threads 8
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myproject.settings")
+os.environ.setdefault("DEEPSEEK_API_KEY", "sk-benchmark")
+
+import django
+
+django.setup()
+
+from langgraph.checkpoint.memory import InMemorySaver
+
+from chat.graph import build_agent
+from chat.testing import StubChatModel
+from chat.sse import chunk_payload
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Gauge:
+    """记录当前/峰值在途流数量"""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def inc(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def dec(self):
+        with self._lock:
+            self.current -= 1
+
+
+def run_sync(agent, streams, threads):
+    gauge = Gauge()
+    ttfts = []
+    t0 = time.perf_counter()
+
+    def one_stream(i):
+        inputs = {"messages": [("user", "24a 主干构建状态")]}
+        config = {"configurable": {"thread_id": f"bench-sync-{i}"}}
+        gauge.inc()
+        first = None
+        try:
+            for chunk, _ in agent.stream(inputs, config=config, stream_mode="messages"):
+                if chunk_payload(chunk) and first is None:
+                    first = time.perf_counter() - t0
+        finally:
+            gauge.dec()
+        ttfts.append(first)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one_stream, range(streams)))
+    return {"elapsed": time.perf_counter() - t0, "peak_concurrent": gauge.peak, "ttft": ttfts}
+
+
+async def run_async(agent, streams):
+    gauge = Gauge()
+    ttfts = []
+    t0 = time.perf_counter()
+
+    async def one_stream(i):
+        inputs = {"messages": [("user", "24a 主干构建状态")]}
+        config = {"configurable": {"thread_id": f"bench-async-{i}"}}
+        gauge.inc()
+        first = None
+        try:
+            async for chunk, _ in agent.astream(inputs, config=config, stream_mode="messages"):
+                if chunk_payload(chunk) and first is None:
+                    first = time.perf_counter() - t0
+        finally:
+            gauge.dec()
+        ttfts.append(first)
+
+    await asyncio.gather(*(one_stream(i) for i in range(streams)))
+    return {"elapsed": time.perf_counter() - t0, "peak_concurrent": gauge.peak, "ttft": ttfts}
+
+
+def summarize(name, result):
+    ttft = result["ttft"]
+    return {
+        "path": name,
+        "elapsed_s": round(result["elapsed"], 3),
+        "peak_concurrent_streams": result["peak_concurrent"],
+        "ttft_p50_ms": round(statistics.median(ttft) * 1000, 1),
+        "ttft_p99_ms": round(percentile(ttft, 99) * 1000, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=200, help="并发流数量")
+    parser.add_argument("--threads", type=int, default=8, help="同步 worker 的线程数 (gunicorn --threads)")
+    parser.add_argument("--first-token-delay", type=float, default=0.3, help="假 LLM 首 token 延迟 (秒)")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="假 LLM 每个 token 间隔 (秒)")
+    args = parser.parse_args(argv)
+
+    def make_agent():
+        model = StubChatModel(first_token_delay=args.first_token_delay, token_delay=args.token_delay)
+        return build_agent(model, InMemorySaver())
+
+    # 中间件里的 print 会刷屏，压测期间丢掉
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        sync_result = run_sync(make_agent(), args.streams, args.threads)
+        async_result = asyncio.run(run_async(make_agent(), args.streams))
+
+    report = {
+        "streams": args.streams,
+        "threads": args.threads,
+        "results": [summarize("sync (graph.stream)", sync_result), summarize("async (graph.astream)", async_result)],
+    }
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
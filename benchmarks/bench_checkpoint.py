@@ -0,0 +1,135 @@
+"""
+压测：原来的“单连接 SqliteSaver” vs 连接池版 PooledSqliteSaver
+
+N 个写线程各自模拟一个正在对话的会话：循环写入 checkpoint (put + put_writes，相当于 Agent 跑一步)；
+同时 N 个读线程不停读取其他会话的最新状态 (get_tuple，相当于 get_history 里的 graph.get_state)。
+分别在 N = 1 / 8 / 64 下统计:
+  * checkpoint 写入吞吐 (steps/s) 与同期完成的读取次数 (get_state/s)
+  * get_tuple 延迟 p50 / p99
+
+运行:
+    python -m benchmarks.bench_checkpoint --steps 200
+"""
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myproject.settings")
+
+import django
+
+django.setup()
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langgraph.checkpoint.base import empty_checkpoint
+from langgraph.checkpoint.base.id import uuid6
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+from chat.checkpoint import PooledSqliteSaver
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def make_messages(step):
+    # 一个典型步骤：用户提问 + 工具结果 + AI 回复，工具结果给 2KB 左右
+    return [
+        HumanMessage(content=f"帮我查一下 24a 的 iware 第 {step} 次"),
+        ToolMessage(content="组件配套信息 " * 200, tool_call_id=f"call_{step}"),
+        AIMessage(content="已查询到数据，iware 版本为 V500R015C00SPC150。"),
+    ]
+
+
+def write_steps(saver, thread_id, steps):
+    config = {"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}}
+    for step in range(steps):
+        checkpoint = empty_checkpoint()
+        checkpoint["id"] = str(uuid6(clock_seq=step))
+        checkpoint["channel_values"] = {"messages": make_messages(step)}
+        config = saver.put(config, checkpoint, {"source": "loop", "step": step}, {})
+        saver.put_writes(config, [("messages", make_messages(step)[-1:])], task_id=f"task-{step}")
+
+
+def run(saver, threads, steps):
+    # 先准备好一批“历史会话”，压测期间读线程随机打开它们 (相当于前端加载历史记录)
+    history_ids = [f"history-{threads}-{i}" for i in range(threads)]
+    for thread_id in history_ids:
+        write_steps(saver, thread_id, 5)
+    if hasattr(saver, "flush"):
+        saver.flush()
+
+    read_latencies = []
+    lock = threading.Lock()
+    writing = threading.Event()
+    writing.set()
+
+    def writer(worker):
+        write_steps(saver, f"bench-{threads}-{worker}", steps)
+
+    def reader(worker):
+        local_reads = []
+        i = worker
+        while writing.is_set():
+            t = time.perf_counter()
+            saver.get_tuple({"configurable": {"thread_id": history_ids[i % len(history_ids)]}})
+            local_reads.append(time.perf_counter() - t)
+            i += 1
+            # 模拟用户翻页的间隔，避免读线程空转把 GIL 全抢走
+            time.sleep(0.005)
+        with lock:
+            read_latencies.extend(local_reads)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads * 2) as pool:
+        readers = [pool.submit(reader, i) for i in range(threads)]
+        list(pool.map(writer, range(threads)))
+        if hasattr(saver, "flush"):
+            saver.flush()
+        elapsed = time.perf_counter() - t0
+        writing.clear()
+        for f in readers:
+            f.result()
+    return {
+        "threads": threads,
+        "steps_per_s": round(threads * steps / elapsed, 1),
+        # 同一时间段内读线程完成的 get_state 次数 (读得越快，和写线程抢 GIL 越多)
+        "get_state_per_s": round(len(read_latencies) / elapsed, 1),
+        "get_state_p50_ms": round(statistics.median(read_latencies) * 1000, 2),
+        "get_state_p99_ms": round(percentile(read_latencies, 99) * 1000, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--steps", type=int, default=200, help="每个线程写入的步数")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8, 64])
+    args = parser.parse_args(argv)
+
+    report = {"steps_per_thread": args.steps, "baseline": [], "pooled": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for threads in args.threads:
+            # 基线：和原来 graph.py 一样，全进程共享一个 sqlite3 连接
+            conn = sqlite3.connect(os.path.join(tmp, f"baseline-{threads}.db"), check_same_thread=False)
+            report["baseline"].append(run(SqliteSaver(conn), threads, args.steps))
+            conn.close()
+
+            saver = PooledSqliteSaver(os.path.join(tmp, f"pooled-{threads}.db"), pool_size=8)
+            report["pooled"].append(run(saver, threads, args.steps))
+            saver.pool.close()
+
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
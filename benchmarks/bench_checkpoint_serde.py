@@ -0,0 +1,188 @@
+"""
+压测：checkpoint 序列化格式 —— 原来的 JsonPlusSerializer vs zstd 压缩 vs zstd + 工具结果去重 (+ 训练字典)
+
+模拟 --threads 个会话，每个会话 --turns 轮对话，每轮：用户提问 -> AI 调工具 -> 工具返回大结果 (版本合入差异 / 配套表，
+十几到几十 KB) -> AI 总结。和真实情况一样，每个 checkpoint 都带着到目前为止的全部消息，
+而且不同会话查的常常是同一组版本，工具结果会重复出现。
+统计:
+  * 库文件大小 (刷盘并截断 WAL 之后)
+  * dumps_typed / loads_typed 每个 checkpoint 的耗时 p50 / p99
+  * get_tuple (恢复最新状态) 的耗时 p50
+
+运行:
+    python -m benchmarks.bench_checkpoint_serde --threads 20 --turns 10
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myproject.settings")
+
+import django
+
+django.setup()
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langgraph.checkpoint.base import empty_checkpoint
+from langgraph.checkpoint.base.id import uuid6
+
+from chat.checkpoint import PooledSqliteSaver
+from chat.serde import train_dictionary
+
+VERSIONS = ["V500R024C00SPC100", "V500R024C10SPC200", "V500R023C10SPC500", "V500R025C00SPC010"]
+COMPONENTS = ["iware", "dopra", "bsp", "oam", "nrcell", "ltecell", "gtran", "platform"]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def merge_diff(rng, old, new):
+    """版本间合入差异：几百条 MR 记录，结构重复、字段值各不相同"""
+    rows = []
+    for i in range(rng.randint(80, 240)):
+        rows.append({
+            "mr_id": f"MR{rng.randint(100000, 999999)}",
+            "component": rng.choice(COMPONENTS),
+            "title": f"[{rng.choice(COMPONENTS)}] 修复 {rng.choice(['告警上报', '内存泄漏', '配置同步', '时钟漂移'])} 问题 #{i}",
+            "author": f"user{rng.randint(1, 300):03d}",
+            "merged_at": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "status": rng.choice(["merged", "reverted", "cherry-picked"]),
+        })
+    return json.dumps({"from": old, "to": new, "count": len(rows), "items": rows}, ensure_ascii=False)
+
+
+def build_tool_results(seed, count):
+    # 所有会话共用的一组“热门查询”结果，会话之间会查到同样的内容
+    rng = random.Random(seed)
+    return [merge_diff(rng, *rng.sample(VERSIONS, 2)) for _ in range(count)]
+
+
+def write_thread(saver, thread_id, turns, tool_results, rng, timings):
+    config = {"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}}
+    messages = []
+    for turn in range(turns):
+        call_id = f"call_{thread_id}_{turn}"
+        messages = messages + [
+            HumanMessage(content=f"帮我查一下 {rng.choice(VERSIONS)} 到 {rng.choice(VERSIONS)} 的合入差异"),
+            AIMessage(content="", tool_calls=[{"name": "get_merge_between", "args": {"turn": turn}, "id": call_id}]),
+            ToolMessage(content=rng.choice(tool_results), tool_call_id=call_id),
+            AIMessage(content=f"两个版本之间共有 {rng.randint(80, 240)} 个 MR 合入，主要集中在 iware 和 dopra。"),
+        ]
+        checkpoint = empty_checkpoint()
+        checkpoint["id"] = str(uuid6(clock_seq=turn))
+        checkpoint["channel_values"] = {"messages": messages}
+
+        t = time.perf_counter()
+        typed = saver.serde.dumps_typed(checkpoint)
+        timings["dumps"].append(time.perf_counter() - t)
+        timings["bytes"].append(len(typed[1]))
+        t = time.perf_counter()
+        saver.serde.loads_typed(typed)
+        timings["loads"].append(time.perf_counter() - t)
+
+        config = saver.put(config, checkpoint, {"source": "loop", "step": turn}, {})
+        saver.put_writes(config, [("messages", messages[-2:])], task_id=f"task-{turn}")
+
+
+def file_size(saver):
+    saver.flush()
+    with saver.lock:
+        conn = saver._writer()
+        conn.commit()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    path = saver.pool.path
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+def run(path, compression, threads, turns, tool_results, train_dict):
+    saver = PooledSqliteSaver(path, compression=compression)
+    timings = {"dumps": [], "loads": [], "bytes": []}
+    rng = random.Random(7)
+    thread_ids = [f"bench-{i}" for i in range(threads)]
+
+    if train_dict:
+        # 先用前一半会话积累数据训练字典，字典生效后再写剩下的会话 (和线上先跑一段时间再执行 train_checkpoint_dict 一样)
+        half = max(1, threads // 2)
+        for thread_id in thread_ids[:half]:
+            write_thread(saver, thread_id, turns, tool_results, rng, {"dumps": [], "loads": [], "bytes": []})
+        saver.flush()
+        with saver.pool.connection() as conn:
+            samples = [saver.serde.payload_bytes(t, p) for t, p in conn.execute("SELECT type, checkpoint FROM checkpoints")]
+            samples += [saver.serde.payload_bytes(t, p) for t, p in conn.execute("SELECT type, value FROM writes")]
+        saver.add_dict(train_dictionary(samples))
+        for thread_id in thread_ids[:half]:
+            saver.delete_thread(thread_id)
+        saver.flush()
+
+    t0 = time.perf_counter()
+    for thread_id in thread_ids:
+        write_thread(saver, thread_id, turns, tool_results, rng, timings)
+    size = file_size(saver)
+    write_elapsed = time.perf_counter() - t0
+
+    # 新开一个实例读，排除序列化器里 blob 缓存的影响
+    reader = PooledSqliteSaver(path, compression=compression)
+    get_latencies = []
+    for thread_id in thread_ids:
+        t = time.perf_counter()
+        reader.get_tuple({"configurable": {"thread_id": thread_id}})
+        get_latencies.append(time.perf_counter() - t)
+    reader.pool.close()
+    saver.pool.close()
+
+    return {
+        "db_bytes": size,
+        "checkpoint_bytes_p50": int(statistics.median(timings["bytes"])),
+        "dumps_p50_ms": round(statistics.median(timings["dumps"]) * 1000, 3),
+        "dumps_p99_ms": round(percentile(timings["dumps"], 99) * 1000, 3),
+        "loads_p50_ms": round(statistics.median(timings["loads"]) * 1000, 3),
+        "loads_p99_ms": round(percentile(timings["loads"], 99) * 1000, 3),
+        "get_tuple_cold_p50_ms": round(statistics.median(get_latencies) * 1000, 3),
+        "write_seconds": round(write_elapsed, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=20, help="会话数")
+    parser.add_argument("--turns", type=int, default=10, help="每个会话的轮数")
+    parser.add_argument("--distinct-results", type=int, default=12, help="不同工具结果的个数 (越少重复越多)")
+    parser.add_argument("--level", type=int, default=3, help="zstd 压缩级别")
+    args = parser.parse_args(argv)
+
+    tool_results = build_tool_results(42, args.distinct_results)
+    no_blobs = {"LEVEL": args.level, "BLOB_MIN_SIZE": float("inf")}
+    with_blobs = {"LEVEL": args.level}
+    variants = [
+        ("jsonplus", None, False),
+        ("zstd", no_blobs, False),
+        ("zstd+blob", with_blobs, False),
+        ("zstd+dict+blob", with_blobs, True),
+    ]
+
+    report = {
+        "threads": args.threads,
+        "turns": args.turns,
+        "tool_result_kb_avg": round(statistics.mean(len(r.encode("utf-8")) for r in tool_results) / 1024, 1),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, compression, train_dict in variants:
+            report[name] = run(os.path.join(tmp, f"{name}.db"), compression, args.threads, args.turns, tool_results, train_dict)
+    baseline = report["jsonplus"]["db_bytes"]
+    for name, _, _ in variants[1:]:
+        report[name]["size_ratio"] = round(report[name]["db_bytes"] / baseline, 4)
+
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+"""
+端到端压测：真实的 Django 应用 + 本地 mock LLM (benchmarks/mock_llm.py) + 本地 cid-service 替身 (benchmarks/stub_cid_service.py)
+
+每个虚拟用户按真实前端的顺序走一遍:
+    创建会话 -> 发 --turns 轮消息 (SSE 流式读完) -> 拉历史记录 -> 查运维全链路追踪
+在每个并发度 (--users) 下统计:
+  * 吞吐: 完成的对话轮数 / 秒、流式 token 数 / 秒
+  * 首 token 延迟 TTFT、token 间隔 (inter-token latency)、每个接口的 p50 / p95 / p99
+  * 每条在途流的内存: (压测期间进程 RSS 峰值 - 压测前 RSS) / 峰值在途流数 (只在进程内启动应用时统计)
+结果写成 JSON (--output)，--compare 传入上一次的结果文件时附上各项指标的变化，方便对比回归。
+
+默认在本进程里用临时数据库启动应用 (WSGI 多线程服务器，走 /api/chat)；
+也可以用 --url 压一个已经启动的服务 (例如 uvicorn myproject.asgi:application 配合 --endpoint /api/chat/async)，
+那个服务需要自己把 AGENT_LLM_BASE_URL / PUO_SERVICE_BASE_URL 指向 mock 服务。
+
+运行:
+    python -m benchmarks.bench_e2e --users 1 8 32 --turns 2 --output benchmarks/results/e2e.json
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.mock_llm import start_mock_llm
+from benchmarks.stub_cid_service import start_stub_server
+
+QUERIES = [
+    "帮我查一下 24a 主干的构建状态",
+    "24a 的 iware 配套信息",
+    "看一下 24b 的版本推送状态",
+    "25a 的 hert 节点有哪些",
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def latency_summary(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50_ms": round(statistics.median(values) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2),
+    }
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+
+        # 取不到当前 RSS 时退回峰值 RSS (Linux 单位是 KB)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler:
+    """后台线程定时采样 RSS，记录峰值"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.baseline = rss_bytes()
+        self.peak = self.baseline
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {"create_session": [], "chat": [], "history": [], "ops_trace": []}
+        self.ttft = []
+        self.inter_token = []
+        self.tokens = 0
+        self.turns = 0
+        self.errors = []
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.latencies[name].append(seconds)
+
+    def stream_started(self):
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def stream_finished(self, ttft, gaps, tokens):
+        with self._lock:
+            self.in_flight -= 1
+            self.turns += 1
+            self.tokens += tokens
+            if ttft is not None:
+                self.ttft.append(ttft)
+            self.inter_token.extend(gaps)
+
+    def error(self, message):
+        with self._lock:
+            self.errors.append(message)
+
+
+def iter_sse_lines(resp):
+    """
+    逐行读取 SSE 响应，数据到了就交出来
+    不用 iter_lines：开发服务器的流式响应没有 chunked 编码，iter_content 会攒满缓冲区 (或读到连接关闭) 才返回，token 间隔就量不准了
+    """
+    buffer = b""
+    while True:
+        data = resp.raw.read1(65536)
+        if not data:
+            break
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8")
+    if buffer:
+        yield buffer.decode("utf-8")
+
+
+def chat_turn(http, base_url, endpoint, session_id, query, rec):
+    rec.stream_started()
+    t0 = time.perf_counter()
+    ttft, last, gaps, tokens = None, None, [], 0
+    try:
+        with http.post(f"{base_url}{endpoint}", json={"query": query, "session_id": session_id}, stream=True, timeout=120) as resp:
+            resp.raise_for_status()
+            for line in iter_sse_lines(resp):
+                if not line or not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                frame = json.loads(data)
+                if frame.get("type") == "error":
+                    rec.error(f"stream: {frame.get('content')}")
+                    break
+                if frame.get("type") != "answer":
+                    continue
+                now = time.perf_counter()
+                if ttft is None:
+                    ttft = now - t0
+                else:
+                    gaps.append(now - last)
+                last = now
+                tokens += 1
+    finally:
+        rec.stream_finished(ttft, gaps, tokens)
+    rec.add("chat", time.perf_counter() - t0)
+
+
+def user_flow(base_url, endpoint, user, turns, rec):
+    """一个虚拟用户：创建会话 -> 多轮对话 -> 历史记录 -> 运维追踪"""
+    http = requests.Session()
+    try:
+        t = time.perf_counter()
+        resp = http.post(f"{base_url}/api/sessions/create", json={"user_id": f"bench-{user}", "title": "新对话"}, timeout=30)
+        resp.raise_for_status()
+        session_id = resp.json()["session_id"]
+        rec.add("create_session", time.perf_counter() - t)
+
+        for turn in range(turns):
+            chat_turn(http, base_url, endpoint, session_id, QUERIES[(user + turn) % len(QUERIES)], rec)
+
+        t = time.perf_counter()
+        resp = http.get(f"{base_url}/api/history", params={"session_id": session_id}, timeout=30)
+        resp.raise_for_status()
+        if len(resp.json()["messages"]) < turns * 2:
+            rec.error(f"history: 会话 {session_id} 只有 {len(resp.json()['messages'])} 条记录")
+        rec.add("history", time.perf_counter() - t)
+
+        t = time.perf_counter()
+        resp = http.get(f"{base_url}/api/ops/trace/{session_id}", timeout=30)
+        resp.raise_for_status()
+        rec.add("ops_trace", time.perf_counter() - t)
+    except Exception as e:
+        rec.error(f"{type(e).__name__}: {e}")
+    finally:
+        http.close()
+
+
+def run_level(base_url, endpoint, users, turns, measure_memory):
+    rec = Recorder()
+    sampler = RssSampler() if measure_memory else None
+    t0 = time.perf_counter()
+    if sampler:
+        sampler.__enter__()
+    try:
+        with ThreadPoolExecutor(max_workers=users) as pool:
+            list(pool.map(lambda u: user_flow(base_url, endpoint, u, turns, rec), range(users)))
+    finally:
+        if sampler:
+            sampler.__exit__(None, None, None)
+    elapsed = time.perf_counter() - t0
+
+    result = {
+        "users": users,
+        "elapsed_s": round(elapsed, 3),
+        "turns": rec.turns,
+        "turns_per_s": round(rec.turns / elapsed, 2),
+        "tokens_per_s": round(rec.tokens / elapsed, 1),
+        "peak_concurrent_streams": rec.peak_in_flight,
+        "ttft": latency_summary(rec.ttft),
+        "inter_token": latency_summary(rec.inter_token),
+        "endpoints": {name: latency_summary(values) for name, values in rec.latencies.items()},
+        "errors": len(rec.errors),
+        "error_samples": rec.errors[:5],
+    }
+    if sampler:
+        grown = max(0, sampler.peak - sampler.baseline)
+        result["rss_baseline_mb"] = round(sampler.baseline / 1024 / 1024, 1)
+        result["rss_peak_mb"] = round(sampler.peak / 1024 / 1024, 1)
+        result["memory_per_stream_kb"] = round(grown / max(1, rec.peak_in_flight) / 1024, 1)
+    return result
+
+
+def start_app(tmp, llm_url, cid_url, answer_cache=False):
+    """在本进程里用临时数据库启动应用，返回 base_url"""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myproject.settings")
+    os.environ.setdefault("DEEPSEEK_API_KEY", "sk-benchmark")
+    os.environ["AGENT_LLM_BASE_URL"] = llm_url
+    os.environ["TITLE_LLM_BASE_URL"] = llm_url
+
+    from django.conf import settings
+
+    # 在 django.setup() 和第一次数据库访问之前改掉存储位置，不碰项目目录下的库
+    settings.DATABASES["default"]["NAME"] = os.path.join(tmp, "db.sqlite3")
+    settings.AGENT_CHECKPOINTER = {
+        **settings.AGENT_CHECKPOINTER,
+        "OPTIONS": {**settings.AGENT_CHECKPOINTER["OPTIONS"], "path": os.path.join(tmp, "agent_chat_history.db")},
+    }
+    settings.PUO_SERVICE = {**settings.PUO_SERVICE, "MOCK_RESPONSE": None, "BASE_URL": cid_url}
+    # 压测的问题反复出现，答案缓存默认关掉，测的是完整的 Agent 链路
+    settings.AGENT_ANSWER_CACHE = {
+        **settings.AGENT_ANSWER_CACHE,
+        "ENABLED": answer_cache,
+        "PATH": os.path.join(tmp, "answer_cache.db"),
+    }
+    # 压测从同一个 IP 打满并发，准入控制的限速 / 并发上限会把请求拒掉，测的是 Agent 本身的容量
+    if hasattr(settings, "AGENT_ADMISSION"):
+        settings.AGENT_ADMISSION = {**settings.AGENT_ADMISSION, "ENABLED": False}
+    settings.LOGGING["loggers"]["chat"]["level"] = "WARNING"
+
+    import django
+
+    django.setup()
+
+    from django.core.management import call_command
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+    from django.core.wsgi import get_wsgi_application
+
+    call_command("migrate", verbosity=0)
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadedWSGIServer(("127.0.0.1", 0), QuietHandler, allow_reuse_address=True)
+    server.request_queue_size = 256
+    server.set_app(get_wsgi_application())
+    # 启动时先构建 Agent，避免第一批请求的延迟里混进导入和编译时间
+    from chat.agents import warm_up
+
+    warm_up()
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, previous):
+    """和上一次的结果按并发度逐项对比，返回 {users: {指标: [上次, 这次, 变化比例]}}"""
+    metrics = [
+        ("turns_per_s", lambda r: r["turns_per_s"]),
+        ("ttft_p50_ms", lambda r: r["ttft"].get("p50_ms")),
+        ("ttft_p99_ms", lambda r: r["ttft"].get("p99_ms")),
+        ("inter_token_p99_ms", lambda r: r["inter_token"].get("p99_ms")),
+        ("chat_p99_ms", lambda r: r["endpoints"]["chat"].get("p99_ms")),
+        ("history_p99_ms", lambda r: r["endpoints"]["history"].get("p99_ms")),
+        ("memory_per_stream_kb", lambda r: r.get("memory_per_stream_kb")),
+    ]
+    old_levels = {level["users"]: level for level in previous.get("levels", [])}
+    diff = {}
+    for level in report["levels"]:
+        old = old_levels.get(level["users"])
+        if not old:
+            continue
+        rows = {}
+        for name, get in metrics:
+            before, after = get(old), get(level)
+            if before is None or after is None:
+                continue
+            rows[name] = [before, after, round((after - before) / before, 4) if before else None]
+        diff[str(level["users"])] = rows
+    return diff
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 8, 32], help="并发用户数 (每个值跑一轮)")
+    parser.add_argument("--turns", type=int, default=2, help="每个用户在会话里发的消息数")
+    parser.add_argument("--ttft-ms", type=float, default=200, help="mock LLM 首 token 延迟")
+    parser.add_argument("--token-ms", type=float, default=10, help="mock LLM 每个 token 间隔")
+    parser.add_argument("--tool-latency-ms", type=float, default=20, help="cid-service 替身的响应延迟")
+    parser.add_argument("--answer-cache", action="store_true", help="打开语义答案缓存 (重复的问题直接回放)")
+    parser.add_argument("--url", help="压测已经启动的服务 (不在本进程内启动应用，不统计内存)")
+    parser.add_argument("--endpoint", default="/api/chat", help="聊天接口路径，ASGI 部署可用 /api/chat/async")
+    parser.add_argument("--output", help="结果 JSON 的保存路径，默认 benchmarks/results/e2e-<时间>.json")
+    parser.add_argument("--compare", help="上一次的结果文件，输出各项指标的变化")
+    args = parser.parse_args(argv)
+
+    llm = start_mock_llm(ttft=args.ttft_ms / 1000, token_delay=args.token_ms / 1000)
+    cid = start_stub_server(latency=args.tool_latency_ms / 1000)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base_url = args.url.rstrip("/") if args.url else start_app(tmp, llm.base_url, cid.base_url, args.answer_cache)
+        levels = []
+        for users in args.users:
+            llm.stats.reset()
+            cid.stats.reset()
+            level = run_level(base_url, args.endpoint, users, args.turns, measure_memory=not args.url)
+            level["mock_llm"] = llm.stats.snapshot()
+            level["cid_service"] = cid.stats.snapshot()
+            levels.append(level)
+            print(
+                f"👥 users={users} turns/s={level['turns_per_s']} ttft_p50={level['ttft'].get('p50_ms')}ms "
+                f"errors={level['errors']}",
+                file=sys.stderr,
+            )
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "git": git_revision(),
+            "python": sys.version.split()[0],
+            "target": args.url or "in-process (WSGI threaded)",
+            "endpoint": args.endpoint,
+            "turns_per_user": args.turns,
+            "mock_llm": {"ttft_ms": args.ttft_ms, "token_ms": args.token_ms},
+            "tool_latency_ms": args.tool_latency_ms,
+        },
+        "levels": levels,
+    }
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            report["compare"] = compare(report, json.load(f))
+
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "results", f"e2e-{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+    print(f"💾 结果已保存到 {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+测量 System Prompt 拆分缓存前后的差异
+
+1. 每次模型调用渲染 Prompt 的 CPU 时间
+   - legacy: 和原来的 inject_environment_context 一样，每次 join 枚举列表再 .format 整段模板
+   - cached: 固定的 SYSTEM_PROMPT (import 时预渲染) + render_environment_context (只格式化环境感知一小节)
+2. 每轮对话写入 checkpoint 的字节数
+   - legacy: before_model 把 SystemMessage 插进 state，随 checkpoint 一起持久化
+   - cached: 构建请求时注入，state 里没有 SystemMessage
+
+运行:
+    python -m benchmarks.bench_prompt --renders 20000 --turns 10
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myproject.settings")
+os.environ.setdefault("DEEPSEEK_API_KEY", "sk-benchmark")
+
+import django
+
+django.setup()
+
+from langchain.agents.middleware import before_model
+from langchain_core.messages import SystemMessage
+
+from chat import graph as agent_graph
+from chat.checkpoint import PooledSqliteSaver
+from chat.testing import StubChatModel
+
+LEGACY_TEMPLATE = (
+    agent_graph.PROMPT_HEAD_TEMPLATE
+    + agent_graph.ENVIRONMENT_SECTION_TEMPLATE
+    + agent_graph.PROMPT_RULES
+)
+
+
+def cached_render(current_time, context_version):
+    return agent_graph.SYSTEM_PROMPT, agent_graph.render_environment_context(current_time, context_version)
+
+
+def legacy_render(current_time, context_version):
+    return LEGACY_TEMPLATE.format(
+        current_time=current_time,
+        context_version=context_version,
+        components_str=", ".join(agent_graph.COMPONENTS_LIST),
+        products_str=", ".join(agent_graph.PRODUCTS_LIST),
+    )
+
+
+@before_model
+def legacy_inject_environment_context(state, runtime):
+    # 原实现：把 SystemMessage 写进 state["messages"]
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    messages = state["messages"]
+    new_sys_msg = SystemMessage(content=legacy_render(now, "29a"))
+    if messages and isinstance(messages[0], SystemMessage):
+        messages[0] = new_sys_msg
+    else:
+        messages.insert(0, new_sys_msg)
+    return {"messages": messages}
+
+
+def bench_render(renders):
+    results = {}
+    for name, render in (("legacy", legacy_render), ("cached", cached_render)):
+        agent_graph.render_environment_context.cache_clear()
+        start = time.process_time()
+        for i in range(renders):
+            # 每 10 次换一个时间戳，模拟真实调用 (一轮对话里的几次模型调用落在同一秒)
+            render(f"2026-01-01 00:00:{i // 10 % 60:02d}", "29a")
+        results[f"{name}_us_per_call"] = round((time.process_time() - start) / renders * 1e6, 2)
+    return results
+
+
+def checkpoint_bytes(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        ckpt = conn.execute("SELECT COALESCE(SUM(LENGTH(checkpoint) + LENGTH(metadata)), 0) FROM checkpoints").fetchone()[0]
+        writes = conn.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM writes").fetchone()[0]
+        return ckpt + writes
+    finally:
+        conn.close()
+
+
+def bench_checkpoint(turns, middleware, tmp, name):
+    db_path = os.path.join(tmp, f"{name}.db")
+    saver = PooledSqliteSaver(db_path, batch_size=1)
+    model = StubChatModel(tool_calls=[{"name": "check_trunk_build_status", "args": {"ver": "24a"}}])
+    agent = agent_graph.create_agent(model=model, tools=agent_graph.tools_list, checkpointer=saver, middleware=middleware)
+    config = {"configurable": {"thread_id": name}}
+    per_turn = []
+    previous = 0
+    for turn in range(turns):
+        agent.invoke({"messages": [("user", f"24a 主干构建状态 第 {turn} 次")]}, config=config)
+        total = checkpoint_bytes(db_path)
+        per_turn.append(total - previous)
+        previous = total
+    saver.pool.close()
+    return per_turn
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--renders", type=int, default=20000)
+    parser.add_argument("--turns", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    report = {"render": bench_render(args.renders)}
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        legacy = bench_checkpoint(args.turns, [legacy_inject_environment_context], tmp, "legacy")
+        cached = bench_checkpoint(args.turns, [agent_graph.inject_environment_context], tmp, "cached")
+    report["checkpoint_bytes_per_turn"] = {
+        "legacy": legacy,
+        "cached": cached,
+        "legacy_avg": round(sum(legacy) / len(legacy)),
+        "cached_avg": round(sum(cached) / len(cached)),
+    }
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+压测：SSE 推流的帧数和服务端 CPU
+
+用 StubChatModel (逐字输出，不发网络请求) 顶替真实 LLM，通过 Django 测试客户端完整走一遍 /api/chat
+(视图 -> StreamingHttpResponse -> 逐帧读出)，统计:
+  * frames_per_answer: 每个回答的 answer 帧数 (前端 reader.read() + JSON.parse 的次数)
+  * bytes_per_answer:  每个回答推给前端的字节数
+  * cpu_ms_per_stream: 每条流消耗的进程 CPU 时间 (串行跑，包含 Agent 本身的开销，两次对比看差值)
+  * first_frame_ms:    从发请求到读到第一帧回答的时间
+--token-ms 可以给多个值，对比 LLM 吐字快慢不同时合并的效果。
+
+只依赖 /api/chat 接口和 chat.agents 注册表，可以在改动前的代码上跑同一个脚本做对比:
+    python -m benchmarks.bench_sse --streams 50 --token-ms 0 2 20
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+REPLY = (
+    "已查询到数据，24a 主干最近一次构建成功，构建节点 36ff94e9，耗时 42 分钟，没有失败的编译任务。"
+    "最近 24 小时共触发 6 次构建，其中 1 次因为代码检查告警被重试，重试后通过；"
+    "当前排队中的合入请求 3 个，预计下一次构建在 20 分钟后开始。"
+) * 3
+
+
+def setup(tmp):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myproject.settings")
+    os.environ.setdefault("DEEPSEEK_API_KEY", "sk-benchmark")
+    from django.conf import settings
+
+    settings.DATABASES["default"]["NAME"] = os.path.join(tmp, "db.sqlite3")
+    settings.LOGGING["loggers"]["chat"]["level"] = "WARNING"
+    if hasattr(settings, "AGENT_ANSWER_CACHE"):
+        settings.AGENT_ANSWER_CACHE = {**settings.AGENT_ANSWER_CACHE, "ENABLED": False}
+    if hasattr(settings, "AGENT_ADMISSION"):
+        settings.AGENT_ADMISSION = {**settings.AGENT_ADMISSION, "ENABLED": False}
+
+    import django
+
+    django.setup()
+    from django.core.management import call_command
+
+    call_command("migrate", verbosity=0)
+
+
+def use_stub_agent(token_delay):
+    from langgraph.checkpoint.memory import InMemorySaver
+
+    from chat.agents import registry
+    from chat.graph import build_agent
+    from chat.testing import StubChatModel
+
+    model = StubChatModel(reply=REPLY, token_delay=token_delay)
+    registry.register("graph", lambda: build_agent(model, InMemorySaver()))
+
+
+def run(streams):
+    from django.test import Client
+
+    client = Client(HTTP_HOST="127.0.0.1")
+    frames, sizes, firsts = [], [], []
+    cpu_start = time.process_time()
+    for i in range(streams):
+        started = time.perf_counter()
+        response = client.post(
+            "/api/chat",
+            json.dumps({"query": "你好，介绍一下最近的构建情况", "session_id": f"bench-sse-{i}"}),
+            content_type="application/json",
+        )
+        answer_frames, size, first, content = 0, 0, None, []
+        for data in response.streaming_content:
+            size += len(data)
+            for line in data.decode("utf-8").split("\n"):
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                payload = json.loads(line[6:])
+                if payload["type"] == "answer":
+                    answer_frames += 1
+                    content.append(payload["content"])
+                    if first is None:
+                        first = time.perf_counter() - started
+        assert "".join(content) == REPLY, "回答内容不完整"
+        frames.append(answer_frames)
+        sizes.append(size)
+        firsts.append(first)
+    cpu = time.process_time() - cpu_start
+    return {
+        "frames_per_answer": statistics.mean(frames),
+        "bytes_per_answer": statistics.mean(sizes),
+        "cpu_ms_per_stream": round(cpu / streams * 1000, 2),
+        "first_frame_ms": round(statistics.median(firsts) * 1000, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=50)
+    parser.add_argument("--token-ms", type=float, nargs="+", default=[0, 2, 20], help="假 LLM 每个字的间隔")
+    args = parser.parse_args(argv)
+
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    report = {"reply_chars": len(REPLY), "streams": args.streams, "levels": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        setup(tmp)
+        for token_ms in args.token_ms:
+            use_stub_agent(token_ms / 1000)
+            run(2)  # 预热：构建 Agent、导入
+            report["levels"].append({"token_ms": token_ms, **run(args.streams)})
+
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
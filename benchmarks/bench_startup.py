@@ -0,0 +1,143 @@
+"""
+压测：启动耗时 (导入时间 / worker 冷启动)
+
+每一项都在全新的子进程里跑 --runs 次取中位数:
+  * manage_check:   python manage.py check 的总耗时 (所有管理命令、migrate 都要付的导入开销)
+  * import_urls:    django.setup() 之后导入 URL 配置 (chat.views / chat.ops_views) 的耗时
+  * cold_start:     一个 worker 从进程启动到处理完第一个请求:
+                      - wsgi_import_s:     导入 myproject.wsgi
+                      - first_request_s:   第一个普通请求 (会话列表)
+                      - first_agent_s:     第一次拿到 Agent (导入 langchain + 编译图 + 打开存储器)
+  * cold_start_warmup: 同上，但设置 AGENT_WARMUP=1，Agent 的构建挪到了导入 wsgi 的阶段
+另外在本进程里 fork 一次，检查子进程拿到的存储器是不是重新构建的 (fork_safe)。
+
+运行:
+    python -m benchmarks.bench_startup --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子进程里先把数据库指到临时目录，不碰项目目录下的库
+_SETUP_TMP_DB = """
+import os, sys, time, json
+sys.path.insert(0, {root!r})
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myproject.settings")
+os.environ.setdefault("DEEPSEEK_API_KEY", "sk-benchmark")
+from django.conf import settings
+settings.DATABASES["default"]["NAME"] = os.path.join({tmp!r}, "db.sqlite3")
+settings.AGENT_CHECKPOINTER = {{
+    **settings.AGENT_CHECKPOINTER,
+    "OPTIONS": {{**settings.AGENT_CHECKPOINTER["OPTIONS"], "path": os.path.join({tmp!r}, "agent_chat_history.db")}},
+}}
+"""
+
+IMPORT_URLS = """
+import django
+django.setup()
+t = time.perf_counter()
+import myproject.urls
+print(json.dumps({{"import_urls_s": time.perf_counter() - t}}))
+"""
+
+COLD_START = """
+t0 = time.perf_counter()
+import myproject.wsgi
+t1 = time.perf_counter()
+from django.core.management import call_command
+call_command("migrate", verbosity=0)
+from django.test import Client
+t2 = time.perf_counter()
+Client(HTTP_HOST="127.0.0.1").get("/api/sessions/list", {{"user_id": "bench"}})
+t3 = time.perf_counter()
+from chat.agents import get_graph
+get_graph()
+t4 = time.perf_counter()
+print(json.dumps({{"wsgi_import_s": t1 - t0, "first_request_s": t3 - t2, "first_agent_s": t4 - t3}}))
+"""
+
+
+def run_child(code, env=None):
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=ROOT,
+        env={**os.environ, **(env or {})},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def wall_time(cmd, env=None):
+    started = time.perf_counter()
+    subprocess.run(cmd, cwd=ROOT, env={**os.environ, **(env or {})}, capture_output=True, check=True)
+    return time.perf_counter() - started
+
+
+def median_of(samples):
+    keys = samples[0].keys()
+    return {key: round(statistics.median(s[key] for s in samples), 3) for key in keys}
+
+
+def fork_check(tmp):
+    """父进程构建好存储器后 fork，子进程拿到的应该是新实例"""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myproject.settings")
+    os.environ.setdefault("DEEPSEEK_API_KEY", "sk-benchmark")
+    from django.conf import settings
+
+    settings.AGENT_CHECKPOINTER = {
+        **settings.AGENT_CHECKPOINTER,
+        "OPTIONS": {**settings.AGENT_CHECKPOINTER["OPTIONS"], "path": os.path.join(tmp, "fork.db")},
+    }
+    import django
+
+    django.setup()
+    from chat.agents import registry
+
+    parent = registry.get("checkpointer")
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        child = registry.get("checkpointer")
+        os.write(write_fd, b"1" if child is not parent else b"0")
+        os._exit(0)
+    os.close(write_fd)
+    rebuilt = os.read(read_fd, 1) == b"1"
+    os.waitpid(pid, 0)
+    return rebuilt
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    env = {"DEEPSEEK_API_KEY": os.environ.get("DEEPSEEK_API_KEY", "sk-benchmark")}
+    report = {"runs": args.runs}
+    with tempfile.TemporaryDirectory() as tmp:
+        setup = _SETUP_TMP_DB.format(root=ROOT, tmp=tmp)
+        report["manage_check_s"] = round(
+            statistics.median(wall_time([sys.executable, "manage.py", "check"], env) for _ in range(args.runs)), 3
+        )
+        report["import_urls"] = median_of([run_child(setup + IMPORT_URLS.format(), env) for _ in range(args.runs)])
+        report["cold_start"] = median_of([run_child(setup + COLD_START.format(), env) for _ in range(args.runs)])
+        report["cold_start_warmup"] = median_of(
+            [run_child(setup + COLD_START.format(), {**env, "AGENT_WARMUP": "1"}) for _ in range(args.runs)]
+        )
+        report["fork_safe"] = fork_check(tmp)
+
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+压测：工具调用的 HTTP 请求 —— 每次新建连接 vs 共享连接池 (同步) vs 异步连接池
+
+对本地 stub cid-service (benchmarks/stub_cid_service.py) 发起 N 次工具调用，保持 C 个并发，对比：
+  * 服务端看到的 TCP 连接数 (连接复用情况)
+  * 单次工具调用耗时的 p50 / p99
+  * 重试次数 (--fail-rate 大于 0 时，服务端随机返回 503)
+
+三条链路都走真实的工具调用入口 (tool.invoke / tool.ainvoke)，只替换底层 HTTP 客户端。
+
+运行:
+    python -m benchmarks.bench_tool_http --calls 1000 --concurrency 50 --latency-ms 20 --fail-rate 0.02
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myproject.settings")
+os.environ.setdefault("DEEPSEEK_API_KEY", "sk-benchmark")
+
+import django
+
+django.setup()
+
+import requests
+
+from benchmarks.stub_cid_service import start_stub_server
+from chat.tools import http_client
+from chat.tools.cache import tool_result_cache
+from chat.tools.http_client import AsyncPooledHttpClient, PooledHttpClient, get_service_conf
+from chat.tools.PuoToolManager import PuoToolManager
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class PerCallHttpClient(PooledHttpClient):
+    """对照组：和改造前直接 requests.post 一样，每次调用都新建连接"""
+
+    def post_json(self, url, payload, headers=None, max_retries=None):
+        with requests.Session() as session:
+            self._session, self._pid = session, os.getpid()
+            return super().post_json(url, payload, headers=headers, max_retries=max_retries)
+
+
+TOOL = PuoToolManager.query_component_details
+TOOL_ARGS = {"ver": "24a", "search_key": "release/24a", "component_name": "iware"}
+
+
+def run_sync(calls, concurrency):
+    latencies = []
+
+    def one_call(_):
+        start = time.perf_counter()
+        TOOL.invoke(TOOL_ARGS)
+        latencies.append(time.perf_counter() - start)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_call, range(calls)))
+    return time.perf_counter() - t0, latencies
+
+
+async def run_async(calls, concurrency):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_call():
+        async with semaphore:
+            start = time.perf_counter()
+            await TOOL.ainvoke(TOOL_ARGS)
+            latencies.append(time.perf_counter() - start)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one_call() for _ in range(calls)))
+    await http_client.get_async_http_client().aclose()
+    return time.perf_counter() - t0, latencies
+
+
+def summarize(name, server, elapsed, latencies):
+    stats = server.stats.snapshot()
+    return {
+        "client": name,
+        "elapsed_s": round(elapsed, 3),
+        "calls_per_s": round(len(latencies) / elapsed, 1),
+        "tcp_connections": stats["connections"],
+        "http_requests": stats["requests"],
+        "retried_503": stats["failures"],
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=1000, help="工具调用总次数")
+    parser.add_argument("--concurrency", type=int, default=50, help="同时在途的工具调用数")
+    parser.add_argument("--latency-ms", type=float, default=20, help="stub 服务每个请求的处理耗时")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="stub 服务随机返回 503 的比例")
+    args = parser.parse_args(argv)
+
+    # 这里测的是 HTTP 连接复用，关掉工具结果缓存，保证每次调用都真的发请求
+    tool_result_cache.enabled = False
+    server = start_stub_server(latency=args.latency_ms / 1000, fail_rate=args.fail_rate)
+    conf = {
+        **get_service_conf(),
+        "MOCK_RESPONSE": None,
+        "BASE_URL": server.base_url,
+        "POOL_SIZE": args.concurrency,
+        # 压测关心的是连接复用，退避时间压小一点，免得重试把结果拉得太长
+        "BACKOFF_BASE": 0.01,
+    }
+
+    results = []
+    # 重试日志会刷屏，压测期间丢掉
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name, client in (
+            ("per-call connection (requests.post)", PerCallHttpClient(conf)),
+            ("pooled session (sync)", PooledHttpClient(conf)),
+        ):
+            http_client._http_client = client
+            server.stats.reset()
+            elapsed, latencies = run_sync(args.calls, args.concurrency)
+            results.append(summarize(name, server, elapsed, latencies))
+
+        http_client._async_http_client = AsyncPooledHttpClient(conf)
+        server.stats.reset()
+        elapsed, latencies = asyncio.run(run_async(args.calls, args.concurrency))
+        results.append(summarize("pooled aiohttp (async)", server, elapsed, latencies))
+
+    server.shutdown()
+    report = {
+        "calls": args.calls,
+        "concurrency": args.concurrency,
+        "latency_ms": args.latency_ms,
+        "fail_rate": args.fail_rate,
+        "results": results,
+    }
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+本地 OpenAI 兼容 LLM 替身 (压测 / 联调用)
+
+实现 POST /chat/completions (也接受 /v1/chat/completions)，支持 stream=True 的 SSE 分块输出和
+stream_options.include_usage。输出是确定性的：
+  * 请求带了 tools，且最后一条对话消息是用户提问 -> 发起一次工具调用 (--tool，默认 check_trunk_build_status)
+  * 起标题的批量请求 (prompt 里要求输出 JSON 数组) -> 按条数返回 JSON 字符串数组
+  * 其他情况 -> 按 --chars-per-token 切分固定回复逐块吐出
+首 token 延迟和每个 token 的间隔可配，用来把 LLM 的耗时固定下来，压测只测我们自己的代码。
+
+单独运行 (然后设置环境变量 AGENT_LLM_BASE_URL=http://127.0.0.1:8766，起标题用 TITLE_LLM_BASE_URL):
+    python -m benchmarks.mock_llm --port 8766 --ttft-ms 200 --token-ms 20
+"""
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = "已查询到数据，24a 主干最近一次构建成功，构建节点 36ff94e9，耗时 42 分钟，没有失败的编译任务。"
+
+
+class MockLLMStats:
+    def __init__(self):
+        self.requests = 0
+        self.streams = 0
+        self.tool_calls = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def reset(self):
+        with self._lock:
+            self.requests = self.streams = self.tool_calls = self.completion_tokens = 0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "streams": self.streams,
+                "tool_calls": self.tool_calls,
+                "completion_tokens": self.completion_tokens,
+            }
+
+
+def _text(content) -> str:
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._reply_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+        server = self.server
+        server.stats.incr("requests")
+
+        message, tokens = server.respond(body.get("messages", []), bool(body.get("tools")))
+        usage = {
+            "prompt_tokens": sum(len(_text(m.get("content"))) for m in body.get("messages", [])),
+            "completion_tokens": len(tokens),
+            "total_tokens": 0,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        server.stats.incr("completion_tokens", len(tokens))
+        if message.get("tool_calls"):
+            server.stats.incr("tool_calls")
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:16]}"
+        if body.get("stream"):
+            server.stats.incr("streams")
+            include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+            self._stream(completion_id, body.get("model", "mock"), message, tokens, usage if include_usage else None)
+        else:
+            time.sleep(server.ttft + server.token_delay * max(len(tokens) - 1, 0))
+            self._reply_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [{
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": "tool_calls" if message.get("tool_calls") else "stop",
+                }],
+                "usage": usage,
+            })
+
+    # --- SSE 分块 (chunked transfer encoding，连接可以 keep-alive 复用) ---
+    def _stream(self, completion_id, model, message, tokens, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(delta=None, finish_reason=None, **extra):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                **extra,
+            }
+            self._write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n")
+
+        time.sleep(self.server.ttft)
+        if message.get("tool_calls"):
+            chunk({"role": "assistant", "content": None, "tool_calls": [
+                {"index": i, **call} for i, call in enumerate(message["tool_calls"])
+            ]})
+            chunk({}, "tool_calls")
+        else:
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(self.server.token_delay)
+                chunk({"role": "assistant", "content": token} if i == 0 else {"content": token})
+            chunk({}, "stop")
+        if usage:
+            chunk(None, usage=usage)
+        self._write("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _write(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _reply_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address, ttft=0.0, token_delay=0.0, reply=DEFAULT_REPLY, chars_per_token=2,
+                 tool="check_trunk_build_status", tool_args=None):
+        super().__init__(address, MockLLMHandler)
+        self.ttft = ttft
+        self.token_delay = token_delay
+        self.reply = reply
+        self.chars_per_token = max(1, chars_per_token)
+        self.tool = tool
+        self.tool_args = tool_args if tool_args is not None else {"ver": "24a"}
+        self.stats = MockLLMStats()
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def tokenize(self, text):
+        return [text[i:i + self.chars_per_token] for i in range(0, len(text), self.chars_per_token)] or [""]
+
+    def respond(self, messages, has_tools):
+        """返回 (OpenAI 格式的 assistant 消息, 流式输出的 token 列表)"""
+        conversation = [m for m in messages if m.get("role") != "system"]
+        if has_tools and self.tool and conversation and conversation[-1].get("role") == "user":
+            call = {
+                "id": f"call_{uuid.uuid4().hex[:12]}",
+                "type": "function",
+                "function": {"name": self.tool, "arguments": json.dumps(self.tool_args, ensure_ascii=False)},
+            }
+            return {"role": "assistant", "content": None, "tool_calls": [call]}, [""]
+
+        prompt = _text(conversation[-1].get("content")) if conversation else ""
+        if "JSON 字符串数组" in prompt:
+            # chat/llm.py 的批量起标题
+            count = len(re.findall(r"^\d+\. ", prompt, re.M))
+            reply = json.dumps([f"压测会话{i + 1}" for i in range(count)], ensure_ascii=False)
+        elif "对话标题" in prompt:
+            reply = "压测会话"
+        else:
+            reply = self.reply
+        return {"role": "assistant", "content": reply}, self.tokenize(reply)
+
+
+def start_mock_llm(host="127.0.0.1", port=0, **kwargs) -> MockLLMServer:
+    """在后台线程里启动 mock LLM，port=0 表示随机端口"""
+    server = MockLLMServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--ttft-ms", type=float, default=200, help="首 token 延迟")
+    parser.add_argument("--token-ms", type=float, default=20, help="每个 token 的间隔")
+    parser.add_argument("--chars-per-token", type=int, default=2)
+    parser.add_argument("--tool", default="check_trunk_build_status", help="第一次调用时发起的工具调用，空字符串表示不调工具")
+    args = parser.parse_args()
+
+    server = MockLLMServer(
+        (args.host, args.port),
+        ttft=args.ttft_ms / 1000,
+        token_delay=args.token_ms / 1000,
+        chars_per_token=args.chars_per_token,
+        tool=args.tool or None,
+    )
+    print(f"🚀 mock LLM listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats.snapshot()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+本地 cid-service 替身 (压测 / 联调用)
+
+对任意 POST 路径返回一段 JSON，可配置固定延迟和随机失败率 (返回 503)，
+并统计服务端看到的 TCP 连接数和请求数，用来验证客户端有没有复用连接。
+
+单独运行 (然后把 settings.PUO_SERVICE 的 MOCK_RESPONSE 设为 None，
+并设置环境变量 PUO_SERVICE_BASE_URL=http://127.0.0.1:8765):
+    python -m benchmarks.stub_cid_service --port 8765 --latency-ms 20 --fail-rate 0.05
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubStats:
+    def __init__(self):
+        self.connections = 0
+        self.requests = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def reset(self):
+        with self._lock:
+            self.connections = self.requests = self.failures = 0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"connections": self.connections, "requests": self.requests, "failures": self.failures}
+
+
+class StubCidServiceHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 才支持 keep-alive
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        # 每条 TCP 连接对应一个 handler 实例
+        super().setup()
+        self.server.stats.incr("connections")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        self.server.stats.incr("requests")
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if random.random() < self.server.fail_rate:
+            self.server.stats.incr("failures")
+            self._reply(503, {"error": "service unavailable"})
+            return
+
+        endpoint = self.path.rstrip("/").rsplit("/", 1)[-1]
+        self._reply(200, {"code": 0, "endpoint": endpoint, "data": payload})
+
+    def _reply(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubCidServiceServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 默认 backlog 只有 5，并发建连时会被内核丢 SYN，压测结果会失真
+    request_queue_size = 256
+
+    def __init__(self, address, latency=0.0, fail_rate=0.0):
+        super().__init__(address, StubCidServiceHandler)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.stats = StubStats()
+
+    def handle_error(self, request, client_address):
+        # 客户端超时 / 取消后断开连接是预期行为，不打印堆栈
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_stub_server(host="127.0.0.1", port=0, latency=0.0, fail_rate=0.0) -> StubCidServiceServer:
+    """在后台线程里启动 stub 服务，port=0 表示随机端口"""
+    server = StubCidServiceServer((host, port), latency=latency, fail_rate=fail_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = StubCidServiceServer((args.host, args.port), latency=args.latency_ms / 1000, fail_rate=args.fail_rate)
+    print(f"🚀 stub cid-service listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats.snapshot()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,597 @@
+"""
+聊天接口的准入控制 (令牌桶限速 + 并发流上限 + 有界等待队列)
+
+以前 /api/chat 对调用方没有任何限制：一个脚本就能开几十条流、把 DeepSeek 的配额跑光，其他用户全部排队。
+现在每个请求进入 Agent 之前先过准入:
+  * 令牌桶：每个用户一个桶、全局一个桶，每个放行的请求消耗一个令牌 (拿到并发名额之后才扣，因为并发满了被拒的请求不扣)；
+    桶空了直接 429，Retry-After 是攒够一个令牌的时间
+  * 并发流：同一个用户 / 全局同时在推的流有上限，每条流占一个带过期时间的租约 (worker 崩了租约到期自动释放)，
+    推流结束 (含前端断开) 时释放；长回答由后台线程定期续租
+  * 有界等待：并发满了的请求最多排队 MAX_WAIT 秒等名额，排队的请求数超过 QUEUE_SIZE 时不再排队，直接 429，
+    不会在 worker 里越堆越多
+
+用户按会话的 user_id 区分，没有会话记录的按客户端 IP。
+计数放在可替换的后端里，写法仿照 CACHES (BACKEND + OPTIONS):
+  * InMemoryAdmissionBackend: 默认，进程内计数 (单 worker 部署)
+  * SqliteAdmissionBackend: 本机共享的 SQLite 文件，单机多 worker 用
+  * RedisAdmissionBackend: 多机部署，需要 pip install redis
+配置见 settings.AGENT_ADMISSION，统计见运维接口 /api/ops/admission。
+"""
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+import weakref
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import List, Optional, Sequence, Tuple
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from chat.config import get_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADMISSION = {
+    "ENABLED": True,
+    "BACKEND": "chat.admission.InMemoryAdmissionBackend",
+    "OPTIONS": {},
+    # 令牌桶：CAPACITY 是允许的突发请求数，PER_SECOND 是每秒补充的令牌数 (长期平均速率)
+    "USER_BUCKET": {"CAPACITY": 20, "PER_SECOND": 0.5},
+    "GLOBAL_BUCKET": {"CAPACITY": 200, "PER_SECOND": 20},
+    # 同时在推的流数上限
+    "USER_MAX_STREAMS": 3,
+    "GLOBAL_MAX_STREAMS": 100,
+    # 并发满了时每个 worker 进程最多排队多少个请求、每个请求最多等多久 (秒)
+    "QUEUE_SIZE": 32,
+    "MAX_WAIT": 3.0,
+    # 流租约的有效期 (秒)，每 1/3 有效期续一次
+    "LEASE_TTL": 60,
+}
+
+# 排队等名额时的轮询间隔 (秒)
+POLL_INTERVAL = 0.05
+
+# (key, capacity, per_second)
+Bucket = Tuple[str, float, float]
+# (key, limit)
+Slot = Tuple[str, int]
+
+
+class AdmissionRejected(Exception):
+    """请求没有通过准入，视图返回 429"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+# ==========================================
+# 后端：令牌桶 + 租约计数
+# ==========================================
+# take(buckets)                  所有桶都有令牌时各扣一个，返回 (0, None)；否则一个都不扣，返回 (等待秒数, 不够的桶)
+# acquire(slots, lease_id, ttl)  所有计数都没到上限时各登记一个租约，返回 True；否则一个都不登记
+# renew(keys, lease_id, ttl)     续租
+# release(keys, lease_id)        释放
+# active(key)                    当前未过期的租约数
+
+class InMemoryAdmissionBackend:
+    """进程内计数，只在单个 worker 进程内生效"""
+
+    blocking_io = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._leases = defaultdict(dict)
+
+    def take(self, buckets: Sequence[Bucket]):
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            for key, capacity, per_second in buckets:
+                tokens, updated = self._buckets.get(key, (capacity, now))
+                levels.append(min(capacity, tokens + (now - updated) * per_second))
+            for (key, capacity, per_second), tokens in zip(buckets, levels):
+                if tokens < 1:
+                    return (1 - tokens) / per_second, key
+            for (key, _, _), tokens in zip(buckets, levels):
+                self._buckets[key] = (tokens - 1, now)
+            return 0.0, None
+
+    def _expire(self, key: str, now: float) -> dict:
+        leases = self._leases[key]
+        for lease_id in [lease for lease, expires in leases.items() if expires <= now]:
+            del leases[lease_id]
+        return leases
+
+    def acquire(self, slots: Sequence[Slot], lease_id: str, ttl: float) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if any(len(self._expire(key, now)) >= limit for key, limit in slots):
+                return False
+            for key, _ in slots:
+                self._leases[key][lease_id] = now + ttl
+            return True
+
+    def renew(self, keys: Sequence[str], lease_id: str, ttl: float) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                leases = self._leases.get(key)
+                if leases is not None and lease_id in leases:
+                    leases[lease_id] = now + ttl
+
+    def release(self, keys: Sequence[str], lease_id: str) -> None:
+        with self._lock:
+            for key in keys:
+                leases = self._leases.get(key)
+                if leases is not None:
+                    leases.pop(lease_id, None)
+                    if not leases:
+                        del self._leases[key]
+
+    def active(self, key: str) -> int:
+        with self._lock:
+            return len(self._expire(key, time.monotonic()))
+
+
+class SqliteAdmissionBackend:
+    """
+    本机多个 worker 进程共享的 SQLite 文件
+    每次操作一个 BEGIN IMMEDIATE 事务 (写锁)，读-改-写在进程之间也是原子的；时间用 time.time()，同一台机器上各进程一致
+    """
+
+    blocking_io = True
+
+    def __init__(self, path, pool_size: int = 4, timeout: float = 5.0):
+        from chat.checkpoint import SqliteConnectionPool
+
+        self.pool = SqliteConnectionPool(path, size=pool_size, timeout=timeout)
+        with self._transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "key TEXT NOT NULL, lease_id TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (key, lease_id))"
+            )
+
+    @contextmanager
+    def _transaction(self):
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.commit()
+
+    def take(self, buckets: Sequence[Bucket]):
+        now = time.time()
+        with self._transaction() as conn:
+            levels = []
+            for key, capacity, per_second in buckets:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens, updated = row if row else (capacity, now)
+                levels.append(min(capacity, tokens + max(0.0, now - updated) * per_second))
+            for (key, capacity, per_second), tokens in zip(buckets, levels):
+                if tokens < 1:
+                    return (1 - tokens) / per_second, key
+            conn.executemany(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                [(key, tokens - 1, now) for (key, _, _), tokens in zip(buckets, levels)],
+            )
+            return 0.0, None
+
+    def acquire(self, slots: Sequence[Slot], lease_id: str, ttl: float) -> bool:
+        now = time.time()
+        with self._transaction() as conn:
+            for key, limit in slots:
+                conn.execute("DELETE FROM leases WHERE key = ? AND expires <= ?", (key, now))
+                (count,) = conn.execute("SELECT COUNT(*) FROM leases WHERE key = ?", (key,)).fetchone()
+                if count >= limit:
+                    return False
+            conn.executemany(
+                "INSERT OR REPLACE INTO leases (key, lease_id, expires) VALUES (?, ?, ?)",
+                [(key, lease_id, now + ttl) for key, _ in slots],
+            )
+            return True
+
+    def renew(self, keys: Sequence[str], lease_id: str, ttl: float) -> None:
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE leases SET expires = ? WHERE key = ? AND lease_id = ?",
+                [(time.time() + ttl, key, lease_id) for key in keys],
+            )
+
+    def release(self, keys: Sequence[str], lease_id: str) -> None:
+        with self._transaction() as conn:
+            conn.executemany("DELETE FROM leases WHERE key = ? AND lease_id = ?", [(key, lease_id) for key in keys])
+
+    def active(self, key: str) -> int:
+        with self.pool.connection() as conn:
+            (count,) = conn.execute(
+                "SELECT COUNT(*) FROM leases WHERE key = ? AND expires > ?", (key, time.time())
+            ).fetchone()
+            return count
+
+
+# Redis 脚本里的时间统一用 Redis 服务器的 TIME，多台机器之间的时钟误差不影响令牌桶和租约
+_REDIS_NOW = "local t = redis.call('TIME'); local now = tonumber(t[1]) + tonumber(t[2]) / 1000000"
+
+# KEYS: 各个桶；ARGV: capacity1, per_second1, capacity2, per_second2 ...
+_REDIS_TAKE = _REDIS_NOW + """
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    levels[i] = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    if levels[i] < 1 then
+        return {tostring((1 - levels[i]) / rate), i}
+    end
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    redis.call('HSET', key, 'tokens', levels[i] - 1, 'updated', now)
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return {'0', 0}
+"""
+
+# KEYS: 各个租约集合 (zset，score 是过期时间)；ARGV: lease_id, ttl, limit1, limit2 ...
+_REDIS_ACQUIRE = _REDIS_NOW + """
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now)
+    if redis.call('ZCARD', key) >= tonumber(ARGV[i + 2]) then
+        return 0
+    end
+end
+local ttl = tonumber(ARGV[2])
+for _, key in ipairs(KEYS) do
+    redis.call('ZADD', key, now + ttl, ARGV[1])
+    redis.call('EXPIRE', key, math.ceil(ttl) + 1)
+end
+return 1
+"""
+
+# KEYS: 各个租约集合；ARGV: lease_id, ttl
+_REDIS_RENEW = _REDIS_NOW + """
+local ttl = tonumber(ARGV[2])
+for _, key in ipairs(KEYS) do
+    redis.call('ZADD', key, 'XX', now + ttl, ARGV[1])
+    redis.call('EXPIRE', key, math.ceil(ttl) + 1)
+end
+return 1
+"""
+
+_REDIS_ACTIVE = _REDIS_NOW + """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+return redis.call('ZCARD', KEYS[1])
+"""
+
+
+class RedisAdmissionBackend:
+    """多台机器共享：令牌桶和租约的读-改-写都在 Lua 脚本里完成，Redis 保证原子性"""
+
+    blocking_io = True
+
+    def __init__(self, url: str, prefix: str = "agent:admission:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise ImproperlyConfigured("RedisAdmissionBackend 需要安装 redis (pip install redis)") from e
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.client.register_script(_REDIS_TAKE)
+        self._acquire = self.client.register_script(_REDIS_ACQUIRE)
+        self._renew = self.client.register_script(_REDIS_RENEW)
+        self._active = self.client.register_script(_REDIS_ACTIVE)
+
+    def _bucket_key(self, key: str) -> str:
+        return f"{self.prefix}bucket:{key}"
+
+    def _lease_key(self, key: str) -> str:
+        return f"{self.prefix}lease:{key}"
+
+    def take(self, buckets: Sequence[Bucket]):
+        args = []
+        for _, capacity, per_second in buckets:
+            args += [capacity, per_second]
+        wait, index = self._take(keys=[self._bucket_key(key) for key, _, _ in buckets], args=args)
+        if not index:
+            return 0.0, None
+        return float(wait), buckets[int(index) - 1][0]
+
+    def acquire(self, slots: Sequence[Slot], lease_id: str, ttl: float) -> bool:
+        keys = [self._lease_key(key) for key, _ in slots]
+        return bool(self._acquire(keys=keys, args=[lease_id, ttl] + [limit for _, limit in slots]))
+
+    def renew(self, keys: Sequence[str], lease_id: str, ttl: float) -> None:
+        self._renew(keys=[self._lease_key(key) for key in keys], args=[lease_id, ttl])
+
+    def release(self, keys: Sequence[str], lease_id: str) -> None:
+        pipe = self.client.pipeline()
+        for key in keys:
+            pipe.zrem(self._lease_key(key), lease_id)
+        pipe.execute()
+
+    def active(self, key: str) -> int:
+        return int(self._active(keys=[self._lease_key(key)]))
+
+
+# ==========================================
+# 准入控制
+# ==========================================
+
+class Lease:
+    """一条流占用的名额 (或一个会话的运行权，见 chat/session_lock.py)，用完时 release() (可以重复调用)"""
+
+    def __init__(self, controller: "AdmissionController", keys: List[str], ttl: float):
+        self.controller = controller
+        self.keys = keys
+        self.ttl = ttl
+        self.lease_id = uuid.uuid4().hex
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.controller._release(self)
+
+    async def arelease(self):
+        if self.controller.backend.blocking_io:
+            await asyncio.to_thread(self.release)
+        else:
+            self.release()
+
+
+class AdmissionStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record_admit(self, waited: float):
+        with self._lock:
+            self.admitted += 1
+            if waited > 0:
+                self.queued += 1
+                self.wait_seconds += waited
+
+    def record_reject(self, reason: str):
+        with self._lock:
+            self.rejected[reason] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            rejected = sum(self.rejected.values())
+            total = self.admitted + rejected
+            return {
+                "admitted": self.admitted,
+                "rejected": rejected,
+                "rejected_by_reason": dict(self.rejected),
+                "reject_rate": round(rejected / total, 4) if total else None,
+                "queued": self.queued,
+                "avg_queue_wait_ms": round(self.wait_seconds / self.queued * 1000, 1) if self.queued else None,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.admitted = 0
+            self.queued = 0
+            self.wait_seconds = 0.0
+            self.rejected = defaultdict(int)
+
+
+class AdmissionController:
+    def __init__(self, backend, conf: Optional[dict] = None):
+        conf = {**DEFAULT_ADMISSION, **(conf or {})}
+        self.backend = backend
+        self.enabled = conf["ENABLED"]
+        self.user_bucket = conf["USER_BUCKET"]
+        self.global_bucket = conf["GLOBAL_BUCKET"]
+        self.user_max_streams = conf["USER_MAX_STREAMS"]
+        self.global_max_streams = conf["GLOBAL_MAX_STREAMS"]
+        self.queue_size = conf["QUEUE_SIZE"]
+        self.max_wait = conf["MAX_WAIT"]
+        self.lease_ttl = conf["LEASE_TTL"]
+        for name in ("USER_BUCKET", "GLOBAL_BUCKET"):
+            bucket = conf[name]
+            if bucket["CAPACITY"] < 1 or bucket["PER_SECOND"] <= 0:
+                raise ImproperlyConfigured(f"AGENT_ADMISSION.{name} 的 CAPACITY 至少为 1，PER_SECOND 必须大于 0: {bucket}")
+        for name in ("USER_MAX_STREAMS", "GLOBAL_MAX_STREAMS"):
+            if conf[name] < 1:
+                raise ImproperlyConfigured(f"AGENT_ADMISSION.{name} 至少为 1: {conf[name]}")
+        self.stats = AdmissionStats()
+
+        self._lock = threading.Lock()
+        self._waiting = 0
+        # 还没释放的租约，由续租线程定期续期 (弱引用：视图异常退出没释放的租约到期后自然失效)
+        self._leases = weakref.WeakSet()
+        self._keeper_pid = None
+
+    # --- 一次准入的各个步骤 ---
+    def _buckets(self, user_id: str) -> List[Bucket]:
+        return [
+            (f"user:{user_id}", self.user_bucket["CAPACITY"], self.user_bucket["PER_SECOND"]),
+            ("global", self.global_bucket["CAPACITY"], self.global_bucket["PER_SECOND"]),
+        ]
+
+    def _slots(self, user_id: str) -> List[Slot]:
+        return [(f"streams:user:{user_id}", self.user_max_streams), ("streams:global", self.global_max_streams)]
+
+    def _take(self, user_id: str):
+        wait, key = self.backend.take(self._buckets(user_id))
+        if wait > 0:
+            reason = "global_rate" if key == "global" else "user_rate"
+            self.stats.record_reject(reason)
+            raise AdmissionRejected(reason, wait)
+
+    def _enqueue(self):
+        with self._lock:
+            if self._waiting >= self.queue_size:
+                self.stats.record_reject("queue_full")
+                raise AdmissionRejected("queue_full", self.max_wait)
+            self._waiting += 1
+
+    def _dequeue(self):
+        with self._lock:
+            self._waiting -= 1
+
+    def _timeout(self, waited: float):
+        self.stats.record_reject("concurrency")
+        raise AdmissionRejected("concurrency", max(waited, POLL_INTERVAL))
+
+    def _admitted(self, lease: Lease, waited: float) -> Lease:
+        self.stats.record_admit(waited)
+        return self.track(lease)
+
+    def track(self, lease: Lease) -> Lease:
+        """登记一个已经拿到的租约，释放之前由续租线程定期续期"""
+        with self._lock:
+            self._leases.add(lease)
+        self._ensure_keeper()
+        return lease
+
+    def admit(self, user_id: str) -> Optional[Lease]:
+        """通过时返回占用的名额 (推流结束时 release)，不通过抛 AdmissionRejected；关闭准入时返回 None"""
+        if not self.enabled:
+            return None
+        slots = self._slots(user_id)
+        lease = Lease(self, [key for key, _ in slots], self.lease_ttl)
+        started = time.monotonic()
+        waited = 0.0
+        if not self.backend.acquire(slots, lease.lease_id, self.lease_ttl):
+            self._enqueue()
+            try:
+                while True:
+                    if waited >= self.max_wait:
+                        self._timeout(waited)
+                    time.sleep(POLL_INTERVAL)
+                    waited = time.monotonic() - started
+                    if self.backend.acquire(slots, lease.lease_id, self.lease_ttl):
+                        break
+            finally:
+                self._dequeue()
+        # 先占名额再扣令牌：因为并发满了被拒的请求不消耗令牌
+        try:
+            self._take(user_id)
+        except AdmissionRejected:
+            lease.release()
+            raise
+        return self._admitted(lease, waited)
+
+    async def aadmit(self, user_id: str) -> Optional[Lease]:
+        """异步版：排队时只挂起协程；SQLite / Redis 后端的调用放到线程池里"""
+        if not self.enabled:
+            return None
+
+        async def call(fn, *args):
+            if self.backend.blocking_io:
+                return await asyncio.to_thread(fn, *args)
+            return fn(*args)
+
+        slots = self._slots(user_id)
+        lease = Lease(self, [key for key, _ in slots], self.lease_ttl)
+        started = time.monotonic()
+        waited = 0.0
+        if not await call(self.backend.acquire, slots, lease.lease_id, self.lease_ttl):
+            self._enqueue()
+            try:
+                while True:
+                    if waited >= self.max_wait:
+                        self._timeout(waited)
+                    await asyncio.sleep(POLL_INTERVAL)
+                    waited = time.monotonic() - started
+                    if await call(self.backend.acquire, slots, lease.lease_id, self.lease_ttl):
+                        break
+            finally:
+                self._dequeue()
+        try:
+            await call(self._take, user_id)
+        except AdmissionRejected:
+            await lease.arelease()
+            raise
+        return self._admitted(lease, waited)
+
+    def _release(self, lease: Lease):
+        with self._lock:
+            self._leases.discard(lease)
+        try:
+            self.backend.release(lease.keys, lease.lease_id)
+        except Exception as e:
+            # 释放失败的租约到期后自动失效
+            logger.warning("⚠️ [admission] 释放名额失败: %s", e)
+
+    # --- 续租 ---
+    def _ensure_keeper(self):
+        if self._keeper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._keeper_pid == os.getpid():
+                return
+            self._keeper_pid = os.getpid()
+            threading.Thread(target=self._keep_alive, name="admission-lease-keeper", daemon=True).start()
+
+    def _live_leases(self) -> List[Lease]:
+        # 其他线程同时在登记 / 释放租约，迭代 WeakSet 必须持锁，否则会抛 "Set changed size during iteration"
+        with self._lock:
+            return list(self._leases)
+
+    def _keep_alive(self):
+        pid = os.getpid()
+        while self._keeper_pid == pid:
+            # 这个线程退出后不会再被拉起 (_keeper_pid 还是本进程)，任何异常都只能记日志接着跑
+            try:
+                time.sleep(min([self.lease_ttl] + [lease.ttl for lease in self._live_leases()]) / 3)
+                for lease in self._live_leases():
+                    if lease.released:
+                        continue
+                    try:
+                        self.backend.renew(lease.keys, lease.lease_id, lease.ttl)
+                    except Exception as e:
+                        logger.warning("⚠️ [admission] 续租失败: %s", e)
+            except Exception as e:
+                logger.exception("❌ [admission] 续租线程出错: %s", e)
+                time.sleep(POLL_INTERVAL)
+
+    def snapshot(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__,
+            "active_streams": self.backend.active("streams:global"),
+            "waiting": self._waiting,
+            **self.stats.snapshot(),
+        }
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def build_admission(conf: Optional[dict] = None) -> AdmissionController:
+    """按 settings.AGENT_ADMISSION 构造，BACKEND / OPTIONS 的写法和 AGENT_CHECKPOINTER 一样"""
+    if conf is None:
+        conf = get_setting("AGENT_ADMISSION", {})
+    conf = {**DEFAULT_ADMISSION, **conf}
+    backend = import_string(conf["BACKEND"])(**conf["OPTIONS"])
+    return AdmissionController(backend, conf)
+
+
+def get_admission() -> AdmissionController:
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = build_admission()
+    return _controller
@@ -0,0 +1,130 @@
+"""
+Agent 注册表：LLM、存储器、编译好的 Agent 都在第一次用到时才构建，每个进程一份
+
+以前 chat.views 一导入就把 chat.graph 整个执行一遍 (构造 ChatOpenAI、打开 SQLite 存储器、编译 Agent)，
+光导入 langchain / openai 就要 3 秒多，manage.py 的每个命令 (check / migrate / Admin 页面) 都要白白付这笔开销；
+gunicorn --preload 时 fork 出来的 worker 还会继承父进程已经打开的 SQLite 句柄。现在:
+  * views / ops_views 只依赖这个模块 (它本身不导入 langchain)，真正的构建推迟到第一次请求
+  * 工厂函数在每个进程里只执行一次，第一批并发请求不会重复构建
+  * fork 之后 pid 变了，子进程丢掉从父进程继承来的实例，用到时重新构建，不和父进程共用连接
+  * 想把构建时间挪到启动阶段 (第一个请求不等)，设置环境变量 AGENT_WARMUP=1 (见 myproject/wsgi.py / asgi.py)，
+    或者在 gunicorn 的 post_fork 钩子里调用 warm_up()
+
+启动耗时的压测见 benchmarks/bench_startup.py。
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AgentRegistry:
+    """按名字注册工厂函数，get() 时才构建，结果在当前进程内缓存"""
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], object]] = {}
+        self._instances: Dict[str, object] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def register(self, name: str, factory: Callable[[], object]) -> None:
+        with self._lock:
+            self._factories[name] = factory
+            self._instances.pop(name, None)
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # 父进程的锁可能在 fork 时正被别的线程持有，子进程里连锁一起换新的
+            self._lock = threading.Lock()
+            self._locks = {}
+            self._instances = {}
+            self._pid = os.getpid()
+
+    def get(self, name: str):
+        self._check_fork()
+        try:
+            return self._instances[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._factories:
+                raise KeyError(f"未注册的组件: {name}")
+            # 每个组件一把构建锁：构建 graph 时会再 get("llm")，不能共用同一把锁
+            build_lock = self._locks.setdefault(name, threading.Lock())
+        with build_lock:
+            if name not in self._instances:
+                started = time.perf_counter()
+                self._instances[name] = self._factories[name]()
+                logger.info("🧩 [registry] %s 构建完成，用时 %.2fs (pid %s)", name, time.perf_counter() - started, os.getpid())
+            return self._instances[name]
+
+    async def aget(self, name: str):
+        """异步版：第一次构建 (导入 + 编译) 放到线程池里，不阻塞事件循环"""
+        self._check_fork()
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        return await asyncio.to_thread(self.get, name)
+
+    def is_built(self, name: str) -> bool:
+        self._check_fork()
+        return name in self._instances
+
+    def reset(self, name: Optional[str] = None) -> None:
+        """丢掉已经构建的实例 (测试 / 修改配置后使用)，下次 get() 时重新构建"""
+        with self._lock:
+            if name is None:
+                self._instances.clear()
+            else:
+                self._instances.pop(name, None)
+
+    def warm_up(self, names: Iterable[str] = ("graph",)) -> None:
+        for name in names:
+            self.get(name)
+
+
+def _build_llm():
+    from chat.graph import build_llm
+
+    return build_llm()
+
+
+def _build_checkpointer():
+    from chat.checkpoint import build_checkpointer
+
+    return build_checkpointer()
+
+
+def _build_graph():
+    from chat.graph import build_agent
+    from chat.maintenance import start_periodic_gc
+
+    checkpointer = registry.get("checkpointer")
+    # 定时裁剪旧 checkpoint / 回收磁盘空间 (settings.AGENT_CHECKPOINT_GC，默认关闭，也可以用 manage.py gc_checkpoints)
+    start_periodic_gc(checkpointer)
+    return build_agent(registry.get("llm"), checkpointer)
+
+
+registry = AgentRegistry()
+registry.register("llm", _build_llm)
+registry.register("checkpointer", _build_checkpointer)
+registry.register("graph", _build_graph)
+
+
+def get_graph():
+    """进程内共享的 Agent (同步 stream / 异步 astream 共用同一个)"""
+    return registry.get("graph")
+
+
+async def aget_graph():
+    return await registry.aget("graph")
+
+
+def warm_up() -> None:
+    """提前构建 Agent，供启动脚本 / gunicorn post_fork 调用"""
+    registry.warm_up()
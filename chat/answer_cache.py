@@ -0,0 +1,482 @@
+"""
+语义答案缓存 (跨用户 / 跨会话复用重复问题的回答)
+
+很多人问的是几乎一样的问题 ("24a 主干构建状态"、"查询 24a 推送情况")，每次都要走一遍
+选工具 -> 调工具 -> LLM 组织回答。这里在 chat_endpoint 里、Agent 之前加一层答案缓存:
+  * 只缓存快速路由 (chat/router.py，AGENT_FAST_PATH.ENABLED 关掉时整个缓存不生效) 能确定性解析的问题：实体和版本 (请求 / 会话上下文里的有效版本) 都已经确定，
+    工具调用和参数一模一样，查到的数据就一样。把工具调用序列化后的哈希作为签名，签名不同的问题绝不会互相命中
+  * 同一个签名下还要看问法是否相近 ("构建状态" 和 "构建为什么失败" 调的是同一个工具，回答的侧重点不同)：
+    把问题里的实体抹掉，按字符 n-gram 哈希成一个定长向量，余弦相似度不低于 MIN_SIMILARITY 才算命中
+  * 向量索引存在本地 SQLite 文件里，用 sqlite-vec 的 vec0 虚表按签名分区做 KNN；
+    Python 的 sqlite3 不支持加载扩展时退化为按签名取出候选在 Python 里算相似度 (同一个签名下的候选很少)
+  * 新鲜度：按这次涉及的工具在 settings.PUO_TOOL_CACHE 里最短的 TTL 过期；回答用的是工具缓存里的旧结果时，
+    按这些结果里最早的过期时间算 (答案不能比它依据的数据活得更久)，过期的答案不会再回放
+  * 命中时把答案按 SSE 协议回放给前端 (工具帧 + 分段的回答帧)，同时把这一轮问答写进 checkpoint 和聊天记录投影，
+    后续对话和历史接口看到的和真的跑了一轮一样
+
+配置见 settings.AGENT_ANSWER_CACHE，命中率和命中答案的新鲜程度见 /api/ops/answer-cache。
+"""
+import array
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from typing import Iterator, List, NamedTuple, Optional
+
+from chat.checkpoint import SqliteConnectionPool
+from chat.config import BASE_DIR, get_setting
+from chat.tools.http_client import is_failure
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ANSWER_CACHE = {
+    "ENABLED": True,
+    "PATH": os.path.join(os.path.dirname(BASE_DIR), "answer_cache.db"),
+    "POOL_SIZE": 4,
+    # 向量维度和字符 n-gram 的最大长度
+    "DIM": 256,
+    "MAX_NGRAM": 3,
+    # 同一个签名下，问法的余弦相似度不低于这个值才算同一个问题
+    "MIN_SIMILARITY": 0.8,
+    "MAX_ENTRIES": 5000,
+    # 回放时每个 SSE 回答帧的字数
+    "REPLAY_CHUNK_CHARS": 16,
+}
+
+# 实体被抹掉后留下的占位符
+ENTITY_MASK = "\x00"
+# 标点、空白和客套话 / 通用的查询动词不参与相似度计算 ("帮我查一下 24a 的主干构建状态" 和 "24a 主干构建状态" 是同一个问题)
+PUNCT_RE = re.compile(r"[\s,.;:!?，。；：！？、\"'“”‘’()（）\[\]【】]+")
+FILLER_RE = re.compile(r"请问|请|帮我|帮忙|麻烦|查询|查看|查一下|查下|看一下|看下|一下|告诉我|我想知道|的|吗|呢|呀")
+
+
+class CacheKey(NamedTuple):
+    signature: str
+    embedding: List[float]
+    tools: List[str]
+    ttl: float
+
+
+class CachedAnswer(NamedTuple):
+    answer: str
+    tools: List[str]
+    age: float
+    ttl: float
+    similarity: float
+
+
+class AnswerCacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # 不可缓存 (快速路由解析不出来) / 查找 / 命中 / 未命中 / 最近的答案已过期 / 写入
+            self.uncacheable = 0
+            self.lookups = 0
+            self.hits = 0
+            self.misses = 0
+            self.stale = 0
+            self.stores = 0
+            # 命中答案的年龄 (秒) 和它占 TTL 的比例
+            self.hit_age_total = 0.0
+            self.hit_age_max = 0.0
+            self.hit_age_ratio_total = 0.0
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def hit(self, age: float, ttl: float):
+        with self._lock:
+            self.hits += 1
+            self.hit_age_total += age
+            self.hit_age_max = max(self.hit_age_max, age)
+            self.hit_age_ratio_total += age / ttl if ttl else 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "uncacheable": self.uncacheable,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "stores": self.stores,
+                "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else None,
+                "avg_hit_age_s": round(self.hit_age_total / self.hits, 2) if self.hits else None,
+                "max_hit_age_s": round(self.hit_age_max, 2) if self.hits else None,
+                # 命中的答案平均用掉了 TTL 的多少 (0 表示刚写入，接近 1 表示快过期了)
+                "avg_hit_ttl_used": round(self.hit_age_ratio_total / self.hits, 4) if self.hits else None,
+            }
+
+
+def _fast_path():
+    # 复用快速路由的实体抽取和意图判断，这里才导入是为了不在加载本模块时就构建 Agent
+    from chat.graph import route_fast_path
+
+    return route_fast_path
+
+
+def _signature(tool_calls: List[dict]) -> str:
+    canonical = json.dumps(
+        sorted([call["name"], call["args"]] for call in tool_calls),
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def normalize_question(query: str, tool_calls: List[dict]) -> str:
+    """抹掉问题里已经进了签名的实体 (版本、组件名、节点号...)，只留下问法"""
+    text = query.strip().lower()
+    values = {str(v).lower() for call in tool_calls for v in call["args"].values() if v}
+    for value in sorted(values, key=len, reverse=True):
+        text = text.replace(value, ENTITY_MASK)
+    return FILLER_RE.sub("", PUNCT_RE.sub("", text))
+
+
+def embed(text: str, dim: int, max_ngram: int) -> List[float]:
+    """字符 n-gram 特征哈希 (带符号)，L2 归一化后点积就是余弦相似度"""
+    vector = [0.0] * dim
+    for n in range(1, max_ngram + 1):
+        for i in range(len(text) - n + 1):
+            h = zlib.crc32(text[i:i + n].encode("utf-8"))
+            vector[h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector] if norm else vector
+
+
+def _pack(vector: List[float]) -> bytes:
+    # 和 sqlite_vec.serialize_float32 的格式一致 (小端 float32)
+    return array.array("f", vector).tobytes()
+
+
+def _unpack(data: bytes) -> List[float]:
+    return array.array("f", data).tolist()
+
+
+class _VecConnectionPool(SqliteConnectionPool):
+    """每个新连接都尝试加载 sqlite-vec 扩展"""
+
+    vec_enabled = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = super()._connect()
+        if self.vec_enabled is not False:
+            try:
+                import sqlite_vec
+
+                conn.enable_load_extension(True)
+                sqlite_vec.load(conn)
+                conn.enable_load_extension(False)
+                self.vec_enabled = True
+            except (ImportError, AttributeError, sqlite3.Error) as e:
+                # 没装 sqlite-vec，或者 Python 的 sqlite3 编译时关掉了扩展加载
+                logger.warning("⚠️ [answer-cache] sqlite-vec 不可用 (%s)，改为在 Python 里计算相似度", e)
+                self.vec_enabled = False
+        return conn
+
+
+class AnswerCache:
+    def __init__(self, conf: Optional[dict] = None):
+        conf = {**DEFAULT_ANSWER_CACHE, **(conf or {})}
+        self.enabled = conf["ENABLED"]
+        self.dim = conf["DIM"]
+        self.max_ngram = conf["MAX_NGRAM"]
+        self.min_similarity = conf["MIN_SIMILARITY"]
+        self.max_entries = conf["MAX_ENTRIES"]
+        self.replay_chunk_chars = conf["REPLAY_CHUNK_CHARS"]
+        self.pool = _VecConnectionPool(conf["PATH"], size=conf["POOL_SIZE"])
+        self.stats = AnswerCacheStats()
+        self.is_setup = False
+        self._setup_lock = threading.Lock()
+
+    @property
+    def vec_enabled(self) -> bool:
+        return bool(self.pool.vec_enabled)
+
+    def setup(self) -> None:
+        if self.is_setup:
+            return
+        with self._setup_lock:
+            if self.is_setup:
+                return
+            with self.pool.connection() as conn:
+                conn.executescript(
+                    """
+                    CREATE TABLE IF NOT EXISTS answers (
+                        id INTEGER PRIMARY KEY,
+                        signature TEXT NOT NULL,
+                        question TEXT NOT NULL,
+                        answer TEXT NOT NULL,
+                        tools TEXT NOT NULL,
+                        embedding BLOB NOT NULL,
+                        created_at REAL NOT NULL,
+                        expires_at REAL NOT NULL,
+                        hits INTEGER NOT NULL DEFAULT 0
+                    );
+                    CREATE INDEX IF NOT EXISTS answers_signature ON answers (signature);
+                    CREATE INDEX IF NOT EXISTS answers_expires_at ON answers (expires_at);
+                    """
+                )
+                if self.pool.vec_enabled:
+                    conn.execute(
+                        f"CREATE VIRTUAL TABLE IF NOT EXISTS answer_vectors USING vec0("
+                        f"signature TEXT PARTITION KEY, embedding float[{self.dim}] distance_metric=cosine)"
+                    )
+                conn.commit()
+            self.is_setup = True
+
+    # ------------------------------------------------------------------
+    # 查找
+    # ------------------------------------------------------------------
+    def key_for(self, query: Optional[str], version: Optional[str]) -> Optional[CacheKey]:
+        """快速路由能确定性解析的问题返回缓存 key，否则返回 None (交给 Agent，不缓存)"""
+        if not self.enabled or not query:
+            return None
+        from chat.tools.cache import tool_result_cache
+
+        fast_path = _fast_path()
+        # 快速路由关掉时 Agent 自己选工具，问题和工具调用之间没有确定的对应关系，不能缓存
+        route = fast_path.router.route(query, default_ver=version) if fast_path.enabled else None
+        if route is None:
+            self.stats.incr("uncacheable")
+            return None
+        tools = [call["name"] for call in route.tool_calls]
+        return CacheKey(
+            signature=_signature(route.tool_calls),
+            embedding=embed(normalize_question(query, route.tool_calls), self.dim, self.max_ngram),
+            tools=tools,
+            # 答案的新鲜度取决于最快变化的那个工具
+            ttl=min(tool_result_cache.ttl_for(name) for name in tools),
+        )
+
+    def _nearest(self, conn, key: CacheKey):
+        """同一个签名下问法最接近的一条: (id, 相似度)"""
+        if self.pool.vec_enabled:
+            row = conn.execute(
+                "SELECT rowid, distance FROM answer_vectors WHERE embedding MATCH ? AND k = 1 AND signature = ?",
+                (_pack(key.embedding), key.signature),
+            ).fetchone()
+            return (row[0], 1.0 - row[1]) if row else None
+        best = None
+        for answer_id, data in conn.execute(
+            "SELECT id, embedding FROM answers WHERE signature = ?", (key.signature,)
+        ):
+            similarity = sum(a * b for a, b in zip(key.embedding, _unpack(data)))
+            if best is None or similarity > best[1]:
+                best = (answer_id, similarity)
+        return best
+
+    def lookup(self, key: CacheKey) -> Optional[CachedAnswer]:
+        self.setup()
+        self.stats.incr("lookups")
+        now = time.time()
+        with self.pool.connection() as conn:
+            nearest = self._nearest(conn, key)
+            if nearest is None or nearest[1] < self.min_similarity:
+                self.stats.incr("misses")
+                return None
+            answer_id, similarity = nearest
+            answer, tools, created_at, expires_at = conn.execute(
+                "SELECT answer, tools, created_at, expires_at FROM answers WHERE id = ?", (answer_id,)
+            ).fetchone()
+            if expires_at <= now:
+                self.stats.incr("stale")
+                self._delete(conn, [answer_id])
+                conn.commit()
+                return None
+            conn.execute("UPDATE answers SET hits = hits + 1 WHERE id = ?", (answer_id,))
+            conn.commit()
+        age = now - created_at
+        self.stats.hit(age, key.ttl)
+        return CachedAnswer(answer, json.loads(tools), age, key.ttl, similarity)
+
+    # ------------------------------------------------------------------
+    # 写入 / 清理
+    # ------------------------------------------------------------------
+    def store(
+        self, key: CacheKey, question: str, answer: str, tools: List[str], expires_at: Optional[float] = None
+    ) -> None:
+        """expires_at: 回答依据的工具结果最早什么时候过期 (见 AnswerRecorder)，答案不会比它晚过期"""
+        if not answer:
+            return
+        now = time.time()
+        expires_at = now + key.ttl if expires_at is None else min(expires_at, now + key.ttl)
+        if expires_at <= now:
+            return
+        self.setup()
+        with self.pool.connection() as conn:
+            # 同一个签名下问法几乎一样的旧答案直接替换
+            nearest = self._nearest(conn, key)
+            if nearest is not None and nearest[1] >= self.min_similarity:
+                self._delete(conn, [nearest[0]])
+            cur = conn.execute(
+                "INSERT INTO answers (signature, question, answer, tools, embedding, created_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key.signature, question, answer, json.dumps(tools, ensure_ascii=False),
+                 _pack(key.embedding), now, expires_at),
+            )
+            if self.pool.vec_enabled:
+                conn.execute(
+                    "INSERT INTO answer_vectors (rowid, signature, embedding) VALUES (?, ?, ?)",
+                    (cur.lastrowid, key.signature, _pack(key.embedding)),
+                )
+            self._prune(conn, now)
+            conn.commit()
+        self.stats.incr("stores")
+
+    def _delete(self, conn, ids: List[int]) -> None:
+        if not ids:
+            return
+        placeholders = ",".join("?" * len(ids))
+        conn.execute(f"DELETE FROM answers WHERE id IN ({placeholders})", ids)
+        if self.pool.vec_enabled:
+            conn.execute(f"DELETE FROM answer_vectors WHERE rowid IN ({placeholders})", ids)
+
+    def _prune(self, conn, now: float) -> None:
+        """删掉过期的答案；超过 MAX_ENTRIES 时再从最旧的开始删"""
+        expired = [row[0] for row in conn.execute("SELECT id FROM answers WHERE expires_at <= ?", (now,))]
+        self._delete(conn, expired)
+        overflow = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            oldest = [row[0] for row in conn.execute("SELECT id FROM answers ORDER BY created_at LIMIT ?", (overflow,))]
+            self._delete(conn, oldest)
+
+    def clear(self) -> None:
+        self.setup()
+        with self.pool.connection() as conn:
+            conn.execute("DELETE FROM answers")
+            if self.pool.vec_enabled:
+                conn.execute("DELETE FROM answer_vectors")
+            conn.commit()
+
+    # ------------------------------------------------------------------
+    # 回放
+    # ------------------------------------------------------------------
+    def replay_payloads(self, cached: CachedAnswer) -> Iterator[dict]:
+        """按 SSE 协议回放：先是工具帧，再把回答切成小段逐帧输出"""
+        for name in cached.tools:
+            yield {"type": "tool", "content": name}
+        step = self.replay_chunk_chars
+        for i in range(0, len(cached.answer), step):
+            yield {"type": "answer", "content": cached.answer[i:i + step]}
+
+    @staticmethod
+    def _turn(query: str, cached: CachedAnswer):
+        from langchain_core.messages import AIMessage, HumanMessage
+
+        return [
+            HumanMessage(content=query, id=str(uuid.uuid4())),
+            AIMessage(content=cached.answer, id=str(uuid.uuid4()), response_metadata={"answer_cache": True}),
+        ]
+
+    def record_turn(self, graph, session_id: str, query: str, cached: CachedAnswer) -> None:
+        """命中缓存时把这一轮问答写进 checkpoint 和聊天记录投影"""
+        from chat.models import ChatMessage
+        from chat.transcript import AFTER_AGENT_NODE, backfill_from_checkpoint, record_messages
+
+        turn = self._turn(query, cached)
+        config = {"configurable": {"thread_id": session_id}}
+        graph.update_state(config, {"messages": turn}, as_node=AFTER_AGENT_NODE)
+        if ChatMessage.objects.filter(session_id=session_id).exists():
+            record_messages(session_id, turn)
+        else:
+            backfill_from_checkpoint(graph, session_id)
+
+    async def arecord_turn(self, graph, session_id: str, query: str, cached: CachedAnswer) -> None:
+        from asgiref.sync import sync_to_async
+
+        from chat.models import ChatMessage
+        from chat.transcript import AFTER_AGENT_NODE, arecord_messages, backfill_from_checkpoint
+
+        turn = self._turn(query, cached)
+        config = {"configurable": {"thread_id": session_id}}
+        await graph.aupdate_state(config, {"messages": turn}, as_node=AFTER_AGENT_NODE)
+        if await ChatMessage.objects.filter(session_id=session_id).aexists():
+            await arecord_messages(session_id, turn)
+        else:
+            await sync_to_async(backfill_from_checkpoint)(graph, session_id)
+
+    def snapshot(self) -> dict:
+        entries = None
+        if self.is_setup:
+            with self.pool.connection() as conn:
+                entries = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        return {
+            "pid": os.getpid(),
+            "enabled": self.enabled,
+            "index": "sqlite-vec" if self.vec_enabled else "python",
+            "entries": entries,
+            "min_similarity": self.min_similarity,
+            **self.stats.snapshot(),
+        }
+
+
+class AnswerRecorder:
+    """边流式输出边收集这一轮的回答，正常跑完且工具都没有报错时写进缓存"""
+
+    def __init__(self, cache: AnswerCache, key: CacheKey, question: str):
+        self.cache = cache
+        self.key = key
+        self.question = question
+        self.parts = []
+        self.tools = []
+        self.failed = False
+        # 这一轮用到的工具结果的过期时间 (chat/tools/cache.py 的 track_result_expiry)
+        self.tool_expiries = []
+
+    @contextmanager
+    def tracking(self):
+        """包住整个流式运行，收集工具结果的过期时间"""
+        from chat.tools.cache import track_result_expiry
+
+        with track_result_expiry() as expiries:
+            self.tool_expiries = expiries
+            yield self
+
+    def feed(self, chunk) -> None:
+        if chunk.type == "AIMessageChunk" and isinstance(chunk.content, str):
+            self.parts.append(chunk.content)
+        elif chunk.type == "tool":
+            self.tools.append(chunk.name)
+            # 工具抛异常是 error 状态；查询失败时 http_client 返回的是一段错误说明，状态照样是 success
+            if getattr(chunk, "status", None) == "error" or is_failure(chunk.content):
+                self.failed = True
+
+    def finish(self) -> None:
+        answer = "".join(self.parts)
+        if self.failed or not answer:
+            return
+        try:
+            self.cache.store(
+                self.key, self.question, answer, self.tools or self.key.tools,
+                expires_at=min(self.tool_expiries, default=None),
+            )
+        except Exception as e:
+            # 缓存写失败不影响本轮回答
+            logger.warning("⚠️ [answer-cache] 写入失败: %s", e)
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    """进程内共享的答案缓存，按 settings.AGENT_ANSWER_CACHE 创建"""
+    global _answer_cache
+    if _answer_cache is None:
+        with _answer_cache_lock:
+            if _answer_cache is None:
+                _answer_cache = AnswerCache(get_setting("AGENT_ANSWER_CACHE", {}))
+    return _answer_cache
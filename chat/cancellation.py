@@ -0,0 +1,259 @@
+"""
+前端断开后取消本轮 Agent 运行
+
+以前浏览器标签页关掉之后，graph.stream 还会一直跑到 LLM 把回答写完、所有工具调用返回为止：
+token、后端查询和 worker 都白白浪费。现在每一轮运行带一个 CancelToken:
+  * 推流这边 (views.sse_stream / asse_stream) 发现连接断开 (WSGI 下写帧失败后服务器关闭生成器，
+    ASGI 下 Django 收到 http.disconnect 后取消推流的 task) 就调用 token.cancel()
+  * CancellationHandler 挂在本轮的 callbacks 上：LLM 正在吐字时下一个 token 就抛 RunCancelled，
+    流式请求随之关闭；还没开始的模型调用 / 工具调用在开始时抛出，相当于在下一个节点边界停下
+  * 同步链路里等工具结果的地方 (chat/tool_execution.py) 立刻返回，还在途的 HTTP 请求直接关掉 socket
+    (chat/tools/http_client.py)，重试的退避等待也会被打断；异步链路靠取消 task，aiohttp 请求随之中止
+  * 运行停下之后用 settle_cancelled_run 把 checkpoint 收尾：只有 tool_calls 没有结果的 AI 消息补上
+    “已取消” 的 ToolMessage，并以 “Agent 已经跑完” 的身份写入，下一轮对话可以正常继续
+
+被取消的运行数和估算省下的 token 数见运维接口 /api/ops/cancellations。
+"""
+import contextvars
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+# 补给没有结果的 tool_calls 的内容，下一轮模型能看出上一轮是被打断的
+CANCELLED_TOOL_MESSAGE = "用户已断开连接，本次工具调用被取消，没有结果。"
+
+
+class RunCancelled(Exception):
+    """本轮运行已被取消 (前端断开)"""
+
+
+class CancellationStats:
+    """
+    被取消的运行数和估算省下的 token (每个 worker 进程各自统计)
+    省下的 token 是估算值：按本进程模型调用的平均 prompt / completion token 数，
+    - 模型正在吐字时取消：平均 completion 数减去已经吐出的数
+    - 等工具 / 节点之间取消：后面那次模型调用整个省掉 (平均 prompt + completion)
+    - 模型已经给出最终回答后才取消：不算
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def observe_model_call(self, prompt_tokens: int, completion_tokens: int):
+        with self._lock:
+            self.model_calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def record_cancel(self, token: "CancelToken"):
+        with self._lock:
+            avg_prompt = self.prompt_tokens / self.model_calls if self.model_calls else 0
+            avg_completion = self.completion_tokens / self.model_calls if self.model_calls else 0
+            if token.phase == "model":
+                saved = max(avg_completion - token.streamed_tokens, 0)
+            elif token.phase == "answered":
+                saved = 0
+            else:
+                saved = avg_prompt + avg_completion
+            self.cancelled_runs += 1
+            self.by_phase[token.phase or "start"] += 1
+            self.by_reason[token.reason] += 1
+            self.tokens_saved += saved
+
+    def record_http_abort(self):
+        with self._lock:
+            self.http_aborted += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "cancelled_runs": self.cancelled_runs,
+                "by_phase": dict(self.by_phase),
+                "by_reason": dict(self.by_reason),
+                "tokens_saved_estimate": round(self.tokens_saved),
+                "http_requests_aborted": self.http_aborted,
+                "model_calls_observed": self.model_calls,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.cancelled_runs = 0
+            self.by_phase = defaultdict(int)
+            self.by_reason = defaultdict(int)
+            self.tokens_saved = 0.0
+            self.http_aborted = 0
+            self.model_calls = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+
+
+cancellation_stats = CancellationStats()
+
+
+class CancelToken:
+    """一轮运行的取消标记，线程安全；cancel() 可以重复调用，只有第一次生效"""
+
+    def __init__(self, session_id: Optional[str] = None):
+        self.session_id = session_id
+        self.reason: Optional[str] = None
+        # 取消时运行走到哪一步 (model / answered / tools)，以及当前这次模型调用已经吐出的 token 数，用来估算省下的 token
+        self.phase: Optional[str] = None
+        self.streamed_tokens = 0
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._next_id = 0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "client_disconnected") -> bool:
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = list(self._callbacks.values()), {}
+        cancellation_stats.record_cancel(self)
+        logger.info("🛑 [cancel] 会话 %s 的运行已取消 (%s, 阶段 %s)", self.session_id, reason, self.phase or "start")
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning("⚠️ [cancel] 取消回调执行失败: %s", e)
+        return True
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """登记取消时要执行的动作 (关闭 socket、唤醒等待者)，返回注销函数；已经取消的话立即执行"""
+        with self._lock:
+            if not self._event.is_set():
+                key = self._next_id
+                self._next_id += 1
+                self._callbacks[key] = callback
+                return lambda: self._callbacks.pop(key, None)
+        callback()
+        return lambda: None
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """最多等 timeout 秒，被取消时立即返回 True (用来代替 time.sleep)"""
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise RunCancelled(self.reason)
+
+
+_current_token: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar("cancel_token", default=None)
+
+
+def current_cancel_token() -> Optional[CancelToken]:
+    """当前运行的取消标记 (工具线程池会带上调用方的 contextvars，所以工具里也能拿到)"""
+    return _current_token.get()
+
+
+@contextmanager
+def bind_cancel_token(token: CancelToken):
+    reset = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(reset)
+
+
+class CancellationHandler(BaseCallbackHandler):
+    """
+    挂在本轮运行 config["callbacks"] 上：被取消后在下一个 token / 下一次模型或工具调用开始时抛出 RunCancelled
+    raise_error 让异常穿过 langchain 的回调管理器，run_inline 让异步链路里也在当前 task 里同步执行
+    """
+
+    raise_error = True
+    run_inline = True
+
+    def __init__(self, token: CancelToken):
+        self.token = token
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.token.raise_if_cancelled()
+        self.token.phase = "model"
+        self.token.streamed_tokens = 0
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.token.streamed_tokens += 1
+        self.token.raise_if_cancelled()
+
+    def on_llm_end(self, response, **kwargs):
+        from chat.usage import extract_usage
+
+        message = None
+        generations = response.generations[0] if response.generations else []
+        if generations:
+            message = getattr(generations[0], "message", None)
+        if message is None:
+            return
+        usage = extract_usage(message)
+        if usage["prompt_tokens"] or usage["completion_tokens"]:
+            cancellation_stats.observe_model_call(usage["prompt_tokens"], usage["completion_tokens"])
+        self.token.phase = "tools" if getattr(message, "tool_calls", None) else "answered"
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self.token.raise_if_cancelled()
+        self.token.phase = "tools"
+
+
+def _cancelled_tool_messages(messages):
+    """最后一条带 tool_calls 的 AI 消息里还没有结果的调用，补上 “已取消” 的 ToolMessage"""
+    from langchain_core.messages import ToolMessage
+
+    answered = {m.tool_call_id for m in messages if m.type == "tool"}
+    for message in reversed(messages):
+        if message.type == "ai" and message.tool_calls:
+            return [
+                ToolMessage(content=CANCELLED_TOOL_MESSAGE, name=call["name"], tool_call_id=call["id"], status="error")
+                for call in message.tool_calls
+                if call["id"] not in answered
+            ]
+        if message.type == "human":
+            return []
+    return []
+
+
+def settle_cancelled_run(graph, config) -> None:
+    """
+    取消之后的 checkpoint 收尾 (同步版)
+    LangGraph 只在节点执行完时写 checkpoint，停在一半的节点不会留下半条回答；
+    但模型发出 tool_calls 之后、工具结果写回之前停下的话，下一轮请求会因为 tool_calls 没有对应的结果被模型接口拒绝，
+    这里补上结果，并把待执行的节点清掉
+    """
+    from chat.transcript import AFTER_AGENT_NODE
+
+    try:
+        state = graph.get_state(config)
+        if not state or not state.values:
+            return
+        patch = _cancelled_tool_messages(state.values.get("messages", []))
+        if patch or state.next:
+            graph.update_state(config, {"messages": patch}, as_node=AFTER_AGENT_NODE)
+    except Exception as e:
+        logger.exception("❌ [cancel] 取消后收尾 checkpoint 失败: %s", e)
+
+
+async def asettle_cancelled_run(graph, config) -> None:
+    from chat.transcript import AFTER_AGENT_NODE
+
+    try:
+        state = await graph.aget_state(config)
+        if not state or not state.values:
+            return
+        patch = _cancelled_tool_messages(state.values.get("messages", []))
+        if patch or state.next:
+            await graph.aupdate_state(config, {"messages": patch}, as_node=AFTER_AGENT_NODE)
+    except Exception as e:
+        logger.exception("❌ [cancel] 取消后收尾 checkpoint 失败: %s", e)
@@ -0,0 +1,521 @@
+"""
+LangGraph 对话状态存储 (Checkpointer) 后端
+
+原来 graph.py 里是一个进程级的 sqlite3 连接 + SqliteSaver，所有请求线程抢同一把锁，
+读写完全串行，而且多 worker 同时写一个文件时很容易 "database is locked"。
+
+这里提供:
+  * SqliteConnectionPool: 有上限的连接池，每个连接都开 WAL，并设置 synchronous / mmap 等参数
+  * PooledSqliteSaver:   SqliteSaver 的连接池版本
+        - 读操作各自借连接并发执行 (WAL 下读不阻塞写)
+        - 写操作进程内串行，走一条独立的写连接 (SQLite 本身就只允许一个写者)，并按批合并提交：
+          每一步产生的 checkpoint / writes 先进缓冲区，攒够 batch_size 条或超过 flush_interval
+          就在一个事务里一次性写入；读某个会话前如果它还有没落盘的数据会先刷盘，保证“读到自己刚写的”；
+          刷盘失败时整批留在缓冲区里重试，错误抛给正在读这个会话的调用方
+        - 同时实现了 async 接口 (放到线程池执行)，同一个实例可以给 graph.stream / graph.astream 共用
+        - compression 打开时用 chat/serde.py 的 CompressedSerializer：zstd 压缩 + 大工具结果去重存 blobs 表；
+          关掉之后新数据按原格式写，之前压缩过的数据照样能读
+  * build_checkpointer(): 按 settings.AGENT_CHECKPOINTER 构造存储器
+"""
+import asyncio
+import atexit
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Sequence
+
+from django.utils.module_loading import import_string
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+from chat.config import BASE_DIR, get_setting
+from chat.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# 每个连接建立时执行的 PRAGMA
+# WAL: 读写互不阻塞；synchronous=NORMAL: WAL 模式下只在 checkpoint 时 fsync，崩溃不损坏库，最多丢最后几个事务
+# mmap_size: 读走内存映射，减少 read() 系统调用
+# auto_vacuum=INCREMENTAL: 只对新建的库生效 (必须在建表前设置)，删除的空间可以用 incremental_vacuum 回收，见 chat/maintenance.py
+DEFAULT_PRAGMAS = {
+    "auto_vacuum": "INCREMENTAL",
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+    "cache_size": -16000,  # 负数表示 KB，约 16MB
+}
+
+# 后台刷盘失败 (例如磁盘满、库被锁住太久) 后隔多少秒重试，缓冲区里的数据保留到写成功为止
+FLUSH_RETRY_DELAY = 1.0
+
+DEFAULT_CHECKPOINTER = {
+    "BACKEND": "chat.checkpoint.PooledSqliteSaver",
+    "OPTIONS": {
+        "path": os.path.join(os.path.dirname(BASE_DIR), "agent_chat_history.db"),
+    },
+}
+
+
+class SqliteConnectionPool:
+    """
+    有上限的 SQLite 连接池
+    最多同时借出 size 个连接，借不到时阻塞等待 timeout 秒；fork 之后自动丢弃父进程的连接
+    """
+
+    def __init__(self, path: str, size: int = 8, timeout: float = 30.0, pragmas: Optional[Dict[str, Any]] = None):
+        self.path = str(path)
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=self.timeout)
+        for key, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {key}={value}")
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        if self._pid != os.getpid():
+            # fork 出来的子进程不能复用父进程的 sqlite 句柄，直接换一个新池子
+            self._reset()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"等待 SQLite 连接超时 ({self.timeout}s)，连接池大小 {self.size}")
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class PooledSqliteSaver(SqliteSaver):
+    """
+    连接池 + 批量写入版 SqliteSaver
+    表结构与 SqliteSaver 完全一致，可以直接读写已有的 agent_chat_history.db
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        pool_size: int = 8,
+        timeout: float = 30.0,
+        pragmas: Optional[Dict[str, Any]] = None,
+        batch_size: int = 32,
+        flush_interval: float = 0.05,
+        serde=None,
+        compression: Optional[Dict[str, Any]] = None,
+    ):
+        # 不走 SqliteSaver.__init__ (它要求传入单个连接)，只初始化基类的序列化器
+        BaseCheckpointSaver.__init__(self, serde=serde)
+        # compression 为 None 时按原来的序列化格式写入；读取总是两种格式都认，开关压缩都不用迁移已有数据
+        from chat.serde import CompressedSerializer
+
+        self.compression = compression
+        self.serde = CompressedSerializer(self, compression, inner=self.serde, compress_writes=compression is not None)
+        self._dicts = None
+        self._active_dict = None
+        self._dicts_lock = threading.Lock()
+        self.jsonplus_serde = JsonPlusSerializer()
+        self.pool = SqliteConnectionPool(path, size=pool_size, timeout=timeout, pragmas=pragmas)
+        self.is_setup = False
+        # 写锁：进程内同一时间只有一个写事务，避免多个线程在 SQLite 文件锁上空转
+        self.lock = threading.Lock()
+        self._writer_conn = None
+        self._writer_pid = None
+        self._local = threading.local()
+
+        # 批量写缓冲区: [(thread_id, sql, rows), ...]
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._pending_rows = 0
+        # 缓冲区里 (或正在刷盘的批次里) 有未落盘数据的会话，读这些会话前必须先刷盘
+        self._dirty = set()
+        self._pending_lock = threading.Lock()
+        # 正在刷盘时，其他线程的 flush() 要等它写完，才能保证读到最新数据
+        self._flush_lock = threading.Lock()
+        self._flush_wakeup = threading.Event()
+        self._flusher_pid = None
+        atexit.register(self.flush)
+
+    # ------------------------------------------------------------------
+    # 连接管理：SqliteSaver 内部通过 self.conn / self.cursor() 访问数据库，
+    # 这里把它们改成“当前线程从池子里借到的那个连接”
+    # ------------------------------------------------------------------
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            raise RuntimeError("PooledSqliteSaver.conn 只能在 cursor() 上下文内使用")
+        return conn
+
+    def setup(self) -> None:
+        if self.is_setup:
+            return
+        with self.pool.connection() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    thread_id TEXT NOT NULL,
+                    checkpoint_ns TEXT NOT NULL DEFAULT '',
+                    checkpoint_id TEXT NOT NULL,
+                    parent_checkpoint_id TEXT,
+                    type TEXT,
+                    checkpoint BLOB,
+                    metadata BLOB,
+                    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+                );
+                CREATE TABLE IF NOT EXISTS writes (
+                    thread_id TEXT NOT NULL,
+                    checkpoint_ns TEXT NOT NULL DEFAULT '',
+                    checkpoint_id TEXT NOT NULL,
+                    task_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    channel TEXT NOT NULL,
+                    type TEXT,
+                    value BLOB,
+                    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+                );
+                CREATE TABLE IF NOT EXISTS blobs (
+                    key TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS serde_dicts (
+                    dict_id INTEGER PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                """
+            )
+        self.is_setup = True
+
+    def _writer(self) -> sqlite3.Connection:
+        # SQLite 同一时间只有一个写者，写事务固定走这条独立连接，不和读请求抢连接池的名额
+        if self._writer_pid != os.getpid():
+            self._writer_conn = self.pool._connect()
+            self._writer_pid = os.getpid()
+        return self._writer_conn
+
+    @contextmanager
+    def cursor(self, transaction: bool = True) -> Iterator[sqlite3.Cursor]:
+        self.setup()
+        if transaction:
+            with self.lock:
+                conn = self._writer()
+                with self._bind(conn) as cur:
+                    try:
+                        yield cur
+                        conn.commit()
+                    except BaseException:
+                        conn.rollback()
+                        raise
+        else:
+            with self.pool.connection() as conn, self._bind(conn) as cur:
+                yield cur
+
+    @contextmanager
+    def _bind(self, conn: sqlite3.Connection) -> Iterator[sqlite3.Cursor]:
+        previous = getattr(self._local, "conn", None)
+        self._local.conn = conn
+        cur = conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+            self._local.conn = previous
+
+    # ------------------------------------------------------------------
+    # 批量写入
+    # ------------------------------------------------------------------
+    def _enqueue(self, thread_id: str, sql: str, rows: list):
+        if self.batch_size <= 1:
+            with self.cursor() as cur:
+                cur.executemany(sql, rows)
+            return
+        with self._pending_lock:
+            self._pending.append((thread_id, sql, rows))
+            self._pending_rows += len(rows)
+            self._dirty.add(thread_id)
+            full = self._pending_rows >= self.batch_size
+        if full:
+            self.flush()
+        else:
+            self._ensure_flusher()
+            self._flush_wakeup.set()
+
+    def flush(self) -> None:
+        """把缓冲区里的 checkpoint / writes 在一个事务里写入数据库"""
+        with self._flush_lock:
+            with self._pending_lock:
+                if not self._pending:
+                    return
+                batch, self._pending, self._pending_rows = self._pending, [], 0
+            try:
+                with span("checkpoint.flush", statements=len(batch)), self.cursor() as cur:
+                    for _, sql, rows in batch:
+                        cur.executemany(sql, rows)
+            except BaseException:
+                # 事务已经回滚：整批放回缓冲区最前面 (保持写入顺序)，这些会话依旧是“脏”的，下次刷盘重试；
+                # 异常照样抛给调用方，读这些会话的请求不会读到缺了几步的 checkpoint
+                with self._pending_lock:
+                    self._pending[:0] = batch
+                    self._pending_rows += sum(len(rows) for _, _, rows in batch)
+                raise
+            with self._pending_lock:
+                # 刷盘期间新进来的写入还留在缓冲区里，这些会话依旧是“脏”的
+                self._dirty = {thread_id for thread_id, _, _ in self._pending}
+
+    def _flush_thread(self, config: Optional[RunnableConfig]) -> None:
+        """读某个会话之前调用：只有这个会话还有没落盘的写入时才需要等刷盘"""
+        if config is None:
+            self.flush()
+        elif str(config["configurable"].get("thread_id")) in self._dirty:
+            self.flush()
+
+    def _ensure_flusher(self):
+        if self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name="checkpoint-flusher", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            self._flush_wakeup.wait()
+            self._flush_wakeup.clear()
+            # 攒一小段时间再提交，让同一轮对话里连续几步的写入合并成一个事务
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("❌ [Checkpoint] 批量写入失败，稍后重试: %s", e)
+                time.sleep(FLUSH_RETRY_DELAY)
+                self._flush_wakeup.set()
+
+    # ------------------------------------------------------------------
+    # 压缩序列化 (chat/serde.py) 用到的 blob 和 zstd 字典
+    # ------------------------------------------------------------------
+    def put_blob(self, key: str, data: bytes) -> None:
+        # 内容哈希做主键，重复写入只刷新 created_at (GC 按它判断是不是刚被引用过)；
+        # 和引用它的 checkpoint 进同一个缓冲区，按顺序先落盘
+        self._enqueue(
+            "",
+            "INSERT INTO blobs (key, data, size, created_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET created_at = excluded.created_at",
+            [(key, data, len(data), time.time())],
+        )
+
+    def get_blob(self, key: str) -> bytes:
+        if "" in self._dirty:
+            self.flush()
+        self.setup()
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT data FROM blobs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(f"checkpoint 引用的工具结果 {key} 不存在")
+        return row[0]
+
+    def _load_dicts(self):
+        if self._dicts is not None:
+            return
+        import zstandard
+
+        with self._dicts_lock:
+            if self._dicts is not None:
+                return
+            self.setup()
+            with self.pool.connection() as conn:
+                rows = conn.execute("SELECT dict_id, data FROM serde_dicts ORDER BY created_at").fetchall()
+            dicts = {dict_id: zstandard.ZstdCompressionDict(data) for dict_id, data in rows}
+            # 最新训练的那个字典用来压缩，旧字典只用于解压旧数据
+            self._active_dict = dicts[rows[-1][0]] if rows else None
+            self._dicts = dicts
+
+    def get_dict(self, dict_id: int):
+        self._load_dicts()
+        if dict_id not in self._dicts:
+            # 可能是别的进程刚训练出来的字典，重新加载一次
+            self.reload_dicts()
+        return self._dicts.get(dict_id)
+
+    def active_dict(self):
+        self._load_dicts()
+        return self._active_dict
+
+    def add_dict(self, zdict) -> int:
+        """保存新训练的字典并立即用于压缩，返回字典 ID"""
+        dict_id = zdict.dict_id()
+        with self.cursor() as cur:
+            cur.execute(
+                "INSERT OR REPLACE INTO serde_dicts (dict_id, data, created_at) VALUES (?, ?, ?)",
+                (dict_id, zdict.as_bytes(), time.time()),
+            )
+        self.reload_dicts()
+        return dict_id
+
+    def reload_dicts(self) -> None:
+        with self._dicts_lock:
+            self._dicts = None
+        self._load_dicts()
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
+        serialized_metadata = json.dumps(
+            get_checkpoint_metadata(config, metadata), ensure_ascii=False
+        ).encode("utf-8", "ignore")
+        self.setup()
+        self._enqueue(
+            str(thread_id),
+            "INSERT OR REPLACE INTO checkpoints (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(
+                str(thread_id),
+                checkpoint_ns,
+                checkpoint["id"],
+                config["configurable"].get("checkpoint_id"),
+                type_,
+                serialized_checkpoint,
+                serialized_metadata,
+            )],
+        )
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        query = (
+            "INSERT OR REPLACE INTO writes (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type, value) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+            if all(w[0] in WRITES_IDX_MAP for w in writes)
+            else "INSERT OR IGNORE INTO writes (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type, value) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+        )
+        self.setup()
+        self._enqueue(
+            str(config["configurable"]["thread_id"]),
+            query,
+            [
+                (
+                    str(config["configurable"]["thread_id"]),
+                    str(config["configurable"]["checkpoint_ns"]),
+                    str(config["configurable"]["checkpoint_id"]),
+                    task_id,
+                    WRITES_IDX_MAP.get(channel, idx),
+                    channel,
+                    *self.serde.dumps_typed(value),
+                )
+                for idx, (channel, value) in enumerate(writes)
+            ],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        self._flush_thread(config)
+        return super().get_tuple(config)
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        self._flush_thread(config)
+        return super().list(config, filter=filter, before=before, limit=limit)
+
+    def delete_thread(self, thread_id: str) -> None:
+        self.flush()
+        super().delete_thread(thread_id)
+
+    # ------------------------------------------------------------------
+    # async 接口：放到默认线程池里跑同步实现，供 graph.astream 使用
+    # ------------------------------------------------------------------
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        items = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for item in items:
+            yield item
+
+    async def aput(self, config, checkpoint, metadata, new_versions) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path: str = "") -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+
+def build_checkpointer(conf: Optional[Dict[str, Any]] = None):
+    """
+    按配置构造存储器，配置格式仿照 Django 的 CACHES:
+        AGENT_CHECKPOINTER = {
+            "BACKEND": "chat.checkpoint.PooledSqliteSaver",
+            "OPTIONS": {"path": ..., "pool_size": 8},
+        }
+    BACKEND 也可以是 "langgraph.checkpoint.memory.InMemorySaver" 等任意不需要连接参数的存储器
+    """
+    if conf is None:
+        conf = get_setting("AGENT_CHECKPOINTER", DEFAULT_CHECKPOINTER)
+    backend = import_string(conf["BACKEND"])
+    return backend(**conf.get("OPTIONS", {}))
+
+
+def get_checkpointer():
+    """进程内共享的存储器：graph、会话级联删除 (chat/signals.py)、清理命令用的是同一个实例 (由 chat/agents.py 的注册表管理)"""
+    from chat.agents import registry
+
+    return registry.get("checkpointer")
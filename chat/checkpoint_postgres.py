@@ -0,0 +1,83 @@
+"""
+Postgres 存储器 (多 worker / 多机部署，settings.AGENT_DEPLOYMENT = "multi" 且配置了 AGENT_POSTGRES_DSN 时使用)
+
+SQLite 只适合单机：多个 worker 进程写同一个文件靠文件锁排队，跨机器更是没法共享。
+多 worker 部署时把对话状态放到 Postgres，所有 worker 读写同一份 checkpoint:
+  * 连接池 (psycopg_pool)，每个 worker 进程各自一个池子 (由 chat/agents.py 的注册表在 fork 之后才构建)
+  * 建表 / 迁移用 advisory lock 串行，几个 worker 同时启动不会抢着执行 setup()
+  * LangGraph 的 PostgresSaver 只有同步接口，这里和 PooledSqliteSaver 一样补上 async 接口 (放到线程池执行)，
+    同一个实例可以给 graph.stream / graph.astream 共用
+
+这是可选依赖，只有选了这个后端才会导入:
+    pip install langgraph-checkpoint-postgres "psycopg[binary,pool]"
+"""
+import asyncio
+import logging
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    from langgraph.checkpoint.postgres import PostgresSaver
+    from psycopg.rows import dict_row
+    from psycopg_pool import ConnectionPool
+except ImportError as e:
+    raise ImproperlyConfigured(
+        "Postgres 存储器需要安装 langgraph-checkpoint-postgres 和 psycopg[binary,pool]"
+    ) from e
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock 的 key，所有 worker 约定同一个值
+SETUP_LOCK_ID = 0x70756F01
+
+
+class PooledPostgresSaver(PostgresSaver):
+    """连接池版 PostgresSaver，表结构和 langgraph 自带的一致"""
+
+    def __init__(self, dsn: str, *, pool_size: int = 8, timeout: float = 30.0, serde=None):
+        pool = ConnectionPool(
+            dsn,
+            min_size=1,
+            max_size=pool_size,
+            timeout=timeout,
+            # PostgresSaver 要求的连接参数
+            kwargs={"autocommit": True, "prepare_threshold": 0, "row_factory": dict_row},
+            open=True,
+        )
+        super().__init__(pool, serde=serde)
+        self.pool = pool
+        self.setup()
+
+    def setup(self) -> None:
+        with self.pool.connection() as conn:
+            conn.execute("SELECT pg_advisory_lock(%s)", (SETUP_LOCK_ID,))
+            try:
+                super().setup()
+            finally:
+                conn.execute("SELECT pg_advisory_unlock(%s)", (SETUP_LOCK_ID,))
+        logger.info("🐘 [Checkpoint] Postgres 存储器就绪 (pool_size=%s)", self.pool.max_size)
+
+    def close(self) -> None:
+        self.pool.close()
+
+    # ------------------------------------------------------------------
+    # async 接口：放到默认线程池里跑同步实现，供 graph.astream 使用
+    # ------------------------------------------------------------------
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        items = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for item in items:
+            yield item
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path: str = "") -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
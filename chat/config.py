@@ -5,4 +5,16 @@ import os
 # 把数据库路径定义在这里
 # 使用绝对路径是个好习惯，防止在不同目录下运行脚本时找不到文件
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-METADATA_DB_PATH = os.path.join(BASE_DIR, "session_metadata.db")
\ No newline at end of file
+METADATA_DB_PATH = os.path.join(BASE_DIR, "session_metadata.db")
+
+
+def get_setting(name, default=None):
+    """
+    读取 Django settings 里的配置项
+    脱离 Django 单独运行脚本 (例如 python chat/graph.py) 时 settings 未配置，直接返回默认值
+    """
+    from django.conf import settings
+
+    if not settings.configured:
+        return default
+    return getattr(settings, name, default)
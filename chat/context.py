@@ -0,0 +1,70 @@
+"""
+Agent 每次运行的上下文 (LangGraph runtime context)
+
+以前 views 里 set_current_version("29a") 把版本写进一个 contextvar，中间件再 get_current_version() 读出来。
+可模型调用 / 工具节点不一定和 view 在同一个线程或任务里 (同步链路的后台线程、astream 里的 to_thread)，
+那里的 contextvar 从来没设置过，读到的是默认值“无 (需询问用户)”，LLM 只好先反问用户版本，白白多一轮调用。
+
+现在版本放在 AgentContext 里随 graph.stream(..., context=...) 传入，中间件从 runtime.context 读取，
+跟着这一次运行走，和线程无关。版本按会话缓存在 ChatSession.version：
+请求里带了 version 就用它并更新缓存，没带就沿用这个会话上次的版本，都没有才用 settings.AGENT_DEFAULT_VERSION。
+"""
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+from chat.config import get_setting
+
+# 提示里“当前上下文版本”的兜底内容，LLM 看到它会先追问用户
+UNKNOWN_VERSION = "无 (需询问用户)"
+
+# 和 System Prompt 里 ver 的格式规范一致: 2 位数字 + 1 个小写字母
+VERSION_RE = re.compile(r"\d{2}[a-z]")
+
+
+@dataclass(frozen=True)
+class AgentContext:
+    # 用户当前所在的版本 (如 29a)，None 表示不知道
+    user_context_version: Optional[str] = None
+
+
+def context_version(runtime, default: Optional[str] = UNKNOWN_VERSION) -> Optional[str]:
+    """从中间件拿到的 runtime 里取本次运行的版本 (直接调用 graph、没传 context 时返回 default)"""
+    context = getattr(runtime, "context", None)
+    return getattr(context, "user_context_version", None) or default
+
+
+def normalize_version(value) -> Optional[str]:
+    """前端传来的版本号：空值返回 None，格式不对抛 ValueError"""
+    if value in (None, ""):
+        return None
+    version = str(value).strip().lower()
+    if not VERSION_RE.fullmatch(version):
+        raise ValueError(f"无效的版本号: {value} (格式应为 2 位数字 + 1 个小写字母，如 24a)")
+    return version
+
+
+def _resolve(session, requested: Optional[str]):
+    """返回 (本次使用的版本, 是否需要写回会话)"""
+    if requested:
+        return requested, session is not None and session.version != requested
+    if session is not None and session.version:
+        return session.version, False
+    return get_setting("AGENT_DEFAULT_VERSION") or None, False
+
+
+def resolve_version(session, requested: Optional[str]) -> AgentContext:
+    """按 请求参数 -> 会话缓存 -> 默认值 的顺序确定版本，请求里换了版本时更新会话缓存"""
+    version, changed = _resolve(session, requested)
+    if changed:
+        session.version = version
+        session.save(update_fields=["version"])
+    return AgentContext(user_context_version=version)
+
+
+async def aresolve_version(session, requested: Optional[str]) -> AgentContext:
+    version, changed = _resolve(session, requested)
+    if changed:
+        session.version = version
+        await session.asave(update_fields=["version"])
+    return AgentContext(user_context_version=version)
@@ -1,29 +1,26 @@
 import datetime
+import logging
 import os
-import re
-import sqlite3
-from typing import Optional, Literal, Dict, Any, List
-
-from langchain.agents import create_agent, AgentState
-from langchain.agents.middleware import before_model, dynamic_prompt, ModelRequest
-from langchain_core.runnables import RunnableConfig, RunnableLambda
-from langgraph.checkpoint.memory import MemorySaver
-from langgraph.checkpoint.sqlite import SqliteSaver
-from langgraph.config import get_stream_writer
-from langgraph.runtime import Runtime
-from pydantic import BaseModel, Field
+from functools import lru_cache
+from typing import List
 
+from langchain.agents import create_agent
+from langchain.agents.middleware import AgentMiddleware, ModelRequest
 from langchain_openai import ChatOpenAI
-from langchain_core.tools import tool
-from langchain_core.messages import SystemMessage, trim_messages, BaseMessage
-from langgraph.graph import StateGraph, MessagesState, START, END
-from langgraph.prebuilt import ToolNode, tools_condition, create_react_agent
-from dotenv import load_dotenv
-
-from chat.global_context import get_current_version
+from langchain_core.messages import SystemMessage, BaseMessage
+
+from chat.config import get_setting
+from chat.context import AgentContext, context_version
+from chat.history import build_history_window
+from chat.router import build_fast_path_router
+from chat.tool_execution import build_tool_execution
+from chat.tracing import trace_agent
+from chat.transcript import record_transcript
+from chat.usage import track_prompt_cache_usage
 from chat.tools.PuoToolManager import PuoToolManager
 
-load_dotenv()  # 自动寻找并加载项目根目录下的 .env 文件
+logger = logging.getLogger(__name__)
+
 # ==========================================
 # 1. 定义实体枚举 (来自你的知识库)
 # ==========================================
@@ -32,12 +29,27 @@ load_dotenv()  # 自动寻找并加载项目根目录下的 .env 文件
 
 
 
-llm = ChatOpenAI(
-    model="deepseek-chat",  # 或 gpt-4o
-    api_key=os.getenv("DEEPSEEK_API_KEY"),
-    base_url="https://api.deepseek.com",
-    temperature=0  # 任务型 Agent 温度设为 0 以保证精准
-)
+# 主对话模型，配置见 settings.AGENT_LLM (压测时 BASE_URL 指向 benchmarks/mock_llm.py)
+DEFAULT_AGENT_LLM = {
+    "MODEL": "deepseek-chat",  # 或 gpt-4o
+    "BASE_URL": "https://api.deepseek.com",
+    "API_KEY_ENV": "DEEPSEEK_API_KEY",
+    "TEMPERATURE": 0,  # 任务型 Agent 温度设为 0 以保证精准
+}
+
+
+def build_llm() -> ChatOpenAI:
+    """主对话模型，由 chat/agents.py 的注册表在第一次用到时构建"""
+    conf = {**DEFAULT_AGENT_LLM, **get_setting("AGENT_LLM", {})}
+    return ChatOpenAI(
+        model=conf["MODEL"],
+        api_key=os.getenv(conf["API_KEY_ENV"]),
+        base_url=conf["BASE_URL"],
+        temperature=conf["TEMPERATURE"],
+        stream_usage=True,  # 流式输出时也返回 token 用量 (含前缀缓存命中数)，见 chat/usage.py
+    )
+
+
 tools_list = PuoToolManager.get_tools_list()
 # ==========================================
 # 3. 配置 LLM 与 System Prompt
@@ -58,73 +70,13 @@ PRODUCTS_LIST = [
 
 
 # =================================================================
-# 中间件 2: 调试日志打印 (只负责 Print)
+# System Prompt 模板
 # =================================================================
-@before_model
-def debug_print_prompt(state: AgentState, runtime: Runtime) -> None:
-    """
-    【调试中间件】负责将最终发给 LLM 的消息打印到控制台
-    由于它排在 inject_environment_context 后面，所以它能看到更新后的 Prompt
-    """
-    messages: List[BaseMessage] = state["messages"]
-
-    print("\n" + "🐛" * 20 + " [LLM Request Debug] " + "🐛" * 20)
-    print(f"⏰ 触发时间: {datetime.datetime.now().strftime('%H:%M:%S')}")
-    print(f"📦 消息总数: {len(messages)}")
-    print("-" * 60)
-
-    for i, msg in enumerate(messages):
-        role = msg.type.upper()
-        content = msg.content
-
-        # 为了防止控制台刷屏，System Prompt 如果太长可以截断显示，或者完全显示
-        preview = content
-        if role == "SYSTEM" and len(content) > 100:
-            # 这里只为了演示，实际调试你可能想看全
-            # preview = content[:100] + "...(剩余略)..."
-            pass
-
-        print(f"[{i}] 【{role}】:")
-        print(f"{preview}")
-        print("-" * 30)
-
-    print("🐛" * 45 + "\n")
-
-    # 返回 None 表示不修改任何 state，只做副作用（打印）
-    return None
-
-@before_model
-def inject_environment_context(state: AgentState, runtime: Runtime) -> Dict[str, Any]:
-    """
-    每次调用模型前执行：
-    1. 获取最新时间
-    2. 获取 Config 参数
-    3. 暴力替换/插入 SystemMessage
-    """
-    """
-    动态生成 System Prompt
-    该函数会在每次 LLM 调用前执行，用于注入时间及上下文版本
-    """
-    # --- A. 获取【绝对实时】的时间 ---
-    # 因为这个函数每次对话都会运行，所以 now() 肯定是当前的
-    now = datetime.datetime.now()
-    current_time_str = now.strftime("%Y-%m-%d %H:%M:%S")
-
-    # --- B. 获取 Django 传进来的 Context ---
-    # 截图里 `@dynamic_prompt` 用的是 request.runtime.context
-    # 这里直接有 runtime 对象，所以直接用 runtime.context
-    # 加个防御性判断
-
-    user_ver = get_current_version()
-
-    # 打印日志（方便你后台看有没有刷新）
-    print(f"⚡ [@before_model] 触发更新! 时间: {current_time_str}, 版本: {user_ver}")
-
-    # --- C. 组装 Prompt ---
-    components_str = ", ".join(COMPONENTS_LIST)
-    products_str = ", ".join(PRODUCTS_LIST)
-    # 3. 返回格式化后的完整 System Prompt 字符串
-    SYSTEM_PROMPT = """你是一个专业的 IT 运维研发数据查询助手。
+# DeepSeek / OpenAI 都有“前缀缓存”：请求开头和上一次完全相同的部分只计费、只计算一次。
+# 所以 Prompt 按“越稳定越靠前”排列：
+#   [System: 数据字典 + 路由规则 (字节级固定)] [工具 schema] [历史消息 ...] [本轮问题] [环境感知: 时间 + 版本]
+# 每次都会变的时间和版本放在请求最末尾，前面的系统提示和整段历史都能命中缓存。
+PROMPT_HEAD_TEMPLATE = """你是一个专业的 IT 运维研发数据查询助手。
         你的核心任务是精准识别用户意图，并调用工具查询构建、版本、组件及产品配套信息。
         
         ### 全局数据字典 (Data Dictionary)
@@ -132,14 +84,9 @@ def inject_environment_context(state: AgentState, runtime: Runtime) -> Dict[str,
         * **支持的组件**: [{components_str}]
         * **支持的产品**: [{products_str}]
 
-        ### 0. 环境感知 (Environment Context)
-        * **当前系统时间**: {current_time}
-        * **当前上下文版本**: {context_version}
-          > **注意**: 如果用户在问题中没有明确指定版本号 (ver)，**请默认使用上述“当前上下文版本”**。只有当用户明确指定了新版本时，才覆盖此默认值。
-
+"""
 
-
-        ### 核心规则（Entity & Logic）
+PROMPT_RULES = """        ### 核心规则（Entity & Logic）
         ### 1. 参数定义与格式规范 (Strict Format Rules)
         在提取参数调用工具前，必须严格进行格式校验。如果用户输入不符合规范，请礼貌反问，不要强行调用。
 
@@ -193,50 +140,168 @@ def inject_environment_context(state: AgentState, runtime: Runtime) -> Dict[str,
 
         """
 
-    filled_prompt = SYSTEM_PROMPT.format(
-        current_time=current_time_str,
-        context_version=user_ver,
-        components_str=components_str,
-        products_str=products_str
+ENVIRONMENT_SECTION_TEMPLATE = """### 环境感知 (Environment Context)
+* **当前系统时间**: {current_time}
+* **当前上下文版本**: {context_version}
+  > **注意**: 如果用户在问题中没有明确指定版本号 (ver)，**请默认使用上述“当前上下文版本”**。只有当用户明确指定了新版本时，才覆盖此默认值。
+"""
+
+
+# 预编译好的固定系统提示 (枚举列表只 join 一次)，每次请求复用同一个 SystemMessage 对象
+SYSTEM_PROMPT = PROMPT_HEAD_TEMPLATE.format(
+    components_str=", ".join(COMPONENTS_LIST),
+    products_str=", ".join(PRODUCTS_LIST),
+) + PROMPT_RULES
+SYSTEM_MESSAGE = SystemMessage(content=SYSTEM_PROMPT)
+
+
+@lru_cache(maxsize=256)
+def render_environment_context(current_time: str, context_version: str) -> str:
+    """渲染末尾的环境感知小节，同一秒内同一版本的多次模型调用 (例如工具调用后的总结) 直接命中缓存"""
+    return ENVIRONMENT_SECTION_TEMPLATE.format(
+        current_time=current_time,
+        context_version=context_version,
     )
 
-    # --- D. 修改 Messages (核心逻辑) ---
-    # Node-style 中间件要求返回一个 dict，用来更新 state
-    # 我们取出旧的 messages，替换第一条
-    messages = state["messages"]
-    new_sys_msg = SystemMessage(content=filled_prompt)
 
-    if messages and isinstance(messages[0], SystemMessage):
-        # 如果第一条本来就是 SystemMessage，直接替换内容
-        messages[0] = new_sys_msg
-    else:
-        # 否则插入到最前面
-        messages.insert(0, new_sys_msg)
+# =================================================================
+# 中间件 1: 注入环境上下文 (System Prompt)
+# =================================================================
+class EnvironmentContextMiddleware(AgentMiddleware):
+    """
+    每次调用模型前执行：
+    1. 获取最新时间
+    2. 获取当前上下文版本
+    3. 在【构建模型请求】时放入 System Prompt (固定部分在最前，环境信息在最后)
 
-    # 返回更新后的 state
-    return {"messages": messages}
+    System Prompt 只存在于这一次请求里，不会写回 state，
+    所以 checkpointer 不会因为它把整段历史再存一遍，数据库里也不会多出一条 SystemMessage。
+    """
+
+    def _prepare(self, request: ModelRequest) -> ModelRequest:
+        # --- A. 获取【绝对实时】的时间 ---
+        current_time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        # --- B. 获取 Django 传进来的 Context (graph.stream 的 context 参数，见 chat/context.py) ---
+        user_ver = context_version(request.runtime)
+
+        # 打印日志（方便你后台看有没有刷新）
+        logger.debug("⚡ [inject_environment_context] 触发更新! 时间: %s, 版本: %s", current_time_str, user_ver)
+
+        # --- C. 组装请求 ---
+        # 老版本会把 SystemMessage 直接写进 state，历史会话里可能还残留着，这里顺手过滤掉
+        messages = [m for m in request.messages if not isinstance(m, SystemMessage)]
+        # 固定的系统提示放最前面，易变的环境信息追加到最后，保证前缀缓存命中
+        environment = SystemMessage(content=render_environment_context(current_time_str, user_ver))
+        return request.override(
+            system_message=SYSTEM_MESSAGE,
+            messages=messages + [environment],
+        )
+
+    def wrap_model_call(self, request: ModelRequest, handler):
+        return handler(self._prepare(request))
+
+    async def awrap_model_call(self, request: ModelRequest, handler):
+        return await handler(self._prepare(request))
+
+
+inject_environment_context = EnvironmentContextMiddleware()
+
+
+# =================================================================
+# 中间件 2: 调试日志打印 (只在 DEBUG 级别输出)
+# =================================================================
+class DebugPrintPromptMiddleware(AgentMiddleware):
+    """
+    【调试中间件】负责将最终发给 LLM 的消息打印到日志
+    由于它排在 inject_environment_context 里层，所以它能看到注入后的 System Prompt
+    完整 prompt 很大，只有 chat.graph 的日志级别是 DEBUG 时才拼接，平时直接跳过
+    """
+
+    def _print(self, request: ModelRequest) -> None:
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        messages: List[BaseMessage] = request.messages
+        if request.system_message is not None:
+            messages = [request.system_message] + messages
 
-db_path = "agent_chat_history.db" # 这会在你项目根目录生成一个文件
-conn = sqlite3.connect(db_path, check_same_thread=False)
+        lines = [
+            "\n" + "🐛" * 20 + " [LLM Request Debug] " + "🐛" * 20,
+            f"⏰ 触发时间: {datetime.datetime.now().strftime('%H:%M:%S')}",
+            f"📦 消息总数: {len(messages)}",
+            "-" * 60,
+        ]
 
+        for i, msg in enumerate(messages):
+            role = msg.type.upper()
+            content = msg.content
 
-# 3. 初始化持久化存储器
-memory = SqliteSaver(conn)
-agent = create_agent(
-    model=llm,
-    tools=tools_list,
-    # 启用记忆持久化 (可选)
-    # 把我们的修剪逻辑传给 state_modifier
-    # 这样，虽然数据库里存了 100 条，但 LLM 每次只看到最近 10 条 + System Prompt
+            # 为了防止控制台刷屏，System Prompt 如果太长可以截断显示，或者完全显示
+            preview = content
+            if role == "SYSTEM" and len(content) > 100:
+                # 这里只为了演示，实际调试你可能想看全
+                # preview = content[:100] + "...(剩余略)..."
+                pass
 
-    checkpointer=memory,
+            lines += [f"[{i}] 【{role}】:", f"{preview}", "-" * 30]
 
-    # LangChain 1.0 新特性：中间件 (Middleware)
-    # 这里我们可以留空，或者添加用于日志、鉴权、限流的中间件
-    middleware=[inject_environment_context, debug_print_prompt],
-)
+        lines.append("🐛" * 45 + "\n")
+        logger.debug("\n".join(lines))
 
-graph = agent
+    def wrap_model_call(self, request: ModelRequest, handler):
+        self._print(request)
+        return handler(request)
+
+    async def awrap_model_call(self, request: ModelRequest, handler):
+        self._print(request)
+        return await handler(request)
+
+
+debug_print_prompt = DebugPrintPromptMiddleware()
+
+# =================================================================
+# 中间件 3: 历史窗口 (按 token 预算裁剪发给 LLM 的历史)
+# =================================================================
+# 预算、是否生成滚动摘要等由 settings.AGENT_HISTORY_WINDOW 决定，见 chat/history.py
+trim_history = build_history_window()
+
+# =================================================================
+# 中间件 4: 工具调用的后端限流 + 单次超时
+# =================================================================
+# 一条 AI 消息里的多个 tool_calls 本身就是并行执行的，这里限制同一后端的在途数，
+# 超时的调用变成一条报错的 ToolMessage (见 chat/tool_execution.py)
+limit_tool_calls = build_tool_execution()
+
+# =================================================================
+# 中间件 5: 确定性快速路由
+# =================================================================
+# 意图明确的查询 (组件配套、构建状态、SPC 商用状态...) 不用 LLM 选工具，直接调用工具 (见 chat/router.py)
+route_fast_path = build_fast_path_router(COMPONENTS_LIST, PRODUCTS_LIST)
+
+
+def build_agent(model, checkpointer):
+    """按给定的模型和存储器编译 Agent (同步 / 异步两条链路共用同一套工具和中间件)"""
+    return create_agent(
+        model=model,
+        tools=tools_list,
+        # 启用记忆持久化 (可选)
+        # 数据库里存完整历史，但 LLM 每次只看到 token 预算内的最近几轮 + System Prompt (见 trim_history)
+        checkpointer=checkpointer,
+        # 每次运行的上下文 (版本号)，调用时通过 graph.stream(..., context=AgentContext(...)) 传入
+        context_schema=AgentContext,
+
+        # LangChain 1.0 新特性：中间件 (Middleware)
+        # 这里我们可以留空，或者添加用于日志、鉴权、限流的中间件
+        middleware=[
+            record_transcript, route_fast_path,
+            trace_agent, track_prompt_cache_usage, inject_environment_context, trim_history, debug_print_prompt, limit_tool_calls,
+        ],
+    )
+
+
+# 3. 持久化存储器和编译好的 Agent 不在这里创建：
+# 由 chat/agents.py 的注册表在第一次请求时构建 (每个进程一份，fork 安全)，
+# 存储器的类型 (连接池版 SQLite / 内存 ...) 由 settings.AGENT_CHECKPOINTER 决定
 #
 # # 绑定工具
 # llm_with_tools = llm.bind_tools(tools_list)
@@ -290,6 +355,9 @@ graph = agent
 # 6. 本地集成测试 (Context & Memory)
 # ==========================================
 if __name__ == "__main__":
+    from chat.agents import get_graph
+
+    agent = get_graph()
     # 定义一个固定的 Session ID，模拟同一个用户的连续对话
     # 如果你换成 "user_999"，对于 Agent 来说就是一个新用户，记忆会重置
     config = {"configurable": {"thread_id": "context_test_demo_v1"}}
@@ -0,0 +1,307 @@
+"""
+历史消息窗口 (按 token 预算裁剪)
+
+会话越聊越长时，不再把整段历史 (尤其是很长的工具返回) 每次都发给 LLM：
+- 构建模型请求时按 token 预算只保留最近的若干轮，裁剪只发生在请求里，state / checkpoint 中的完整历史不动
+- 以“轮”为单位裁剪 (一轮 = 一条用户消息 + 之后的 AI / 工具消息)，AI 的 tool_calls 和对应的 ToolMessage 不会被拆开
+- 窗口起点按会话记住，只有超过 MAX_TOKENS 时才一次性往前挪到 TARGET_TOKENS 以内，
+  避免每轮都挪一点导致请求前缀变化、前缀缓存失效
+- 可选：被挤出窗口的旧对话压缩成一段滚动摘要 (按会话缓存，只有窗口起点移动时才增量更新)
+"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from langchain.agents.middleware import AgentMiddleware, ModelRequest
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage, get_buffer_string
+from langgraph.constants import TAG_NOSTREAM
+
+from chat.config import get_setting
+from chat.usage import current_thread_id
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_WINDOW = {
+    # 历史消息 (不含 System Prompt) 超过这个 token 数才开始裁剪
+    "MAX_TOKENS": 6000,
+    # 一旦裁剪，就把窗口收缩到这个 token 数以内
+    "TARGET_TOKENS": 4000,
+    # tiktoken 编码名；设为 None 或加载失败时按字符数估算
+    "TOKENIZER": "cl100k_base",
+    # 是否把被裁掉的旧对话压缩成滚动摘要 (会额外调用一次 LLM，只在窗口起点移动时发生)
+    "SUMMARY": False,
+    # 生成摘要时，单条消息最多带多少字符进去 (长工具返回截断)
+    "SUMMARY_INPUT_CHARS": 500,
+    # 最多缓存多少个会话的窗口状态
+    "CACHE_SIZE": 1024,
+}
+
+SUMMARY_PROMPT = """你是对话摘要助手。请把下面这段较早的对话压缩成一段简短的中文摘要，供后续对话参考。
+要求：
+1. 保留用户关心的版本号 (ver)、分支 / 节点号 / HERT版本、组件和产品名称，以及工具查到的关键结论；
+2. 如果给出了【已有摘要】，请把新内容合并进去，输出一段完整的新摘要；
+3. 不要编造，不要输出与摘要无关的内容，控制在 300 字以内。"""
+
+SUMMARY_MESSAGE_TEMPLATE = "### 更早对话摘要 (Earlier Conversation)\n{summary}"
+
+# 每条消息的格式开销 (role 标记等)，粗略按 4 个 token 计
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+# =================================================================
+# Token 计数
+# =================================================================
+class TokenCounter:
+    """
+    本地 token 计数器
+    优先用 tiktoken (和 DeepSeek 的分词不完全一致，但做预算足够)，不可用时按字符数估算。
+    有 id 的消息 (state 里的消息都有) 计数结果会缓存，长会话每次只需要算新增的那几条。
+    """
+
+    def __init__(self, encoding_name: Optional[str] = "cl100k_base", cache_size: int = 20000):
+        self.encoding_name = encoding_name
+        self.cache_size = cache_size
+        self._encoding = None
+        self._encoding_loaded = False
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_encoding(self):
+        if not self._encoding_loaded:
+            with self._lock:
+                if not self._encoding_loaded:
+                    if self.encoding_name:
+                        try:
+                            import tiktoken
+
+                            self._encoding = tiktoken.get_encoding(self.encoding_name)
+                        except Exception as e:
+                            # 离线环境拉不到编码文件时，不影响主流程
+                            logger.warning("⚠️ [history] tiktoken 不可用 (%s)，改用字符数估算 token", e.__class__.__name__)
+                    self._encoding_loaded = True
+        return self._encoding
+
+    def count_text(self, text: str) -> int:
+        if not text:
+            return 0
+        encoding = self._get_encoding()
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        # 估算：中文等非 ASCII 字符约 1 token / 字，ASCII 约 4 字符 / token
+        ascii_chars = len(text.encode("ascii", "ignore"))
+        return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+    def count_message(self, message: BaseMessage) -> int:
+        text = message_text(message)
+        key = (message.id, message.type, len(text)) if message.id else None
+        if key is not None:
+            with self._lock:
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache.move_to_end(key)
+                    return cached
+
+        tokens = self.count_text(text) + MESSAGE_OVERHEAD_TOKENS
+
+        if key is not None:
+            with self._lock:
+                self._cache[key] = tokens
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return tokens
+
+    def count_messages(self, messages: List[BaseMessage]) -> int:
+        return sum(self.count_message(m) for m in messages)
+
+
+def message_text(message: BaseMessage) -> str:
+    """消息里实际会发给模型的文本：content + AI 消息的工具调用参数"""
+    content = message.content
+    if isinstance(content, list):
+        content = "".join(
+            block if isinstance(block, str) else str(block.get("text", "")) for block in content
+        )
+    if isinstance(message, AIMessage) and message.tool_calls:
+        content += "".join(f"{call['name']}{call['args']}" for call in message.tool_calls)
+    return content
+
+
+def split_turns(messages: List[BaseMessage]) -> List[List[BaseMessage]]:
+    """按用户消息切分成轮，保证工具调用和工具结果落在同一轮里"""
+    turns = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+    return turns
+
+
+# =================================================================
+# 中间件: 历史窗口
+# =================================================================
+class _WindowState:
+    __slots__ = ("start", "summary", "summarized")
+
+    def __init__(self):
+        # 窗口起点：前 start 条历史消息已经被裁掉 (state 里的消息只追加不删除，下标是稳定的)
+        self.start = 0
+        # 滚动摘要，覆盖前 summarized 条消息
+        self.summary = ""
+        self.summarized = 0
+
+
+class HistoryWindowMiddleware(AgentMiddleware):
+    """
+    按 token 预算裁剪发给 LLM 的历史消息
+    排在 inject_environment_context 里层：此时 request.messages 末尾是环境感知的 SystemMessage，原样保留
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 6000,
+        target_tokens: Optional[int] = None,
+        tokenizer: Optional[str] = "cl100k_base",
+        summary: bool = False,
+        summary_model=None,
+        summary_input_chars: int = 500,
+        cache_size: int = 1024,
+    ):
+        super().__init__()
+        self.max_tokens = max_tokens
+        self.target_tokens = min(target_tokens or max_tokens, max_tokens)
+        self.counter = TokenCounter(tokenizer)
+        self.summary = summary
+        # 不指定时用当前请求的模型生成摘要
+        self.summary_model = summary_model
+        self.summary_input_chars = summary_input_chars
+        self.cache_size = cache_size
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    # --- 窗口状态 (按会话缓存) ---
+    def _get_state(self, thread_id) -> _WindowState:
+        with self._lock:
+            state = self._states.get(thread_id)
+            if state is None:
+                state = self._states[thread_id] = _WindowState()
+                if len(self._states) > self.cache_size:
+                    self._states.popitem(last=False)
+            else:
+                self._states.move_to_end(thread_id)
+            return state
+
+    def _window(self, history: List[BaseMessage], state: _WindowState) -> int:
+        """返回新的窗口起点 (被裁掉的历史消息条数)"""
+        turns = split_turns(history)
+        start = state.start
+
+        # 找到起点所在的轮 (起点总是某一轮的开头)
+        offset, first_turn = 0, 0
+        while first_turn < len(turns) and offset < start:
+            offset += len(turns[first_turn])
+            first_turn += 1
+
+        # 只需要数窗口内的消息，已经裁掉的部分不再计数
+        token_counts = {i: self.counter.count_messages(turns[i]) for i in range(first_turn, len(turns))}
+        total = sum(token_counts.values())
+        if total > self.max_tokens:
+            # 一次性收缩到 target_tokens 以内，最后一轮 (当前这一轮) 无论多长都保留
+            while first_turn < len(turns) - 1 and total > self.target_tokens:
+                total -= token_counts[first_turn]
+                offset += len(turns[first_turn])
+                first_turn += 1
+            logger.info("✂️ [history] 历史超出预算，裁掉前 %s 条消息，窗口剩余约 %s tokens", offset, total)
+        return offset
+
+    def _split(self, request: ModelRequest):
+        messages = list(request.messages)
+        # 末尾的 SystemMessage (环境感知) 不参与裁剪
+        tail_start = len(messages)
+        while tail_start > 0 and isinstance(messages[tail_start - 1], SystemMessage):
+            tail_start -= 1
+        return messages[:tail_start], messages[tail_start:]
+
+    def _build(self, request: ModelRequest, history, tail, start: int, summary: str) -> ModelRequest:
+        kept = history[start:]
+        if summary:
+            kept = [SystemMessage(content=SUMMARY_MESSAGE_TEMPLATE.format(summary=summary))] + kept
+        return request.override(messages=kept + tail)
+
+    # --- 滚动摘要 ---
+    def _summary_input(self, state: _WindowState, evicted: List[BaseMessage]) -> List[BaseMessage]:
+        clipped = []
+        for message in evicted:
+            if isinstance(message, ToolMessage) and len(message_text(message)) > self.summary_input_chars:
+                message = message.model_copy(update={"content": message_text(message)[: self.summary_input_chars] + "..."})
+            clipped.append(message)
+        transcript = get_buffer_string(clipped)
+        if state.summary:
+            transcript = f"【已有摘要】\n{state.summary}\n\n【新增对话】\n{transcript}"
+        return [SystemMessage(content=SUMMARY_PROMPT), HumanMessage(content=transcript)]
+
+    def _needs_summary(self, state: _WindowState, start: int) -> bool:
+        return self.summary and start > state.summarized
+
+    def _save(self, state: _WindowState, start: int, summary_message=None) -> None:
+        with self._lock:
+            state.start = start
+            if summary_message is not None and start > state.summarized:
+                state.summary = message_text(summary_message).strip()
+                state.summarized = start
+
+    def _prepare(self, request: ModelRequest):
+        history, tail = self._split(request)
+        thread_id = current_thread_id()
+        state = self._get_state(thread_id) if thread_id else _WindowState()
+        if state.start > len(history):
+            # 会话被清空 / 重建过，旧的窗口和摘要都作废
+            with self._lock:
+                state.start, state.summary, state.summarized = 0, "", 0
+        start = self._window(history, state)
+        return history, tail, state, start
+
+    # 摘要调用打上 nostream 标签，不会混进 stream_mode="messages" 推给前端的 token 流
+    def wrap_model_call(self, request: ModelRequest, handler):
+        history, tail, state, start = self._prepare(request)
+        summary_message = None
+        if self._needs_summary(state, start):
+            model = self.summary_model or request.model
+            try:
+                summary_message = model.invoke(
+                    self._summary_input(state, history[state.summarized:start]),
+                    config={"tags": [TAG_NOSTREAM]},
+                )
+            except Exception as e:
+                logger.warning("⚠️ [history] 生成历史摘要失败: %s", e)
+        self._save(state, start, summary_message)
+        return handler(self._build(request, history, tail, start, state.summary if self.summary else ""))
+
+    async def awrap_model_call(self, request: ModelRequest, handler):
+        history, tail, state, start = self._prepare(request)
+        summary_message = None
+        if self._needs_summary(state, start):
+            model = self.summary_model or request.model
+            try:
+                summary_message = await model.ainvoke(
+                    self._summary_input(state, history[state.summarized:start]),
+                    config={"tags": [TAG_NOSTREAM]},
+                )
+            except Exception as e:
+                logger.warning("⚠️ [history] 生成历史摘要失败: %s", e)
+        self._save(state, start, summary_message)
+        return await handler(self._build(request, history, tail, start, state.summary if self.summary else ""))
+
+
+def build_history_window(conf: Optional[dict] = None) -> HistoryWindowMiddleware:
+    """按 settings.AGENT_HISTORY_WINDOW 创建历史窗口中间件"""
+    conf = {**DEFAULT_HISTORY_WINDOW, **(conf or get_setting("AGENT_HISTORY_WINDOW", {}))}
+    return HistoryWindowMiddleware(
+        max_tokens=conf["MAX_TOKENS"],
+        target_tokens=conf["TARGET_TOKENS"],
+        tokenizer=conf["TOKENIZER"],
+        summary=conf["SUMMARY"],
+        summary_input_chars=conf["SUMMARY_INPUT_CHARS"],
+        cache_size=conf["CACHE_SIZE"],
+    )
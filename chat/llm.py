@@ -1,46 +1,259 @@
-import time
+import json
+import logging
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
-from chat.graph import llm
+from chat.config import get_setting
 # 引入 Django 模型 (注意：需要在 django setup 之后才能引入，通常在 views 调用时没问题)
 # 如果报 AppRegistryNotReady，请确保只在函数内部 import，或者确保 Django 已启动
 from chat.models import ChatSession
 
-# 单独初始化一个轻量级 LLM (保持你之前的逻辑)
+logger = logging.getLogger(__name__)
 
+# 单独初始化一个轻量级 LLM：起标题不需要和主对话抢同一个模型 / 配额，配置见 settings.AGENT_TITLE_LLM
+DEFAULT_TITLE_LLM = {
+    "MODEL": "deepseek-chat",
+    "BASE_URL": "https://api.deepseek.com",
+    "API_KEY_ENV": "DEEPSEEK_API_KEY",
+    "TEMPERATURE": 0,
+    # 每个标题最多 10 个字，批量时按条数放大
+    "MAX_TOKENS_PER_TITLE": 32,
+    "TIMEOUT": 30,
+}
 
+TITLE_PROMPT = ChatPromptTemplate.from_template(
+    "请根据用户的输入生成一个非常简短的对话标题（不超过10个字），不要包含任何标点符号，直接输出标题内容。\n\n用户输入: {query}"
+)
 
-# 【重点修改】去掉 async，改为普通函数
-def generate_and_update_title(session_id: str, user_query: str):
+BATCH_TITLE_PROMPT = ChatPromptTemplate.from_template(
+    "下面是 {count} 个不同对话里用户的第一句输入，请分别为每一条生成一个非常简短的对话标题（不超过10个字，不要包含任何标点符号）。\n"
+    "只输出一个 JSON 字符串数组，按输入顺序一一对应，不要输出其他内容。\n\n{queries}"
+)
+
+# 单条用户输入放进批量 prompt 时截断，避免一条长输入撑大整批请求
+MAX_QUERY_CHARS = 200
+
+# 本地规则生成的标题最长字数 (和前端重命名的上限一致)
+MAX_TITLE_CHARS = 20
+
+# 快速路由的意图 -> 标题里的查询类型
+INTENT_LABELS = {
+    "mr_info": "MR信息",
+    "multimode": "多模版本",
+    "matching_details": "配套信息",
+    "component_merge": "合入状态",
+    "spc_commercial": "商用状态",
+    "merge_between": "版本差异",
+    "basic_info": "基本信息",
+    "bugfix_branch": "分支镜像",
+    "trunk_mirror": "主干镜像",
+    "trunk_build_status": "构建状态",
+    "version_push": "推送状态",
+    "hert_node": "HERT节点",
+}
+
+# 路由没有唯一命中时，按关键词判断查询类型 (按顺序取第一个)
+KEYWORD_LABELS = [
+    ("配套", "配套信息"),
+    ("合入", "合入状态"),
+    ("商用", "商用状态"),
+    ("差异", "版本差异"),
+    ("基本信息", "基本信息"),
+    ("详情", "基本信息"),
+    ("镜像", "镜像信息"),
+    ("构建", "构建状态"),
+    ("推送", "推送状态"),
+]
+
+_title_llm = None
+_title_llm_lock = threading.Lock()
+
+
+def get_title_llm() -> ChatOpenAI:
+    global _title_llm
+    if _title_llm is None:
+        with _title_llm_lock:
+            if _title_llm is None:
+                conf = {**DEFAULT_TITLE_LLM, **get_setting("AGENT_TITLE_LLM", {})}
+                _title_llm = ChatOpenAI(
+                    model=conf["MODEL"],
+                    api_key=os.getenv(conf["API_KEY_ENV"]),
+                    base_url=conf["BASE_URL"],
+                    temperature=conf["TEMPERATURE"],
+                    max_tokens=conf["MAX_TOKENS_PER_TITLE"],
+                    timeout=conf["TIMEOUT"],
+                )
+    return _title_llm
+
+
+def _clean_title(title: str) -> str:
+    return str(title).strip().replace('"', '')
+
+
+class TitleStats:
+    """本地生成 / LLM 生成的标题数，以及实际发生和省掉的 LLM 调用次数"""
+
+    def __init__(self):
+        self.local_titles = 0
+        self.llm_titles = 0
+        self.llm_calls = 0
+        self.llm_calls_saved = 0
+        self._lock = threading.Lock()
+
+    def record_batch(self, local: int, llm: int):
+        with self._lock:
+            self.local_titles += local
+            self.llm_titles += llm
+            # 整批都在本地生成时，这一批原本要发的那次 LLM 调用就省掉了
+            if local and not llm:
+                self.llm_calls_saved += 1
+
+    def record_llm_call(self):
+        with self._lock:
+            self.llm_calls += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            total = self.local_titles + self.llm_titles
+            return {
+                "local_titles": self.local_titles,
+                "llm_titles": self.llm_titles,
+                "local_share": round(self.local_titles / total, 4) if total else None,
+                "llm_calls": self.llm_calls,
+                "llm_calls_saved": self.llm_calls_saved,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.local_titles = self.llm_titles = self.llm_calls = self.llm_calls_saved = 0
+
+
+title_stats = TitleStats()
+
+
+def _title_router():
+    # 复用快速路由的实体抽取 (正则 + 组件 / 产品枚举)，这里才导入是为了不在加载 llm.py 时就构建 Agent
+    from chat.graph import route_fast_path
+
+    return route_fast_path.router
+
+
+def heuristic_title(user_query: str) -> Optional[str]:
+    """
+    不调 LLM，按抽取到的实体拼标题，例如 “帮我查一下 24a 的 iware” -> “24a iware”
+    格式: [版本] [查询对象] [查询类型]
+    没有查询对象时，要有查询类型并且能确定版本 (或能直接路由，如 MR 信息)，否则返回 None 交给 LLM
+    """
+    text = user_query.strip()
+    if not text or len(text) > MAX_QUERY_CHARS:
+        return None
+    router = _title_router()
+    e = router.extract(text)
+
+    # 查询对象：按类别优先级取第一类里的第一个，同类有多个时加“等”
+    subjects = next(
+        (found for found in (e.components, e.products, e.hert_versions, e.multimode, e.spc_versions, e.v_versions, e.branches) if found),
+        [],
+    )
+    route = router.route(text)
+    label = INTENT_LABELS.get(route.intent) if route else None
+    if label is None:
+        label = next((name for keyword, name in KEYWORD_LABELS if keyword in text), None)
+
+    if not subjects and not (label and (e.vers or route)):
+        return None
+
+    subject = subjects[0] + ("等" if len(subjects) > 1 else "") if subjects else None
+    version = e.vers[0] if e.vers else None
+    title = " ".join(p for p in (version, subject, label) if p)
+    if len(title) > MAX_TITLE_CHARS:
+        # 太长先去掉版本，还长就交给 LLM
+        title = " ".join(p for p in (subject, label) if p)
+        if len(title) > MAX_TITLE_CHARS:
+            return None
+    return title
+
+
+def generate_title(user_query: str) -> str:
+    chain = TITLE_PROMPT | get_title_llm() | StrOutputParser()
+    title_stats.record_llm_call()
+    return _clean_title(chain.invoke({"query": user_query}))
+
+
+def generate_titles(queries: List[str]) -> List[Optional[str]]:
     """
-    后台任务：同步版，适合在 threading.Thread 中运行
+    一次 LLM 调用给多条输入起标题，返回和 queries 一一对应的标题
+    模型输出解析不出来 (或条数对不上) 时退回逐条生成
     """
-    print(f"🚀 [后台任务启动] 正在为会话 {session_id} 生成标题...")
+    if len(queries) == 1:
+        return [generate_title(queries[0])]
+
+    numbered = "\n".join(f"{i + 1}. {q[:MAX_QUERY_CHARS]}" for i, q in enumerate(queries))
+    llm = get_title_llm()
+    llm = llm.bind(max_tokens=llm.max_tokens * len(queries))
+    chain = BATCH_TITLE_PROMPT | llm | StrOutputParser()
+    title_stats.record_llm_call()
+    output = chain.invoke({"count": len(queries), "queries": numbered})
 
+    match = re.search(r"\[.*\]", output, re.S)
     try:
-        # 1. 定义 Prompt
-        prompt = ChatPromptTemplate.from_template(
-            "请根据用户的输入生成一个非常简短的对话标题（不超过10个字），不要包含任何标点符号，直接输出标题内容。\n\n用户输入: {query}"
-        )
-        chain = prompt | llm | StrOutputParser()
-
-        # 2. 调用 LLM (同步 invoke)
-        # 线程会阻塞在这里等待 HTTP 请求返回，但这不影响主线程的流式输出
-        new_title = chain.invoke({"query": user_query})
-        new_title = new_title.strip().replace('"', '')
-
-        print(f"✅ [生成成功] 新标题: {new_title}")
-
-        # 3. 使用 Django ORM 更新数据库 (比 raw sql 更安全)
-        # filter().update() 是直接在数据库层面执行 SQL update，效率高
-        rows = ChatSession.objects.filter(session_id=session_id).update(title=new_title)
-
-        if rows == 0:
-            print(f"⚠️ [更新警告] 未找到会话 ID: {session_id}")
-        else:
-            print(f"💾 [数据库更新] 会话标题已保存")
-
-    except Exception as e:
-        print(f"❌ 自动生成标题失败: {e}")
\ No newline at end of file
+        titles = json.loads(match.group()) if match else None
+    except json.JSONDecodeError:
+        titles = None
+    if isinstance(titles, list) and len(titles) == len(queries):
+        return [_clean_title(t) or None for t in titles]
+
+    logger.warning("⚠️ 批量标题结果解析失败，改为逐条生成: %s", output[:200])
+    return [generate_title(q) for q in queries]
+
+
+def save_title(session_id: str, new_title: str) -> None:
+    # 使用 Django ORM 更新数据库 (比 raw sql 更安全)
+    # filter().update() 是直接在数据库层面执行 SQL update，效率高
+    rows = ChatSession.objects.filter(session_id=session_id).update(title=new_title)
+
+    if rows == 0:
+        logger.warning("⚠️ [更新警告] 未找到会话 ID: %s", session_id)
+    else:
+        logger.debug("💾 [数据库更新] 会话标题已保存")
+
+
+def generate_and_update_titles(items: List[Tuple[str, str]]) -> Dict[str, str]:
+    """
+    后台任务：给一批 (session_id, 用户第一句输入) 起标题并写回数据库
+    由 chat/tasks.py 的标题队列在 worker 线程里调用
+    """
+    logger.debug("🚀 [后台任务启动] 正在为 %s 个会话生成标题...", len(items))
+    saved = {}
+    titles = [heuristic_title(query) for _, query in items]
+    # 本地规则搞不定的才走 LLM (剩下的仍然合成一次调用)
+    llm_indexes = [i for i, title in enumerate(titles) if title is None]
+    local_count = len(items) - len(llm_indexes)
+    if llm_indexes:
+        try:
+            llm_titles = generate_titles([items[i][1] for i in llm_indexes])
+        except Exception as e:
+            logger.exception("❌ 自动生成标题失败: %s", e)
+            llm_titles = [None] * len(llm_indexes)
+        for i, title in zip(llm_indexes, llm_titles):
+            titles[i] = title
+    title_stats.record_batch(local=local_count, llm=len(llm_indexes))
+
+    for (session_id, _), new_title in zip(items, titles):
+        if not new_title:
+            continue
+        logger.info("✅ [生成成功] 会话 %s 新标题: %s", session_id, new_title)
+        save_title(session_id, new_title)
+        saved[session_id] = new_title
+    return saved
+
+
+def generate_and_update_title(session_id: str, user_query: str):
+    """单个会话的同步版，等价于只有一条的批量任务"""
+    return generate_and_update_titles([(session_id, user_query)]).get(session_id)
@@ -0,0 +1,333 @@
+"""
+agent_chat_history.db 的保留策略与垃圾回收
+
+SqliteSaver 会把每一步的 checkpoint 都留下来，一轮对话 (模型 -> 工具 -> 模型) 就是好几行，
+而且每行都是当时的完整状态。恢复对话只需要最新的那一个，旧的只在“回到某一步”的时候才有用。
+这里提供:
+  * prune:    每个会话只保留最新 KEEP_LATEST 个 checkpoint，对应的 writes 一并删掉
+  * expire:   最后一次写入早于 IDLE_DAYS 天的会话，整段 checkpoint 删掉 (聊天记录投影 ChatMessage 还在，
+              历史照常能看，只是 Agent 不再记得上下文)；DELETE_IDLE_SESSIONS=True 时连会话本身一起删
+  * orphans:  ChatSession 已经删了但 checkpoint 还在的会话 (级联删除上线之前遗留的)
+  * blobs:    压缩序列化 (chat/serde.py) 存的大工具结果，已经没有任何 checkpoint / writes 引用的删掉
+  * vacuum:   PRAGMA incremental_vacuum 把空闲页还给文件系统，并截断 WAL，报告回收的字节数
+
+删除按会话分批进行，每批一个短事务，不会长时间占着写锁影响在线对话。
+入口: python manage.py gc_checkpoints，或者 settings.AGENT_CHECKPOINT_GC["ENABLED"] 打开进程内的定时任务。
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Iterable, List, Optional
+
+from chat.config import get_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_GC = {
+    # 进程内定时执行 (多 worker 部署时建议关掉，改用 cron 跑管理命令)
+    "ENABLED": False,
+    "INTERVAL": 3600,
+    # 每个会话保留的 checkpoint 个数
+    "KEEP_LATEST": 3,
+    # 超过多少天没有新 checkpoint 的会话视为过期，None 表示不过期
+    "IDLE_DAYS": 30,
+    # 过期时是否连 ChatSession / ChatMessage 一起删除
+    "DELETE_IDLE_SESSIONS": False,
+    # 是否清理没有对应 ChatSession 的会话
+    "DELETE_ORPHANS": False,
+    # 每次 incremental_vacuum 最多回收的页数，None 表示全部
+    "VACUUM_PAGES": None,
+    # 每个事务处理的会话数
+    "BATCH_THREADS": 200,
+    # 清理没有引用的 blob；新写入不久的不动 (引用它的 checkpoint 可能还在写缓冲区里)
+    "SWEEP_BLOBS": True,
+    "BLOB_MIN_AGE": 3600,
+}
+
+# uuid6 时间戳的起点 (1582-10-15) 到 Unix 纪元之间的 100ns 间隔数
+_UUID_EPOCH_OFFSET = 0x01B21DD213814000
+
+
+def checkpoint_id_at(timestamp: float) -> str:
+    """
+    构造一个对应 timestamp 的最小 checkpoint_id
+    LangGraph 的 checkpoint_id 是 uuid6，字符串顺序就是时间顺序，可以直接和库里的值比较大小
+    """
+    ticks = int(timestamp * 10_000_000) + _UUID_EPOCH_OFFSET
+    value = ((ticks >> 12) & 0xFFFFFFFFFFFF) << 80
+    value |= (0x6000 | (ticks & 0x0FFF)) << 64
+    return str(uuid.UUID(int=value))
+
+
+def _chunks(items: List[str], size: int) -> Iterable[List[str]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _placeholders(items) -> str:
+    return ",".join("?" * len(items))
+
+
+class GCReport:
+    def __init__(self):
+        self.threads = 0
+        self.checkpoints_deleted = 0
+        self.writes_deleted = 0
+        self.threads_expired = 0
+        self.orphans_deleted = 0
+        self.sessions_deleted = 0
+        self.blobs_deleted = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+        self.vacuum = None
+        self.seconds = 0.0
+
+    @property
+    def bytes_reclaimed(self) -> int:
+        return max(0, self.bytes_before - self.bytes_after)
+
+    def as_dict(self) -> dict:
+        return {
+            "threads": self.threads,
+            "checkpoints_deleted": self.checkpoints_deleted,
+            "writes_deleted": self.writes_deleted,
+            "threads_expired": self.threads_expired,
+            "orphans_deleted": self.orphans_deleted,
+            "sessions_deleted": self.sessions_deleted,
+            "blobs_deleted": self.blobs_deleted,
+            "vacuum": self.vacuum,
+            "bytes_before": self.bytes_before,
+            "bytes_after": self.bytes_after,
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "seconds": round(self.seconds, 3),
+        }
+
+
+class CheckpointGC:
+    """对 PooledSqliteSaver 的库做清理，所有写操作都走 saver 的写连接和写锁"""
+
+    def __init__(self, saver, conf: Optional[dict] = None):
+        from chat.checkpoint import PooledSqliteSaver
+
+        if not isinstance(saver, PooledSqliteSaver):
+            raise TypeError(f"只支持 PooledSqliteSaver，当前存储器是 {type(saver).__name__}")
+        self.saver = saver
+        self.conf = {**DEFAULT_CHECKPOINT_GC, **(conf if conf is not None else get_setting("AGENT_CHECKPOINT_GC", {}))}
+
+    # --- 查询 ---
+    def file_size(self) -> int:
+        path = self.saver.pool.path
+        return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+    def thread_ids(self) -> List[str]:
+        self.saver.setup()
+        with self.saver.pool.connection() as conn:
+            return [row[0] for row in conn.execute("SELECT DISTINCT thread_id FROM checkpoints")]
+
+    def idle_thread_ids(self, idle_days: float) -> List[str]:
+        cutoff = checkpoint_id_at(time.time() - idle_days * 86400)
+        self.saver.setup()
+        with self.saver.pool.connection() as conn:
+            return [
+                row[0]
+                for row in conn.execute(
+                    "SELECT thread_id FROM checkpoints GROUP BY thread_id HAVING MAX(checkpoint_id) < ?", (cutoff,)
+                )
+            ]
+
+    def orphan_thread_ids(self) -> List[str]:
+        from chat.models import ChatSession
+
+        thread_ids = self.thread_ids()
+        existing = set()
+        for chunk in _chunks(thread_ids, 500):
+            existing.update(ChatSession.objects.filter(session_id__in=chunk).values_list("session_id", flat=True))
+        return [t for t in thread_ids if t not in existing]
+
+    # --- 删除 ---
+    def delete_threads(self, thread_ids: List[str]) -> int:
+        """整段删除这些会话的 checkpoint 和 writes，返回删掉的 checkpoint 行数"""
+        self.saver.flush()
+        deleted = 0
+        for chunk in _chunks(thread_ids, self.conf["BATCH_THREADS"]):
+            with self.saver.cursor() as cur:
+                cur.execute(f"DELETE FROM checkpoints WHERE thread_id IN ({_placeholders(chunk)})", chunk)
+                deleted += cur.rowcount
+                cur.execute(f"DELETE FROM writes WHERE thread_id IN ({_placeholders(chunk)})", chunk)
+        return deleted
+
+    def prune(self, keep: int, report: GCReport) -> None:
+        """每个会话 (及子图命名空间) 只保留最新 keep 个 checkpoint"""
+        keep = max(1, keep)
+        thread_ids = self.thread_ids()
+        report.threads = len(thread_ids)
+        self.saver.flush()
+        for chunk in _chunks(thread_ids, self.conf["BATCH_THREADS"]):
+            with self.saver.cursor() as cur:
+                cur.execute(
+                    f"""
+                    DELETE FROM checkpoints WHERE rowid IN (
+                        SELECT rowid FROM (
+                            SELECT rowid, ROW_NUMBER() OVER (
+                                PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC
+                            ) AS rn
+                            FROM checkpoints WHERE thread_id IN ({_placeholders(chunk)})
+                        ) WHERE rn > ?
+                    )
+                    """,
+                    [*chunk, keep],
+                )
+                report.checkpoints_deleted += cur.rowcount
+                # checkpoint 已经不在了的 writes 没有任何用处
+                cur.execute(
+                    f"""
+                    DELETE FROM writes WHERE thread_id IN ({_placeholders(chunk)}) AND NOT EXISTS (
+                        SELECT 1 FROM checkpoints c
+                        WHERE c.thread_id = writes.thread_id
+                          AND c.checkpoint_ns = writes.checkpoint_ns
+                          AND c.checkpoint_id = writes.checkpoint_id
+                    )
+                    """,
+                    chunk,
+                )
+                report.writes_deleted += cur.rowcount
+
+    def referenced_blobs(self) -> set:
+        """扫一遍 checkpoints / writes，收集还被引用的 blob key"""
+        from chat.serde import BLOB_REF_RE, CompressedSerializer
+
+        serde = self.saver.serde
+        refs = set()
+        with self.saver.pool.connection() as conn:
+            for sql in ("SELECT type, checkpoint FROM checkpoints", "SELECT type, value FROM writes"):
+                for type_, payload in conn.execute(sql):
+                    if not payload:
+                        continue
+                    if isinstance(serde, CompressedSerializer):
+                        payload = serde.payload_bytes(type_, payload)
+                    refs.update(m.decode("ascii") for m in BLOB_REF_RE.findall(payload))
+        return refs
+
+    def sweep_blobs(self, min_age: float) -> int:
+        """删除没有被引用、并且写入超过 min_age 秒的 blob，返回删除个数"""
+        self.saver.setup()
+        self.saver.flush()
+        cutoff = time.time() - min_age
+        with self.saver.pool.connection() as conn:
+            candidates = [row[0] for row in conn.execute("SELECT key FROM blobs WHERE created_at < ?", (cutoff,))]
+        if not candidates:
+            return 0
+        refs = self.referenced_blobs()
+        unused = [key for key in candidates if key not in refs]
+        deleted = 0
+        for chunk in _chunks(unused, 500):
+            with self.saver.cursor() as cur:
+                # 扫描期间又被引用的 blob 已经刷新了 created_at，这里再核对一次，不删
+                cur.execute(
+                    f"DELETE FROM blobs WHERE key IN ({_placeholders(chunk)}) AND created_at < ?",
+                    [*chunk, cutoff],
+                )
+                deleted += cur.rowcount
+        return deleted
+
+    def vacuum(self, pages: Optional[int] = None, full: bool = False) -> str:
+        """
+        把空闲页还给文件系统
+        库是 auto_vacuum=INCREMENTAL 时做增量回收；老库 (auto_vacuum=NONE) 只有 full=True 时才做一次完整 VACUUM
+        把它转换成增量模式 (会重写整个文件，期间阻塞写入)，否则跳过
+        """
+        self.saver.flush()
+        with self.saver.lock:
+            conn = self.saver._writer()
+            conn.commit()
+            mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+            if mode == 2:
+                # 用 executescript：execute() 只 step 一次，incremental_vacuum 每次 step 只回收一页
+                conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});" if pages else "PRAGMA incremental_vacuum;")
+                result = "incremental"
+            elif full:
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+                result = "full"
+            else:
+                result = "skipped (auto_vacuum=NONE，需要 --full-vacuum 转换一次)"
+            # WAL 文件也截断，否则回收的空间还留在 -wal 里
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+            return result
+
+    # --- 入口 ---
+    def run(
+        self,
+        keep: Optional[int] = None,
+        idle_days: Optional[float] = None,
+        orphans: Optional[bool] = None,
+        delete_sessions: Optional[bool] = None,
+        vacuum: bool = True,
+        full_vacuum: bool = False,
+    ) -> GCReport:
+        keep = self.conf["KEEP_LATEST"] if keep is None else keep
+        idle_days = self.conf["IDLE_DAYS"] if idle_days is None else idle_days
+        orphans = self.conf["DELETE_ORPHANS"] if orphans is None else orphans
+        delete_sessions = self.conf["DELETE_IDLE_SESSIONS"] if delete_sessions is None else delete_sessions
+
+        report = GCReport()
+        started = time.perf_counter()
+        report.bytes_before = self.file_size()
+
+        if idle_days:
+            idle = self.idle_thread_ids(idle_days)
+            report.threads_expired = len(idle)
+            report.checkpoints_deleted += self.delete_threads(idle)
+            if delete_sessions and idle:
+                report.sessions_deleted += self._delete_sessions(idle)
+        if orphans:
+            orphan_ids = self.orphan_thread_ids()
+            report.orphans_deleted = len(orphan_ids)
+            report.checkpoints_deleted += self.delete_threads(orphan_ids)
+        if keep:
+            self.prune(keep, report)
+        if self.conf["SWEEP_BLOBS"]:
+            report.blobs_deleted = self.sweep_blobs(self.conf["BLOB_MIN_AGE"])
+        if vacuum:
+            report.vacuum = self.vacuum(self.conf["VACUUM_PAGES"], full=full_vacuum)
+
+        report.bytes_after = self.file_size()
+        report.seconds = time.perf_counter() - started
+        return report
+
+    @staticmethod
+    def _delete_sessions(thread_ids: List[str]) -> int:
+        from chat.models import ChatSession
+
+        deleted = 0
+        for chunk in _chunks(thread_ids, 500):
+            # ChatMessage 由 post_delete 信号级联删除 (见 chat/signals.py)
+            deleted += ChatSession.objects.filter(session_id__in=chunk).delete()[1].get("chat.ChatSession", 0)
+        return deleted
+
+
+def start_periodic_gc(saver, conf: Optional[dict] = None) -> Optional[threading.Thread]:
+    """settings.AGENT_CHECKPOINT_GC["ENABLED"] 为 True 时启动后台定时清理线程"""
+    conf = {**DEFAULT_CHECKPOINT_GC, **(conf if conf is not None else get_setting("AGENT_CHECKPOINT_GC", {}))}
+    if not conf["ENABLED"]:
+        return None
+    try:
+        gc = CheckpointGC(saver, conf)
+    except TypeError as e:
+        logger.warning("⚠️ [checkpoint-gc] 未启动: %s", e)
+        return None
+
+    def loop():
+        while True:
+            time.sleep(conf["INTERVAL"])
+            try:
+                report = gc.run()
+                logger.info("🧹 [checkpoint-gc] %s", report.as_dict())
+            except Exception as e:
+                logger.exception("❌ [checkpoint-gc] 清理失败: %s", e)
+
+    thread = threading.Thread(target=loop, name="checkpoint-gc", daemon=True)
+    thread.start()
+    return thread
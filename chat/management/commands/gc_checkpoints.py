@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.checkpoint import get_checkpointer
+from chat.maintenance import CheckpointGC
+
+
+class Command(BaseCommand):
+    help = "清理 agent_chat_history.db：裁剪旧 checkpoint、过期闲置会话、清理孤儿会话并回收磁盘空间 (默认值见 settings.AGENT_CHECKPOINT_GC)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--keep", type=int, help="每个会话保留最新的 N 个 checkpoint")
+        parser.add_argument("--idle-days", type=float, help="超过 N 天没有新 checkpoint 的会话整段删除，0 表示不过期")
+        parser.add_argument("--delete-sessions", action="store_true", default=None, help="过期会话连 ChatSession / 聊天记录一起删除")
+        parser.add_argument("--orphans", action="store_true", default=None, help="删除没有对应 ChatSession 的会话")
+        parser.add_argument("--no-vacuum", action="store_true", help="只删数据，不回收磁盘空间")
+        parser.add_argument(
+            "--full-vacuum",
+            action="store_true",
+            help="老库 (auto_vacuum=NONE) 做一次完整 VACUUM 转成增量模式，会重写整个文件并阻塞写入",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            gc = CheckpointGC(get_checkpointer())
+        except TypeError as e:
+            raise CommandError(str(e))
+
+        report = gc.run(
+            keep=options["keep"],
+            idle_days=options["idle_days"],
+            orphans=options["orphans"],
+            delete_sessions=options["delete_sessions"],
+            vacuum=not options["no_vacuum"],
+            full_vacuum=options["full_vacuum"],
+        )
+        self.stdout.write(json.dumps(report.as_dict(), ensure_ascii=False, indent=2))
+        self.stdout.write(self.style.SUCCESS(f"🧹 回收 {report.bytes_reclaimed / 1024 / 1024:.2f} MB"))
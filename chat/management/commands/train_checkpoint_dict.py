@@ -0,0 +1,46 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.checkpoint import get_checkpointer
+from chat.serde import train_dictionary
+
+
+class Command(BaseCommand):
+    help = "用库里已有的 checkpoint 训练 zstd 字典，之后新写入的 checkpoint 用字典压缩 (需要 AGENT_CHECKPOINTER 打开 compression)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=112640, help="字典大小 (字节)，默认 110KB")
+        parser.add_argument("--samples", type=int, default=2000, help="最多取多少个 checkpoint / writes 作为训练样本")
+
+    def handle(self, *args, **options):
+        saver = get_checkpointer()
+        if getattr(saver, "compression", None) is None:
+            raise CommandError("当前存储器没有打开压缩序列化，请在 AGENT_CHECKPOINTER.OPTIONS 里配置 compression")
+
+        saver.setup()
+        saver.flush()
+        samples = []
+        with saver.pool.connection() as conn:
+            for sql in (
+                "SELECT type, checkpoint FROM checkpoints ORDER BY checkpoint_id DESC LIMIT ?",
+                "SELECT type, value FROM writes ORDER BY checkpoint_id DESC LIMIT ?",
+            ):
+                for type_, payload in conn.execute(sql, (options["samples"],)):
+                    if payload:
+                        samples.append(saver.serde.payload_bytes(type_, payload))
+        samples = samples[: options["samples"]]
+        if len(samples) < 10:
+            raise CommandError(f"样本太少 ({len(samples)} 个)，先积累一些对话再训练")
+
+        try:
+            zdict = train_dictionary(samples, options["size"])
+        except Exception as e:
+            raise CommandError(f"训练字典失败: {e}")
+        dict_id = saver.add_dict(zdict)
+        self.stdout.write(json.dumps(
+            {"dict_id": dict_id, "samples": len(samples), "dict_bytes": len(zdict.as_bytes())},
+            ensure_ascii=False,
+            indent=2,
+        ))
+        self.stdout.write(self.style.SUCCESS(f"📚 已保存 zstd 字典 {dict_id}，新写入的 checkpoint 将使用它压缩"))
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.10 on 2026-10-18 00:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatsession",
+            name="completion_tokens",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="chatsession",
+            name="prompt_cache_hit_tokens",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="chatsession",
+            name="prompt_tokens",
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
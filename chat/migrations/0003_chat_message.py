@@ -0,0 +1,30 @@
+# Generated by Django 5.2.10 on 2026-10-18 00:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_session_token_usage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.CharField(max_length=100)),
+                ('message_id', models.CharField(max_length=100)),
+                ('role', models.CharField(max_length=10)),
+                ('content', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'chat_messages',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['session_id', 'id'], name='chat_message_session_idx')],
+                'constraints': [models.UniqueConstraint(fields=('session_id', 'message_id'), name='chat_message_unique')],
+            },
+        ),
+    ]
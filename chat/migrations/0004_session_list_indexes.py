@@ -0,0 +1,21 @@
+# Generated by Django 5.2.10 on 2026-10-18 00:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chat_message'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(fields=['user_id', '-created_at', '-session_id'], name='sessions_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(fields=['-created_at', '-session_id'], name='sessions_created_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-18 00:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_session_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='version',
+            field=models.CharField(blank=True, max_length=10, null=True),
+        ),
+    ]
@@ -9,7 +9,44 @@ class ChatSession(models.Model):
     title = models.CharField(max_length=200, default="New Chat")
     # 对应 created_at
     created_at = models.DateTimeField(auto_now_add=True)
+    # Token 用量累计 (chat/usage.py 在每次模型调用后更新)
+    prompt_tokens = models.BigIntegerField(default=0)
+    # 其中命中模型服务商前缀缓存的 prompt token 数
+    prompt_cache_hit_tokens = models.BigIntegerField(default=0)
+    completion_tokens = models.BigIntegerField(default=0)
+    # 会话当前的上下文版本 (如 29a)，前端切换版本时更新，见 chat/context.py
+    version = models.CharField(max_length=10, null=True, blank=True)
 
     class Meta:
         db_table = 'sessions'  #以此名在数据库中创建表
-        ordering = ['-created_at']
\ No newline at end of file
+        ordering = ['-created_at']
+        indexes = [
+            # 按用户查会话列表 + 游标分页 (见 chat/pagination.py)
+            models.Index(fields=['user_id', '-created_at', '-session_id'], name='sessions_user_created_idx'),
+            # 运维接口不按用户过滤时的全局列表
+            models.Index(fields=['-created_at', '-session_id'], name='sessions_created_idx'),
+        ]
+
+class ChatMessage(models.Model):
+    """
+    会话聊天记录的投影 (只有用户提问和 AI 回答)，在 Agent 每轮运行时写入，见 chat/transcript.py
+    历史接口直接分页查这张表，不用再把整个 checkpoint 反序列化出来
+    """
+    session_id = models.CharField(max_length=100)
+    # 对应 LangGraph 消息的 id，重复写入时按它去重
+    message_id = models.CharField(max_length=100)
+    # user / ai (和前端 messageList 的 role 一致)
+    role = models.CharField(max_length=10)
+    content = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'chat_messages'
+        ordering = ['id']
+        constraints = [
+            models.UniqueConstraint(fields=['session_id', 'message_id'], name='chat_message_unique'),
+        ]
+        indexes = [
+            # 历史接口按 session_id 过滤、按 id 倒序翻页
+            models.Index(fields=['session_id', 'id'], name='chat_message_session_idx'),
+        ]
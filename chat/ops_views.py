@@ -1,45 +1,62 @@
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 
-from .graph import graph
+from .agents import get_graph
 from .models import ChatSession
-from .serializers import serialize_message
-
-# 引入你编译好的 graph 对象
-# 必须确保这个 graph 初始化的 checkpointer 指向的是 'agent_chat_history.db'
+from .pagination import InvalidPage, cached_count, keyset_page, page_size
+from .tasks import title_queue
 
+# 依赖 langchain / aiohttp 的模块 (usage / router / llm / serializers / tools) 在各个接口里再导入，
+# 加载 URL 配置时不触发这些导入，见 chat/agents.py
 
 
 @csrf_exempt
 def ops_session_list(request):
     """
     运维接口：获取所有会话列表（带详细元数据）
-    支持分页和按用户ID搜索
+    支持游标分页和按用户ID搜索
+    ?user_id=admin&page_size=20&cursor=xxx  cursor 取上一页返回的 next_cursor
+    user_id 默认是【前缀】匹配 (user_id=adm 能搜到 admin，搜不到 sysadmin)，走索引；
+    要按子串搜索时加 match=contains (LIKE '%xx%'，全表扫描，会话多时慢)
+    total 是缓存过的计数 (最多晚 60 秒)，total_is_estimate 标明这一点
     """
+    from .usage import usage_summary
+
     if request.method == 'GET':
         user_id = request.GET.get('user_id')
-        page = int(request.GET.get('page', 1))
-        page_size = int(request.GET.get('page_size', 20))
+        match = request.GET.get('match', 'prefix')
+        if match not in ('prefix', 'contains'):
+            return JsonResponse({"code": 400, "msg": f"match 只能是 prefix 或 contains: {match}"})
+        try:
+            size = page_size(request.GET.get('page_size'), default=20)
+        except InvalidPage as e:
+            return JsonResponse({"code": 400, "msg": str(e)})
 
         # 1. 查询 Django 数据库中的元数据
-        queryset = ChatSession.objects.all().order_by('-created_at')
+        queryset = ChatSession.objects.all()
 
-        if user_id:
+        if user_id and match == 'contains':
             queryset = queryset.filter(user_id__contains=user_id)
+        elif user_id:
+            # 前缀匹配写成范围查询才能用上 (user_id, created_at) 索引，LIKE '%xx%' 只能全表扫
+            queryset = queryset.filter(user_id__gte=user_id, user_id__lt=user_id + "\U0010ffff")
 
-        total = queryset.count()
+        total = cached_count(queryset)
 
-        # 分页切片
-        start = (page - 1) * page_size
-        sessions = queryset[start: start + page_size]
+        try:
+            page = keyset_page(queryset, request.GET.get('cursor'), size)
+        except InvalidPage as e:
+            return JsonResponse({"code": 400, "msg": str(e)})
 
         data = []
-        for s in sessions:
+        for s in page["rows"]:
             data.append({
                 "session_id": s.session_id,
                 "user_id": s.user_id,
                 "title": s.title,
                 "created_at": s.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+                # token 用量 + 前缀缓存命中率
+                "usage": usage_summary(s),
             })
 
         return JsonResponse({
@@ -47,8 +64,9 @@ def ops_session_list(request):
             "data": {
                 "list": data,
                 "total": total,
-                "page": page,
-                "page_size": page_size
+                "total_is_estimate": True,
+                "next_cursor": page["next_cursor"],
+                "page_size": size
             }
         })
 
@@ -59,6 +77,9 @@ def ops_session_trace(request, session_id):
     运维接口：获取某个会话的【全链路追踪】
     从 LangGraph 的 SQLite Checkpoint 中读取完整历史
     """
+    from .serializers import serialize_message
+    from .usage import usage_summary
+
     if request.method == 'GET':
         try:
             # 1. 构造 LangGraph 配置
@@ -66,7 +87,7 @@ def ops_session_trace(request, session_id):
 
             # 2. 从 Checkpointer 获取状态快照
             # graph.get_state 会去读取 agent_chat_history.db
-            state = graph.get_state(config)
+            state = get_graph().get_state(config)
 
             if not state or not state.values:
                 return JsonResponse({"code": 404, "msg": "未找到该会话的 Graph 状态", "trace": []})
@@ -77,12 +98,140 @@ def ops_session_trace(request, session_id):
             # 4. 序列化为前端可视化的格式
             trace_log = [serialize_message(msg) for msg in messages]
 
+            session = ChatSession.objects.filter(session_id=session_id).first()
+
             return JsonResponse({
                 "code": 200,
                 "session_id": session_id,
                 "step_count": len(trace_log),
+                "usage": usage_summary(session) if session else None,
                 "trace": trace_log
             })
 
         except Exception as e:
-            return JsonResponse({"code": 500, "msg": str(e)})
\ No newline at end of file
+            return JsonResponse({"code": 500, "msg": str(e)})
+
+
+@csrf_exempt
+def ops_tool_cache(request):
+    """
+    运维接口：工具结果缓存的命中情况 (按工具统计，用来调 settings.PUO_TOOL_CACHE 的 TTL)
+    统计是每个 worker 进程各自的，pid 用来区分是哪个进程返回的
+    POST ?action=clear 清空当前进程的缓存，?action=reset 重置统计
+    """
+    from .tools.cache import tool_result_cache
+
+    if request.method == 'GET':
+        return JsonResponse({"code": 200, "data": tool_result_cache.snapshot()})
+
+    if request.method == 'POST':
+        action = request.GET.get('action')
+        if action == 'clear':
+            tool_result_cache.clear()
+        elif action == 'reset':
+            tool_result_cache.stats.reset()
+        else:
+            return JsonResponse({"code": 400, "msg": "action 只支持 clear / reset"})
+        return JsonResponse({"code": 200, "data": tool_result_cache.snapshot()})
+
+
+@csrf_exempt
+def ops_fast_path(request):
+    """
+    运维接口：快速路由命中率 (每个 worker 进程各自统计)
+    POST ?action=reset 重置统计
+    """
+    from .router import fast_path_stats
+
+    if request.method == 'GET':
+        return JsonResponse({"code": 200, "data": fast_path_stats.snapshot()})
+
+    if request.method == 'POST':
+        if request.GET.get('action') != 'reset':
+            return JsonResponse({"code": 400, "msg": "action 只支持 reset"})
+        fast_path_stats.reset()
+        return JsonResponse({"code": 200, "data": fast_path_stats.snapshot()})
+
+
+@csrf_exempt
+def ops_titles(request):
+    """
+    运维接口：自动起标题的情况 (每个 worker 进程各自统计)
+    titles: 本地规则生成 / LLM 生成的标题数、本地占比、实际调用和省掉的 LLM 次数
+    queue: 后台标题队列的积压、去重、拒绝情况
+    POST ?action=reset 重置标题统计
+    """
+    from .llm import title_stats
+
+    if request.method == 'GET':
+        return JsonResponse({"code": 200, "data": {"titles": title_stats.snapshot(), "queue": title_queue.snapshot()}})
+
+    if request.method == 'POST':
+        if request.GET.get('action') != 'reset':
+            return JsonResponse({"code": 400, "msg": "action 只支持 reset"})
+        title_stats.reset()
+        return JsonResponse({"code": 200, "data": {"titles": title_stats.snapshot(), "queue": title_queue.snapshot()}})
+
+
+@csrf_exempt
+def ops_answer_cache(request):
+    """
+    运维接口：语义答案缓存的命中率和新鲜程度 (统计是每个 worker 进程各自的，entries 是本机缓存库里的条数)
+    stale: 找到了相同的问题但答案已经超过工具 TTL，没有回放；avg_hit_ttl_used: 命中的答案平均用掉了 TTL 的比例
+    POST ?action=clear 清空缓存库，?action=reset 重置统计
+    """
+    from .answer_cache import get_answer_cache
+
+    answer_cache = get_answer_cache()
+    if request.method == 'GET':
+        return JsonResponse({"code": 200, "data": answer_cache.snapshot()})
+
+    if request.method == 'POST':
+        action = request.GET.get('action')
+        if action == 'clear':
+            answer_cache.clear()
+        elif action == 'reset':
+            answer_cache.stats.reset()
+        else:
+            return JsonResponse({"code": 400, "msg": "action 只支持 clear / reset"})
+        return JsonResponse({"code": 200, "data": answer_cache.snapshot()})
+
+
+@csrf_exempt
+def ops_cancellations(request):
+    """
+    运维接口：前端断开后被取消的运行 (每个 worker 进程各自统计)
+    by_phase: 取消时运行走到哪一步 (model 正在生成 / tools 等工具 / answered 已经答完 / start 还没调模型)
+    tokens_saved_estimate: 按平均每次模型调用的 token 数估算省下的量；http_requests_aborted: 被中止的在途工具请求数
+    POST ?action=reset 重置统计
+    """
+    from .cancellation import cancellation_stats
+
+    if request.method == 'GET':
+        return JsonResponse({"code": 200, "data": cancellation_stats.snapshot()})
+
+    if request.method == 'POST':
+        if request.GET.get('action') != 'reset':
+            return JsonResponse({"code": 400, "msg": "action 只支持 reset"})
+        cancellation_stats.reset()
+        return JsonResponse({"code": 200, "data": cancellation_stats.snapshot()})
+
+
+@csrf_exempt
+def ops_admission(request):
+    """
+    运维接口：聊天接口的准入控制 (admitted / rejected 是当前 worker 进程的统计，active_streams 按后端计数，共享后端时是全部 worker 的)
+    rejected_by_reason: user_rate / global_rate (令牌桶空了)、concurrency (排队超时)、queue_full (排队的请求太多)
+    POST ?action=reset 重置统计
+    """
+    from .admission import get_admission
+
+    admission = get_admission()
+    if request.method == 'GET':
+        return JsonResponse({"code": 200, "data": admission.snapshot()})
+
+    if request.method == 'POST':
+        if request.GET.get('action') != 'reset':
+            return JsonResponse({"code": 400, "msg": "action 只支持 reset"})
+        admission.stats.reset()
+        return JsonResponse({"code": 200, "data": admission.snapshot()})
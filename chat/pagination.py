@@ -0,0 +1,82 @@
+"""
+会话列表的游标 (keyset) 分页
+
+OFFSET 分页越往后翻越慢 (数据库要先数过前面所有行)，COUNT(*) 也要扫全表。这里改成：
+- 按 (created_at, session_id) 倒序，游标就是上一页最后一行的这两个值，下一页直接 WHERE (created_at, session_id) < 游标，
+  配合 (user_id, created_at, session_id) / (created_at, session_id) 索引，翻到第几页都只读 limit 行
+- 总数用缓存的 COUNT (默认 60 秒)，返回里标明 total_is_estimate
+
+游标对前端是不透明的字符串，原样传回即可。
+"""
+import base64
+import hashlib
+from typing import Optional
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+COUNT_CACHE_TTL = 60
+
+
+class InvalidPage(ValueError):
+    pass
+
+
+def encode_cursor(created_at, session_id: str) -> str:
+    raw = f"{created_at.isoformat()}|{session_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        created_at, session_id = raw.split("|", 1)
+        created_at = parse_datetime(created_at)
+    except (ValueError, UnicodeError) as e:
+        raise InvalidPage(f"无效的游标: {cursor}") from e
+    if created_at is None:
+        raise InvalidPage(f"无效的游标: {cursor}")
+    return created_at, session_id
+
+
+def page_size(value, default: int = DEFAULT_PAGE_SIZE) -> int:
+    try:
+        size = int(value) if value else default
+    except (TypeError, ValueError):
+        raise InvalidPage(f"无效的分页大小: {value}")
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def _field(row, name):
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+def keyset_page(queryset, cursor: Optional[str], limit: int) -> dict:
+    """
+    按 created_at、session_id 倒序取一页 (queryset 可以是模型对象，也可以是 .values())
+    返回 {"rows": [...], "next_cursor": str 或 None}
+    """
+    queryset = queryset.order_by("-created_at", "-session_id")
+    if cursor:
+        created_at, session_id = decode_cursor(cursor)
+        # 单独的 created_at <= 游标 让数据库可以直接在索引上定位起点，而不是从头扫过前面所有页
+        queryset = queryset.filter(created_at__lte=created_at).filter(
+            Q(created_at__lt=created_at) | Q(session_id__lt=session_id)
+        )
+    # 多取一条用来判断还有没有下一页
+    rows = list(queryset[: limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "rows": rows,
+        "next_cursor": encode_cursor(_field(rows[-1], "created_at"), _field(rows[-1], "session_id")) if has_more else None,
+    }
+
+
+def cached_count(queryset, ttl: int = COUNT_CACHE_TTL) -> int:
+    """带缓存的 COUNT(*)：同一个查询条件 ttl 秒内只数一次，列表翻页时不用每页都扫一遍"""
+    key = "chat:count:" + hashlib.md5(str(queryset.query).encode("utf-8")).hexdigest()
+    return cache.get_or_set(key, queryset.count, ttl)
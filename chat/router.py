@@ -0,0 +1,311 @@
+"""
+确定性快速路由 (fast path)
+
+System Prompt 里的路由规则大部分是可以用正则判断的：40 位节点号、SPC 开头、BTS3900 开头、HERT BBU 开头、
+hert_bugfix 分支，以及组件 / 产品枚举列表里的名字。对于意图明确的问题，没必要先让 LLM 花一个来回去“选工具”：
+- 用预编译的正则 + 枚举列表的前缀树 (trie) 抽取实体
+- 只有当恰好命中一种意图、参数齐全时，才直接构造 tool_calls 跳到工具节点执行
+- 其余情况 (有歧义、缺参数、闲聊...) 一律交回 LLM，行为和以前完全一样
+- 工具返回后仍由 LLM 组织回答，省掉的是“选工具”那一次模型调用
+
+命中率可以在运维接口 /api/ops/fast-path 查看。配置见 settings.AGENT_FAST_PATH。
+"""
+import logging
+import re
+import threading
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from langchain.agents.middleware import AgentMiddleware, hook_config
+from langchain_core.messages import AIMessage, HumanMessage
+
+from chat.config import get_setting
+from chat.context import context_version, normalize_version
+
+logger = logging.getLogger(__name__)
+
+# --- 实体正则 (和 System Prompt 里的格式规范一一对应) ---
+URL_RE = re.compile(r"https?://[^\s，。,；;]+")
+HERT_VERSION_RE = re.compile(r"HERT BBU\s*V\w+")
+MULTIMODE_RE = re.compile(r"BTS3900[^\s，。,；;]*(?:\s+V\d{3}R\w*)?")
+NODE_ID_RE = re.compile(r"(?<![0-9A-Za-z])[0-9A-Za-z]{40}(?![0-9A-Za-z])")
+V_VERSION_RE = re.compile(r"(?<![0-9A-Za-z])V\d{3}R\d{3}\w*")
+SPC_RE = re.compile(r"(?<![0-9A-Za-z])SPC\d+\w*")
+BRANCH_RE = re.compile(r"hert_bugfix\w*|(?<![\w/:.])[A-Za-z][\w.-]*/[\w./-]+")
+VER_RE = re.compile(r"(?<![0-9A-Za-z])\d{2}[a-z](?![0-9A-Za-z])", re.IGNORECASE)
+MR_KEYWORD_RE = re.compile(r"(?<![A-Za-z])MR(?![A-Za-z])|merge", re.IGNORECASE)
+
+# 超过这个长度的问题通常不是单纯的查询，直接交给 LLM
+MAX_QUERY_CHARS = 200
+
+
+def _is_word_char(ch: str) -> bool:
+    # 只把 ASCII 字母数字当作单词的一部分，中文紧挨着组件名 (如 “查iware的”) 也能匹配
+    return ch.isascii() and (ch.isalnum() or ch == "_")
+
+
+class EnumTrie:
+    """枚举名的前缀树：一次扫描找出文本里出现的所有名字 (不区分大小写，最长匹配，要求单词边界)"""
+
+    _END = "$"
+
+    def __init__(self, words: List[str]):
+        self.root = {}
+        for word in words:
+            node = self.root
+            for ch in word.lower():
+                node = node.setdefault(ch, {})
+            node[self._END] = word
+
+    def find_all(self, text: str) -> List[str]:
+        found = []
+        lowered = text.lower()
+        i, n = 0, len(lowered)
+        while i < n:
+            if i > 0 and _is_word_char(lowered[i - 1]):
+                i += 1
+                continue
+            node, j, match, match_end = self.root, i, None, i
+            while j < n and lowered[j] in node:
+                node = node[lowered[j]]
+                j += 1
+                if self._END in node and (j == n or not _is_word_char(lowered[j])):
+                    match, match_end = node[self._END], j
+            if match is not None:
+                if match not in found:
+                    found.append(match)
+                i = match_end
+            else:
+                i += 1
+        return found
+
+
+class Entities:
+    """从一句话里抽取出来的实体"""
+
+    def __init__(self):
+        self.urls: List[str] = []
+        self.hert_versions: List[str] = []
+        self.multimode: List[str] = []
+        self.node_ids: List[str] = []
+        self.v_versions: List[str] = []
+        self.spc_versions: List[str] = []
+        self.branches: List[str] = []
+        self.vers: List[str] = []
+        self.components: List[str] = []
+        self.products: List[str] = []
+
+    @property
+    def search_keys(self) -> List[str]:
+        """组件 / 产品配套查询的 search 参数：节点号、分支、HERT版本"""
+        return self.node_ids + self.branches + self.hert_versions
+
+
+class Route:
+    def __init__(self, intent: str, tool_calls: List[Dict]):
+        self.intent = intent
+        self.tool_calls = tool_calls
+
+
+def _call(name: str, **args) -> Dict:
+    return {"name": name, "args": args}
+
+
+class FastPathRouter:
+    def __init__(self, components: List[str], products: List[str]):
+        self.components = EnumTrie(components)
+        self.products = EnumTrie(products)
+
+    def extract(self, text: str) -> Entities:
+        entities = Entities()
+        # 按从长到短、从特殊到一般的顺序抽取，抽到的部分用空格盖掉，避免被后面的规则重复匹配
+        # (例如 HERT版本里的 V500R015...SPC1508002 不能再被当成工程名或 SPC 版本)
+        for attr, pattern in (
+            ("urls", URL_RE),
+            ("hert_versions", HERT_VERSION_RE),
+            ("multimode", MULTIMODE_RE),
+            ("node_ids", NODE_ID_RE),
+            ("v_versions", V_VERSION_RE),
+            ("spc_versions", SPC_RE),
+            ("branches", BRANCH_RE),
+            ("vers", VER_RE),
+        ):
+            values = getattr(entities, attr)
+            for m in pattern.finditer(text):
+                if m.group() not in values:
+                    values.append(m.group())
+            text = pattern.sub(lambda m: " " * len(m.group()), text)
+        # 版本号统一成小写 (“24A” 和 “24a” 是同一个版本)
+        entities.vers = list(dict.fromkeys(normalize_version(v) for v in entities.vers))
+        entities.components = self.components.find_all(text)
+        entities.products = self.products.find_all(text)
+        return entities
+
+    def route(self, text: str, default_ver: Optional[str] = None) -> Optional[Route]:
+        """意图明确且参数齐全时返回要直接执行的工具调用，否则返回 None (交给 LLM)"""
+        text = text.strip()
+        if not text or len(text) > MAX_QUERY_CHARS:
+            return None
+        e = self.extract(text)
+
+        # 版本号：用户明确说了就用用户的 (说了多个有歧义)，否则沿用当前上下文版本
+        if len(e.vers) > 1:
+            return None
+        # 分支名里带着版本号 (如 release/24a) 又和明确说的版本对不上：分不清要查哪个版本，交给 LLM
+        embedded = {normalize_version(m.group()) for b in e.branches for m in VER_RE.finditer(b)}
+        if embedded and embedded != set(e.vers):
+            return None
+        ver = e.vers[0] if e.vers else default_ver
+        try:
+            ver = normalize_version(ver)
+        except ValueError:
+            ver = None
+
+        candidates = [route for route in self._candidates(text, e, ver) if route is not None]
+        return candidates[0] if len(candidates) == 1 else None
+
+    def _candidates(self, text: str, e: Entities, ver: Optional[str]):
+        has_enum = bool(e.components or e.products)
+        version_keys = e.v_versions + e.node_ids
+
+        # MR 信息
+        if len(e.urls) == 1 and MR_KEYWORD_RE.search(text):
+            yield Route("mr_info", [_call("query_mr_info", mr_url=e.urls[0])])
+
+        # 多模版本
+        if len(e.multimode) == 1 and not has_enum:
+            yield Route("multimode", [_call("query_version_by_multimode", search=e.multimode[0])])
+
+        if not ver:
+            return
+
+        # 组件 / 产品配套信息：组件名或产品名 + 唯一的节点 / 分支 / HERT版本
+        if has_enum and len(e.search_keys) == 1 and not e.v_versions and not e.spc_versions:
+            key = e.search_keys[0]
+            calls = [_call("query_component_details", ver=ver, search_key=key, component_name=c) for c in e.components]
+            calls += [_call("query_product_details", ver=ver, search_key=key, product=p) for p in e.products]
+            yield Route("matching_details", calls)
+
+        # 组件合入状态
+        if e.components and not e.products and not e.search_keys and "合入" in text:
+            yield Route(
+                "component_merge",
+                [_call("query_component_merge_status", search=c, ver=ver) for c in e.components],
+            )
+
+        if has_enum:
+            return
+
+        # SPC 商用状态
+        if len(e.spc_versions) == 1 and "商用" in text:
+            yield Route("spc_commercial", [_call("query_spc_commercial_status", ver=ver, spc_ver=e.spc_versions[0])])
+
+        # 两个版本之间的合入 / 差异
+        if len(version_keys) == 2 and ("之间" in text or "差异" in text):
+            yield Route(
+                "merge_between",
+                [_call("query_merge_info_between_versions", ver=ver, start_version=version_keys[0], end_version=version_keys[1])],
+            )
+
+        # 版本基本信息
+        basic_keys = e.spc_versions + e.v_versions + e.node_ids + e.hert_versions
+        if len(basic_keys) == 1 and any(k in text for k in ("基本信息", "基础信息", "详细信息", "详情")):
+            yield Route("basic_info", [_call("query_version_basic_info", ver=ver, search=basic_keys[0])])
+
+        # 只需要 ver 的查询
+        if e.hert_versions or version_keys or e.spc_versions or e.urls or e.multimode:
+            return
+        bugfix = [b for b in e.branches if b.startswith("hert_bugfix")]
+        if "镜像" in text and len(bugfix) == 1:
+            yield Route("bugfix_branch", [_call("query_bugfix_branch_info", ver=ver, branch_name=bugfix[0])])
+        if e.branches:
+            return
+        if "主干镜像" in text:
+            yield Route("trunk_mirror", [_call("query_trunk_mirror_info", ver=ver)])
+        if "构建状态" in text or "smartci" in text.lower():
+            yield Route("trunk_build_status", [_call("check_trunk_build_status", ver=ver)])
+        if "推送" in text:
+            yield Route("version_push", [_call("query_version_push_status", ver=ver)])
+        if "hert节点" in text.lower():
+            yield Route("hert_node", [_call("menu_hert_node_on_rn", ver=ver)])
+
+
+class FastPathStats:
+    def __init__(self):
+        self.total = 0
+        self.hits = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, intent: Optional[str]):
+        with self._lock:
+            self.total += 1
+            if intent:
+                self.hits[intent] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            hit_count = sum(self.hits.values())
+            return {
+                "turns": self.total,
+                "fast_path_hits": hit_count,
+                "llm_fallbacks": self.total - hit_count,
+                "hit_rate": round(hit_count / self.total, 4) if self.total else None,
+                "by_intent": dict(self.hits),
+            }
+
+    def reset(self):
+        with self._lock:
+            self.total = 0
+            self.hits.clear()
+
+
+fast_path_stats = FastPathStats()
+
+
+class FastPathRouterMiddleware(AgentMiddleware):
+    """
+    每轮用户提问后、第一次调用模型前执行：意图明确时直接生成 tool_calls 并跳到工具节点，
+    工具执行完再回到模型组织回答；不明确时什么都不做
+    """
+
+    def __init__(self, router: FastPathRouter, enabled: bool = True):
+        super().__init__()
+        self.router = router
+        self.enabled = enabled
+
+    def _route(self, state, runtime) -> Optional[dict]:
+        messages = state["messages"]
+        if not self.enabled or not messages or not isinstance(messages[-1], HumanMessage):
+            return None
+
+        question = messages[-1].content if isinstance(messages[-1].content, str) else messages[-1].text
+        route = self.router.route(question, default_ver=context_version(runtime, default=None))
+        fast_path_stats.record(route.intent if route else None)
+        if route is None:
+            return None
+
+        logger.debug("🚀 [fast-path] 命中 %s: %s", route.intent, [c["name"] for c in route.tool_calls])
+        message = AIMessage(
+            content="",
+            tool_calls=[
+                {**call, "id": f"call_fast_{uuid.uuid4().hex[:12]}", "type": "tool_call"}
+                for call in route.tool_calls
+            ],
+            response_metadata={"fast_path": route.intent},
+        )
+        return {"messages": [message], "jump_to": "tools"}
+
+    @hook_config(can_jump_to=["tools"])
+    def before_model(self, state, runtime):
+        return self._route(state, runtime)
+
+    @hook_config(can_jump_to=["tools"])
+    async def abefore_model(self, state, runtime):
+        return self._route(state, runtime)
+
+
+def build_fast_path_router(components: List[str], products: List[str]) -> FastPathRouterMiddleware:
+    """按 settings.AGENT_FAST_PATH 创建快速路由中间件"""
+    conf = get_setting("AGENT_FAST_PATH", {})
+    return FastPathRouterMiddleware(FastPathRouter(components, products), enabled=conf.get("ENABLED", True))
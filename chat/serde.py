@@ -0,0 +1,180 @@
+"""
+checkpoint 压缩序列化
+
+SqliteSaver 每一步都把完整状态存一份，工具结果 (版本间合入差异、组件配套表，动辄几十 KB) 会在这个会话之后的
+每一个 checkpoint 里原样再出现一次。这里在 JsonPlusSerializer 外面包两层：
+  * 大工具结果去重：ToolMessage 的内容超过 BLOB_MIN_SIZE 时按 xxh3_128 内容哈希存进 blobs 表，
+    checkpoint 里只留一个引用标记；同样的结果不管出现在多少个 checkpoint / 会话里只存一份
+  * zstd 压缩：序列化结果超过 MIN_SIZE 时压缩，类型名加上 "+zstd" 后缀 (和 langgraph 的 "msgpack+aes" 一个写法)；
+    库里有训练好的字典 (manage.py train_checkpoint_dict) 时用字典压缩，帧头里带着字典 ID，解压时按 ID 找字典
+
+读取时两种格式都认，打开压缩之前写入的旧数据照常能读；反过来关掉压缩 (compress_writes=False) 之后新数据按原格式写，
+已经压缩 / 去重过的数据照样能读，不需要迁移。
+"""
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+import xxhash
+import zstandard
+from langchain_core.messages import ToolMessage
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+DEFAULT_COMPRESSION = {
+    "LEVEL": 3,
+    # 序列化结果小于这个字节数就不压缩 (压缩收益抵不过开销)
+    "MIN_SIZE": 512,
+    # 工具结果超过这个字符数才单独存 blob
+    "BLOB_MIN_SIZE": 4096,
+    # 进程内缓存的 blob 个数 (解压后的文本和压缩后的数据)
+    "BLOB_CACHE_SIZE": 256,
+}
+
+ZSTD_SUFFIX = "+zstd"
+# checkpoint 里代替工具结果的引用标记；\x00 开头，正常的工具返回不会长这样
+BLOB_MARKER = "\x00puo-blob:"
+BLOB_REF_RE = re.compile(re.escape(BLOB_MARKER.encode("utf-8")) + rb"([0-9a-f]{32})")
+
+
+def blob_key(text: str) -> str:
+    return xxhash.xxh3_128_hexdigest(text.encode("utf-8"))
+
+
+class CompressedSerializer:
+    """
+    store 需要提供:
+      put_blob(key, data: bytes) / get_blob(key) -> bytes
+      get_dict(dict_id) -> Optional[zstandard.ZstdCompressionDict] / active_dict() -> Optional[...]
+    PooledSqliteSaver 就是它自己 (不管开没开 compression 都套这一层，compress_writes=False 时只负责读)
+    """
+
+    def __init__(self, store, conf: Optional[dict] = None, inner=None, compress_writes: bool = True):
+        conf = {**DEFAULT_COMPRESSION, **(conf or {})}
+        self.store = store
+        self.inner = inner or JsonPlusSerializer()
+        self.compress_writes = compress_writes
+        self.level = conf["LEVEL"]
+        self.min_size = conf["MIN_SIZE"]
+        self.blob_min_size = conf["BLOB_MIN_SIZE"]
+        self._blob_cache_size = conf["BLOB_CACHE_SIZE"]
+        self._blob_cache = OrderedDict()
+        self._blob_lock = threading.Lock()
+        # ZstdCompressor / ZstdDecompressor 不能多线程共用，每个线程各建一份
+        self._local = threading.local()
+
+    # --- zstd ---
+    def _compressor(self) -> zstandard.ZstdCompressor:
+        zdict = self.store.active_dict()
+        cached = getattr(self._local, "compressor", None)
+        if cached is None or cached[0] is not zdict:
+            compressor = zstandard.ZstdCompressor(level=self.level, dict_data=zdict) if zdict else zstandard.ZstdCompressor(level=self.level)
+            cached = self._local.compressor = (zdict, compressor)
+        return cached[1]
+
+    def _decompressor(self, dict_id: int) -> zstandard.ZstdDecompressor:
+        decompressors = getattr(self._local, "decompressors", None)
+        if decompressors is None:
+            decompressors = self._local.decompressors = {}
+        decompressor = decompressors.get(dict_id)
+        if decompressor is None:
+            if dict_id:
+                zdict = self.store.get_dict(dict_id)
+                if zdict is None:
+                    raise ValueError(f"找不到 zstd 字典 {dict_id}，无法解压 checkpoint")
+                decompressor = zstandard.ZstdDecompressor(dict_data=zdict)
+            else:
+                decompressor = zstandard.ZstdDecompressor()
+            decompressors[dict_id] = decompressor
+        return decompressor
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor().compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor(zstandard.get_frame_parameters(data).dict_id).decompress(data)
+
+    # --- 工具结果去重 ---
+    def _remember(self, key: str, text: str, data: bytes):
+        with self._blob_lock:
+            self._blob_cache[key] = (text, data)
+            self._blob_cache.move_to_end(key)
+            while len(self._blob_cache) > self._blob_cache_size:
+                self._blob_cache.popitem(last=False)
+
+    def _cached_blob(self, key: str):
+        with self._blob_lock:
+            return self._blob_cache.get(key)
+
+    def _blob_ref(self, text: str) -> str:
+        key = blob_key(text)
+        cached = self._cached_blob(key)
+        data = cached[1] if cached is not None else self.compress(text.encode("utf-8"))
+        # 进程内缓存里有也要写：库里的这一份可能已经被 GC 当成没人引用删掉了，
+        # 而且每次引用都要刷新 created_at，GC 扫描期间才不会把刚被重新引用的 blob 删掉
+        self.store.put_blob(key, data)
+        if cached is None:
+            self._remember(key, text, data)
+        return BLOB_MARKER + key
+
+    def _blob_text(self, key: str) -> str:
+        cached = self._cached_blob(key)
+        if cached is not None:
+            return cached[0]
+        data = self.store.get_blob(key)
+        text = self.decompress(data).decode("utf-8")
+        self._remember(key, text, data)
+        return text
+
+    def _externalize(self, obj: Any) -> Any:
+        """把大工具结果换成引用，返回新对象，不修改传进来的状态 (它还在被 graph 使用)"""
+        if isinstance(obj, ToolMessage):
+            if isinstance(obj.content, str) and len(obj.content) >= self.blob_min_size:
+                return obj.model_copy(update={"content": self._blob_ref(obj.content)})
+            return obj
+        if isinstance(obj, dict):
+            changed = {k: self._externalize(v) for k, v in obj.items()}
+            return changed if any(changed[k] is not obj[k] for k in obj) else obj
+        if isinstance(obj, (list, tuple)):
+            changed = [self._externalize(v) for v in obj]
+            if all(a is b for a, b in zip(changed, obj)):
+                return obj
+            return type(obj)(changed) if isinstance(obj, tuple) else changed
+        return obj
+
+    def _internalize(self, obj: Any) -> Any:
+        """反序列化出来的对象是新建的，直接原地把引用换回工具结果"""
+        if isinstance(obj, ToolMessage):
+            if isinstance(obj.content, str) and obj.content.startswith(BLOB_MARKER):
+                obj.content = self._blob_text(obj.content[len(BLOB_MARKER):])
+        elif isinstance(obj, dict):
+            for value in obj.values():
+                self._internalize(value)
+        elif isinstance(obj, (list, tuple)):
+            for value in obj:
+                self._internalize(value)
+        return obj
+
+    # --- SerializerProtocol ---
+    def dumps_typed(self, obj: Any) -> Tuple[str, bytes]:
+        if not self.compress_writes:
+            return self.inner.dumps_typed(obj)
+        type_, data = self.inner.dumps_typed(self._externalize(obj))
+        if type_ == "null" or len(data) < self.min_size:
+            return type_, data
+        return type_ + ZSTD_SUFFIX, self.compress(data)
+
+    def loads_typed(self, data: Tuple[str, bytes]) -> Any:
+        type_, payload = data
+        if type_.endswith(ZSTD_SUFFIX):
+            type_, payload = type_[: -len(ZSTD_SUFFIX)], self.decompress(payload)
+        return self._internalize(self.inner.loads_typed((type_, payload)))
+
+    def payload_bytes(self, type_: str, payload: bytes) -> bytes:
+        """压缩前的原始字节 (训练字典 / 扫描 blob 引用时用)"""
+        return self.decompress(payload) if type_ and type_.endswith(ZSTD_SUFFIX) else payload
+
+
+def train_dictionary(samples, size: int = 112640) -> zstandard.ZstdCompressionDict:
+    """用一批未压缩的序列化结果训练 zstd 字典"""
+    return zstandard.train_dictionary(size, list(samples))
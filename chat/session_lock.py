@@ -0,0 +1,142 @@
+"""
+同一个会话同时只跑一轮
+
+用户连发两句话时，两次 graph.stream 会在同一个 thread_id 上并发执行：两边读到同一个父 checkpoint，
+后写的那一轮把先写的覆盖掉，一轮的消息直接丢失，LLM 的活也白干了。现在每一轮运行前先拿到这个会话的运行权:
+  * 运行权是准入控制后端 (chat/admission.py) 里的一个租约，上限为 1：单进程默认后端在进程内生效，
+    多 worker 部署时是共享的 SQLite / Redis 后端，跨进程、跨机器都生效
+  * 租约有过期时间，运行期间由续租线程续期；worker 崩溃后最多 LEASE_TTL 秒自动释放，会话不会被永久锁住
+  * 拿不到时按 MODE 处理：
+      - queue:  先开始推流 (心跳照常发)，在流里等上一轮结束再开始，最多等 WAIT 秒，超时推一条 error 事件
+      - reject: 直接返回 409 + Retry-After，前端提示用户等上一轮回答结束
+  * 运行权在这一轮完全结束之后才释放 (包括前端断开后 checkpoint 的收尾，见 chat/cancellation.py)
+
+配置见 settings.AGENT_SESSION_LOCK。
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+
+from chat.admission import POLL_INTERVAL, Lease, get_admission
+from chat.config import get_setting
+
+DEFAULT_SESSION_LOCK = {
+    "ENABLED": True,
+    # queue: 排队等上一轮结束；reject: 直接拒绝
+    "MODE": "queue",
+    # queue 模式下最多等多少秒
+    "WAIT": 120,
+    # 运行权租约的有效期 (秒)
+    "LEASE_TTL": 30,
+}
+
+
+class SessionBusy(Exception):
+    """这个会话上一轮还没跑完"""
+
+    def __init__(self, retry_after: float = 1.0):
+        super().__init__("该会话的上一轮回答还没有结束，请稍后再试")
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, round(self.retry_after)))
+
+
+class SessionRunLock:
+    def __init__(self, controller, conf: Optional[dict] = None):
+        conf = {**DEFAULT_SESSION_LOCK, **(conf or {})}
+        self.controller = controller
+        self.enabled = conf["ENABLED"]
+        self.mode = conf["MODE"]
+        self.wait = conf["WAIT"]
+        self.lease_ttl = conf["LEASE_TTL"]
+
+    @property
+    def backend(self):
+        return self.controller.backend
+
+    def _slots(self, session_id: str):
+        return [(f"session:{session_id}", 1)]
+
+    def _try(self, session_id: str) -> Optional[Lease]:
+        slots = self._slots(session_id)
+        lease = Lease(self.controller, [key for key, _ in slots], self.lease_ttl)
+        if self.backend.acquire(slots, lease.lease_id, self.lease_ttl):
+            return self.controller.track(lease)
+        return None
+
+    async def _atry(self, session_id: str) -> Optional[Lease]:
+        if self.backend.blocking_io:
+            return await asyncio.to_thread(self._try, session_id)
+        return self._try(session_id)
+
+    def try_acquire(self, session_id: str) -> Optional[Lease]:
+        """
+        在视图里调用：拿到运行权返回租约；拿不到时 reject 模式抛 SessionBusy，queue 模式返回 None (到流里再等)
+        关闭时返回 None，hold() 也不会再等
+        """
+        if not self.enabled:
+            return None
+        lease = self._try(session_id)
+        if lease is None and self.mode == "reject":
+            raise SessionBusy()
+        return lease
+
+    async def atry_acquire(self, session_id: str) -> Optional[Lease]:
+        if not self.enabled:
+            return None
+        lease = await self._atry(session_id)
+        if lease is None and self.mode == "reject":
+            raise SessionBusy()
+        return lease
+
+    @contextmanager
+    def hold(self, session_id: str, lease: Optional[Lease], cancel_token=None):
+        """
+        包住一轮运行 (在推流的 payloads 生成器里)：还没拿到运行权就轮询等待，被取消时不再等；退出时释放
+        等超时抛 SessionBusy，推流那边推一条 error 事件
+        """
+        if lease is None and self.enabled:
+            deadline = time.monotonic() + self.wait
+            while lease is None:
+                if cancel_token is not None:
+                    if cancel_token.wait(POLL_INTERVAL):
+                        cancel_token.raise_if_cancelled()
+                else:
+                    time.sleep(POLL_INTERVAL)
+                lease = self._try(session_id)
+                if lease is None and time.monotonic() >= deadline:
+                    raise SessionBusy()
+        try:
+            yield lease
+        finally:
+            if lease is not None:
+                lease.release()
+
+    @asynccontextmanager
+    async def ahold(self, session_id: str, lease: Optional[Lease]):
+        if lease is None and self.enabled:
+            deadline = time.monotonic() + self.wait
+            while lease is None:
+                await asyncio.sleep(POLL_INTERVAL)
+                lease = await self._atry(session_id)
+                if lease is None and time.monotonic() >= deadline:
+                    raise SessionBusy()
+        try:
+            yield lease
+        finally:
+            if lease is not None:
+                await lease.arelease()
+
+
+_session_lock = None
+
+
+def get_session_lock() -> SessionRunLock:
+    """和准入控制共用同一个后端 (准入控制关掉时后端照样构建，运行权不受 AGENT_ADMISSION.ENABLED 影响)"""
+    global _session_lock
+    if _session_lock is None:
+        _session_lock = SessionRunLock(get_admission(), get_setting("AGENT_SESSION_LOCK", {}))
+    return _session_lock
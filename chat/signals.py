@@ -0,0 +1,27 @@
+"""
+删除会话时的级联清理
+
+ChatSession 被删除 (前端删除会话、Admin 后台删除、清理命令过期删除) 时，
+一并删掉这个会话的聊天记录投影 (ChatMessage) 和 agent_chat_history.db 里的 checkpoint / writes，
+否则 checkpoint 库只增不减。
+"""
+import logging
+
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from chat.models import ChatMessage, ChatSession
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_delete, sender=ChatSession, dispatch_uid="chat.cascade_session_delete")
+def cascade_session_delete(sender, instance, **kwargs):
+    from chat.checkpoint import get_checkpointer
+
+    ChatMessage.objects.filter(session_id=instance.session_id).delete()
+    try:
+        get_checkpointer().delete_thread(instance.session_id)
+    except Exception as e:
+        # checkpoint 删不掉不影响会话删除，剩下的由清理命令 (gc_checkpoints --orphans) 兜底
+        logger.exception("❌ [cascade] 删除会话 %s 的 checkpoint 失败: %s", instance.session_id, e)
@@ -0,0 +1,244 @@
+"""
+后台任务队列 (有界、按 key 去重、攒批执行)
+
+以前每个新会话的第一句话都会 threading.Thread 一个线程去调 LLM 起标题，新会话一多线程数就没有上限，
+而且和主对话抢同一个模型配额。现在统一交给固定数量的 worker 线程：
+- 队列有界：满了直接拒绝 (背压)，标题保持“新对话”，用户下一句话时会再提交一次
+- 按 key (session_id) 去重：排队中 / 执行中的会话不会重复提交
+- 攒批：worker 取到一个任务后再等一小会儿 (BATCH_WAIT)，把同时到达的最多 BATCH_SIZE 个任务合成一次 LLM 调用
+- worker 线程在第一次提交时才启动，fork 出来的子进程会重新启动自己的 worker
+- 多 worker 部署 (settings.AGENT_DEPLOYMENT = "multi") 时配置 SHARED_CACHE：提交前先在共享缓存里 add() 一个
+  认领标记，别的进程已经在处理的会话不再重复起标题；任务执行完删除标记，进程崩溃时标记按 SHARED_TTL 过期
+
+配置见 settings.AGENT_TITLE_WORKER，运行情况见 snapshot()。
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from chat.config import get_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TITLE_WORKER = {
+    "WORKERS": 2,
+    "QUEUE_SIZE": 256,
+    # 一次 LLM 调用最多给几个会话起标题
+    "BATCH_SIZE": 8,
+    # 攒批最多等待的时间 (秒)
+    "BATCH_WAIT": 0.2,
+    # 跨进程去重用的 settings.CACHES 别名，None 表示只在进程内去重
+    "SHARED_CACHE": None,
+    "SHARED_TTL": 300,
+}
+
+
+class BatchTaskQueueStats:
+    def __init__(self):
+        self.submitted = 0
+        self.deduplicated = 0
+        self.shared_deduplicated = 0
+        self.rejected = 0
+        self.batches = 0
+        self.processed = 0
+        self.failed_batches = 0
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "deduplicated": self.deduplicated,
+                "shared_deduplicated": self.shared_deduplicated,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "processed": self.processed,
+                "failed_batches": self.failed_batches,
+                "avg_batch_size": round(self.processed / self.batches, 2) if self.batches else None,
+            }
+
+
+class BatchTaskQueue:
+    """
+    handler 接收一批 [(key, payload), ...]，在 worker 线程里执行
+    同一个 key 在排队或执行期间只会出现一次 (配置了 shared_cache 时跨进程也只有一次)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[List[Tuple[str, object]]], object],
+        workers: int = 2,
+        queue_size: int = 256,
+        batch_size: int = 8,
+        batch_wait: float = 0.2,
+        shared_cache: Optional[str] = None,
+        shared_ttl: float = 300,
+    ):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue_size = queue_size
+        self.shared_alias = shared_cache
+        self.shared_ttl = shared_ttl
+        self.stats = BatchTaskQueueStats()
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_workers(self):
+        # 在锁内调用
+        if self._pid == os.getpid():
+            return
+        if self._pid is not None:
+            # fork 之后父进程的队列、线程都不可用，重新来过
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._pending = set()
+        self._pid = os.getpid()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"{self.name}-worker-{i}", daemon=True).start()
+
+    # --- 跨进程认领 (Django cache) ---
+    @property
+    def shared(self):
+        if not self.shared_alias:
+            return None
+        from django.core.cache import caches
+
+        return caches[self.shared_alias]
+
+    def _claim_key(self, key: str) -> str:
+        return f"chat:task:{self.name}:{key}"
+
+    def _claim(self, key: str) -> bool:
+        """在共享缓存里认领 key，已被别的进程认领时返回 False"""
+        if self.shared is None:
+            return True
+        try:
+            return self.shared.add(self._claim_key(key), os.getpid(), self.shared_ttl)
+        except Exception as e:
+            # 共享缓存挂了退化成进程内去重，最坏情况是同一个会话多起一次标题
+            logger.warning("⚠️ [%s] 共享缓存认领失败: %s", self.name, e)
+            return True
+
+    def _release(self, keys: List[str]) -> None:
+        if self.shared is None or not keys:
+            return
+        try:
+            self.shared.delete_many([self._claim_key(key) for key in keys])
+        except Exception as e:
+            logger.warning("⚠️ [%s] 共享缓存释放失败: %s", self.name, e)
+
+    def submit(self, key: str, payload) -> bool:
+        """提交任务，不等任务执行；重复的 key 和队列已满时返回 False
+
+        配置了共享缓存时要先去认领 key (一次同步 cache I/O)，异步视图里用 asyncio.to_thread 调用。
+        """
+        with self._lock:
+            self._ensure_workers()
+            if key in self._pending:
+                self.stats.incr("deduplicated")
+                return False
+            # 先在进程内占住 key，认领 (网络 I/O) 放到锁外，不挡住其他线程提交
+            self._pending.add(key)
+        if not self._claim(key):
+            self._unpend(key)
+            self.stats.incr("shared_deduplicated")
+            return False
+        try:
+            self._queue.put_nowait((key, payload))
+        except queue.Full:
+            self._unpend(key)
+            self.stats.incr("rejected")
+            logger.warning("⚠️ [%s] 后台队列已满 (%s)，丢弃任务 %s", self.name, self._queue.maxsize, key)
+            self._release([key])
+            return False
+        self.stats.incr("submitted")
+        return True
+
+    def _unpend(self, key: str) -> None:
+        with self._lock:
+            self._pending.discard(key)
+
+    def _next_batch(self) -> List[Tuple[str, object]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        from django.db import close_old_connections
+
+        while True:
+            batch = self._next_batch()
+            try:
+                close_old_connections()
+                self.handler(batch)
+            except Exception as e:
+                self.stats.incr("failed_batches")
+                logger.exception("❌ [%s] 后台任务执行失败: %s", self.name, e)
+            finally:
+                close_old_connections()
+                keys = [key for key, _ in batch]
+                self._release(keys)
+                with self._lock:
+                    self._pending.difference_update(keys)
+                self.stats.incr("batches")
+                self.stats.incr("processed", len(batch))
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def snapshot(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "shared_cache": self.shared_alias,
+            "queued": self._queue.qsize(),
+            "pending": self.pending_count(),
+            **self.stats.snapshot(),
+        }
+
+
+def _generate_titles(batch):
+    from chat.llm import generate_and_update_titles
+
+    generate_and_update_titles(batch)
+
+
+def build_title_queue(conf: Optional[dict] = None) -> BatchTaskQueue:
+    """按 settings.AGENT_TITLE_WORKER 创建标题生成队列"""
+    conf = {**DEFAULT_TITLE_WORKER, **(conf if conf is not None else get_setting("AGENT_TITLE_WORKER", {}))}
+    return BatchTaskQueue(
+        "title",
+        _generate_titles,
+        workers=conf["WORKERS"],
+        queue_size=conf["QUEUE_SIZE"],
+        batch_size=conf["BATCH_SIZE"],
+        batch_wait=conf["BATCH_WAIT"],
+        shared_cache=conf["SHARED_CACHE"],
+        shared_ttl=conf["SHARED_TTL"],
+    )
+
+
+title_queue = build_title_queue()
@@ -0,0 +1,96 @@
+"""
+测试 / 压测用的替身对象
+
+StubChatModel 是一个确定性的假 LLM：不发任何网络请求，按配置的延迟逐字吐出固定回复，
+可选地在一轮对话的第一次调用时先发起工具调用。用来在没有 DeepSeek Key 的环境里
+跑通 Agent 全流程，以及在压测里把 LLM 的耗时固定下来。
+"""
+import asyncio
+import json
+import time
+import uuid
+from typing import Any, Dict, List
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+class StubChatModel(BaseChatModel):
+    # 最终回复内容 (按字切分流式输出，模拟中文 token)
+    reply: str = "已查询到数据，当前版本构建正常。"
+    # 首 token 延迟 (秒)，模拟 LLM 排队 + prefill
+    first_token_delay: float = 0.0
+    # 后续每个 token 的间隔 (秒)
+    token_delay: float = 0.0
+    # 一轮对话中第一次调用模型时要发起的工具调用，例如 [{"name": "check_trunk_build_status", "args": {"ver": "24a"}}]
+    tool_calls: List[Dict[str, Any]] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub-chat-model"
+
+    def bind_tools(self, tools, **kwargs):
+        # 假模型不需要真的绑定工具 schema
+        return self
+
+    # --- 决定这一次调用是“调工具”还是“直接回答” ---
+    def _should_call_tools(self, messages: List[BaseMessage]) -> bool:
+        # 末尾的环境感知 SystemMessage 不算，看最后一条对话消息是不是用户提问
+        conversation = [m for m in messages if not isinstance(m, SystemMessage)]
+        return bool(self.tool_calls) and bool(conversation) and isinstance(conversation[-1], HumanMessage)
+
+    def _tool_call_message(self) -> AIMessage:
+        return AIMessage(
+            content="",
+            tool_calls=[
+                {"name": c["name"], "args": c.get("args", {}), "id": f"call_{uuid.uuid4().hex[:12]}", "type": "tool_call"}
+                for c in self.tool_calls
+            ],
+        )
+
+    def _tool_call_chunk(self) -> AIMessageChunk:
+        message = self._tool_call_message()
+        return AIMessageChunk(
+            content="",
+            tool_call_chunks=[
+                {"name": c["name"], "args": json.dumps(c["args"], ensure_ascii=False), "id": c["id"], "index": i}
+                for i, c in enumerate(message.tool_calls)
+            ],
+        )
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.first_token_delay + self.token_delay * max(len(self.reply) - 1, 0))
+        message = self._tool_call_message() if self._should_call_tools(messages) else AIMessage(content=self.reply)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.first_token_delay + self.token_delay * max(len(self.reply) - 1, 0))
+        message = self._tool_call_message() if self._should_call_tools(messages) else AIMessage(content=self.reply)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.first_token_delay)
+        if self._should_call_tools(messages):
+            yield ChatGenerationChunk(message=self._tool_call_chunk())
+            return
+        for i, token in enumerate(self.reply):
+            if i:
+                time.sleep(self.token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.first_token_delay)
+        if self._should_call_tools(messages):
+            yield ChatGenerationChunk(message=self._tool_call_chunk())
+            return
+        for i, token in enumerate(self.reply):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
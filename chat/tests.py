@@ -1,3 +1,1124 @@
-from django.test import TestCase
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import traceback
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+# 多 worker 部署测试里交替处理同一个会话的轮数 (两个进程各跑一半)
+INTERLEAVED_TURNS = 8
+# 每个进程同时在自己的会话上跑的轮数，和交替的那个会话抢同一个 SQLite 文件的写锁
+PRIVATE_TURNS = 6
+
+
+def _interleaved_worker(worker, tmp, thread_id, turn_done, errors):
+    """
+    子进程 (spawn 启动，环境变量里已经选好了 AGENT_DEPLOYMENT=multi)
+    第 worker, worker+2, ... 轮由这个进程处理，每一轮都要等上一轮 (另一个进程) 写完
+    """
+    try:
+        import django
+        from django.conf import settings
+
+        settings.DATABASES["default"]["NAME"] = os.path.join(tmp, f"worker{worker}.sqlite3")
+        django.setup()
+        from django.core.management import call_command
+
+        call_command("migrate", verbosity=0)
+
+        from chat.agents import registry
+        from chat.graph import build_agent
+        from chat.testing import StubChatModel
+
+        saver = registry.get("checkpointer")
+        assert saver.batch_size == 1, "multi 模式下 SQLite 存储器应当直接落盘"
+        agent = build_agent(
+            StubChatModel(
+                reply=f"worker{worker} 的回复",
+                tool_calls=[{"name": "check_trunk_build_status", "args": {"ver": "24a"}}],
+            ),
+            saver,
+        )
+
+        def private_turns():
+            config = {"configurable": {"thread_id": f"{thread_id}-private-{worker}"}}
+            for turn in range(PRIVATE_TURNS):
+                agent.invoke({"messages": [("user", f"私有第 {turn} 轮")]}, config)
+
+        background = threading.Thread(target=private_turns)
+        background.start()
+        config = {"configurable": {"thread_id": thread_id}}
+        for turn in range(worker, INTERLEAVED_TURNS, 2):
+            if turn and not turn_done[turn - 1].wait(60):
+                raise TimeoutError(f"等待第 {turn - 1} 轮超时")
+            agent.invoke({"messages": [("user", f"第 {turn} 轮")]}, config)
+            turn_done[turn].set()
+        background.join()
+    except BaseException:
+        errors.put(f"worker{worker}:\n{traceback.format_exc()}")
+        raise
+
+
+# 并发打同一个会话的压测：每个进程同时发起的轮数
+PARALLEL_TURNS_PER_WORKER = 4
+
+
+def _parallel_turns_worker(worker, tmp, session_id, ready, go, errors):
+    """子进程：同时对同一个 session_id 发起几轮 /api/chat，每一轮都要完整跑完、没有 error 事件"""
+    try:
+        import django
+        from django.conf import settings
+
+        settings.DATABASES["default"]["NAME"] = os.path.join(tmp, f"worker{worker}.sqlite3")
+        django.setup()
+        from django.core.management import call_command
+
+        call_command("migrate", verbosity=0)
+
+        from django.test import Client
+
+        from chat.agents import registry
+        from chat.graph import build_agent
+        from chat.testing import StubChatModel
+
+        model = StubChatModel(
+            reply=f"worker{worker} 的回复",
+            first_token_delay=0.02,
+            token_delay=0.002,
+            tool_calls=[{"name": "check_trunk_build_status", "args": {"ver": "24a"}}],
+        )
+        registry.register("graph", lambda: build_agent(model, registry.get("checkpointer")))
+        registry.get("graph")
+
+        def turn(i):
+            try:
+                response = Client(HTTP_HOST="127.0.0.1").post(
+                    "/api/chat",
+                    json.dumps({"query": f"worker{worker} 第 {i} 轮", "session_id": session_id}),
+                    content_type="application/json",
+                )
+                assert response.status_code == 200, response.status_code
+                body = b"".join(response.streaming_content)
+                response.close()
+                assert body.endswith(b"data: [DONE]\n\n") and b'"type":"error"' not in body, body[-200:]
+            except BaseException:
+                errors.put(f"worker{worker} 第 {i} 轮:\n{traceback.format_exc()}")
+
+        ready.set()
+        if not go.wait(60):
+            raise TimeoutError("等待开始信号超时")
+        threads = [threading.Thread(target=turn, args=(i,)) for i in range(PARALLEL_TURNS_PER_WORKER)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    except BaseException:
+        errors.put(f"worker{worker}:\n{traceback.format_exc()}")
+        raise
+
+
+class MultiWorkerCheckpointTests(SimpleTestCase):
+    """两个 worker 进程交替处理同一个 thread_id 的对话，checkpoint 不丢、不分叉、都能正常读出"""
+
+    def test_two_processes_interleave_turns_on_same_thread(self):
+        from chat.checkpoint import PooledSqliteSaver
+
+        ctx = multiprocessing.get_context("spawn")
+        thread_id = "multi-worker-session"
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "agent_chat_history.db")
+            env = {
+                "AGENT_DEPLOYMENT": "multi",
+                "AGENT_CHECKPOINT_PATH": path,
+                "AGENT_SHARED_CACHE_DIR": os.path.join(tmp, "shared_cache"),
+            }
+            turn_done = [ctx.Event() for _ in range(INTERLEAVED_TURNS)]
+            errors = ctx.Queue()
+            workers = [
+                ctx.Process(target=_interleaved_worker, args=(i, tmp, thread_id, turn_done, errors))
+                for i in range(2)
+            ]
+            # spawn 出来的子进程重新加载 settings，按这里的环境变量选中 multi 部署模式
+            with mock.patch.dict(os.environ, env):
+                for process in workers:
+                    process.start()
+            for process in workers:
+                process.join(120)
+            failures = []
+            while not errors.empty():
+                failures.append(errors.get())
+            self.assertEqual(failures, [])
+            self.assertEqual([p.exitcode for p in workers], [0, 0])
+
+            saver = PooledSqliteSaver(path, compression={})
+            try:
+                config = {"configurable": {"thread_id": thread_id}}
+                messages = saver.get_tuple(config).checkpoint["channel_values"]["messages"]
+                self.assertEqual(
+                    [m.content for m in messages if m.type == "human"],
+                    [f"第 {turn} 轮" for turn in range(INTERLEAVED_TURNS)],
+                )
+                # 每一轮: 提问 -> 工具调用 -> 工具结果 -> 回答，回答来自处理这一轮的进程
+                self.assertEqual(len(messages), 4 * INTERLEAVED_TURNS)
+                self.assertEqual(
+                    [m.content for m in messages if m.type == "ai" and not m.tool_calls],
+                    [f"worker{turn % 2} 的回复" for turn in range(INTERLEAVED_TURNS)],
+                )
+
+                # checkpoint 链完整：只有一个起点，每个 parent 都存在，没有两个 checkpoint 接在同一个 parent 后面
+                checkpoints = list(saver.list(config))
+                ids = {c.config["configurable"]["checkpoint_id"] for c in checkpoints}
+                parents = [c.parent_config["configurable"]["checkpoint_id"] for c in checkpoints if c.parent_config]
+                self.assertEqual(len(parents), len(checkpoints) - 1)
+                self.assertLessEqual(set(parents), ids)
+                self.assertEqual(len(parents), len(set(parents)))
+                self.assertEqual(sum(c.metadata["source"] == "input" for c in checkpoints), INTERLEAVED_TURNS)
+
+                for worker in range(2):
+                    private = {"configurable": {"thread_id": f"{thread_id}-private-{worker}"}}
+                    messages = saver.get_tuple(private).checkpoint["channel_values"]["messages"]
+                    self.assertEqual(len(messages), 4 * PRIVATE_TURNS)
+            finally:
+                saver.pool.close()
+
+
+class CheckpointFlushTests(TransactionTestCase):
+    """批量刷盘失败时，缓冲区里的 checkpoint 不能丢"""
+
+    def test_failed_flush_keeps_batch_and_raises(self):
+        import sqlite3
+
+        from chat.checkpoint import PooledSqliteSaver
+        from chat.models import ChatMessage
+        from chat.graph import build_agent
+        from chat.testing import StubChatModel
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # flush_interval 设得很大：只测读之前的同步刷盘，后台刷盘线程不参与
+            saver = PooledSqliteSaver(os.path.join(tmp, "checkpoints.db"), batch_size=1000, flush_interval=60)
+            try:
+                agent = build_agent(StubChatModel(reply="构建成功"), saver)
+                config = {"configurable": {"thread_id": "flush-failure"}}
+                agent.invoke({"messages": [("user", "24a 构建状态")]}, config)
+
+                with mock.patch.object(saver, "cursor", side_effect=sqlite3.OperationalError("disk I/O error")):
+                    with self.assertRaises(sqlite3.OperationalError):
+                        saver.get_tuple(config)
+                self.assertIn("flush-failure", saver._dirty)
+
+                messages = saver.get_tuple(config).checkpoint["channel_values"]["messages"]
+                self.assertEqual([m.type for m in messages], ["human", "ai", "tool", "ai"])
+                self.assertEqual(messages[-1].content, "构建成功")
+                self.assertEqual(saver._pending, [])
+                # 跑的是完整的 Agent，TranscriptMiddleware 的投影也要真的写进去 (写失败只记日志，不检查就发现不了)
+                roles = ChatMessage.objects.filter(session_id="flush-failure").order_by("id").values_list("role", flat=True)
+                self.assertEqual(list(roles), ["user", "ai"])
+            finally:
+                saver.pool.close()
+
+
+class CheckpointBlobTests(SimpleTestCase):
+    """压缩序列化：大工具结果去重存 blobs 表；GC 删掉没人引用的 blob 之后，同样的结果再次出现要重新写入"""
+
+    BIG_RESULT = "组件配套信息\n" + "iware 24a release/24a 已合入\n" * 400
+
+    def setUp(self):
+        from chat.checkpoint import PooledSqliteSaver
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "checkpoints.db")
+        self.saver = PooledSqliteSaver(self.path, compression={}, flush_interval=60)
+        self.addCleanup(self.saver.pool.close)
+
+    def _write(self, saver, thread_id):
+        from langchain_core.messages import ToolMessage
+        from langgraph.checkpoint.base import empty_checkpoint
+
+        checkpoint = empty_checkpoint()
+        checkpoint["channel_values"] = {
+            "messages": [ToolMessage(content=self.BIG_RESULT, name="query_component_details", tool_call_id="call_1")],
+        }
+        saver.put({"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}}, checkpoint, {}, {})
+        saver.flush()
+
+    def _read(self, saver, thread_id):
+        config = {"configurable": {"thread_id": thread_id}}
+        return saver.get_tuple(config).checkpoint["channel_values"]["messages"][0].content
+
+    def _blob_count(self):
+        with self.saver.pool.connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+
+    def test_large_tool_results_are_stored_once_and_compressed(self):
+        from chat.checkpoint import PooledSqliteSaver
+
+        self._write(self.saver, "a")
+        self._write(self.saver, "b")
+        self.assertEqual(self._blob_count(), 1)
+        with self.saver.pool.connection() as conn:
+            size = conn.execute("SELECT LENGTH(checkpoint) FROM checkpoints LIMIT 1").fetchone()[0]
+        self.assertLess(size, len(self.BIG_RESULT.encode("utf-8")) // 10)
+
+        reader = PooledSqliteSaver(self.path, compression={})
+        try:
+            self.assertEqual(self._read(reader, "b"), self.BIG_RESULT)
+        finally:
+            reader.pool.close()
+
+    def test_compressed_data_stays_readable_with_compression_off(self):
+        from chat.checkpoint import PooledSqliteSaver
+
+        self._write(self.saver, "a")
+        plain = PooledSqliteSaver(self.path, compression=None)
+        try:
+            self.assertEqual(self._read(plain, "a"), self.BIG_RESULT)
+            # 关掉之后新写入的按原格式存，不再压缩 / 去重
+            self._write(plain, "b")
+            self.assertEqual(self._read(plain, "b"), self.BIG_RESULT)
+            with plain.pool.connection() as conn:
+                type_ = conn.execute("SELECT type FROM checkpoints WHERE thread_id = 'b'").fetchone()[0]
+            self.assertFalse(type_.endswith("+zstd"))
+        finally:
+            plain.pool.close()
+
+    def test_blob_reused_after_sweep_is_written_again(self):
+        from chat.checkpoint import PooledSqliteSaver
+        from chat.maintenance import CheckpointGC
+
+        self._write(self.saver, "a")
+        self.saver.delete_thread("a")
+        self.assertEqual(CheckpointGC(self.saver, {}).sweep_blobs(0), 1)
+        # 同一个进程里再次出现同样的结果：进程内缓存里还有，但库里已经被删了
+        self._write(self.saver, "b")
+        self.assertEqual(self._read(self.saver, "b"), self.BIG_RESULT)
+
+        # 别的 worker / 重启之后的进程只能从库里读
+        reader = PooledSqliteSaver(self.path, compression={})
+        try:
+            self.assertEqual(self._read(reader, "b"), self.BIG_RESULT)
+        finally:
+            reader.pool.close()
+
+    def test_blob_referenced_during_sweep_scan_is_kept(self):
+        from chat.checkpoint import PooledSqliteSaver
+        from chat.maintenance import CheckpointGC
+
+        self._write(self.saver, "a")
+        self.saver.delete_thread("a")
+        gc = CheckpointGC(self.saver, {})
+        scan = gc.referenced_blobs
+
+        def scan_while_writing():
+            refs = scan()
+            # 扫描完、删除之前，在线的对话又写入了同样的工具结果
+            self._write(self.saver, "b")
+            return refs
+
+        with mock.patch.object(gc, "referenced_blobs", side_effect=scan_while_writing):
+            self.assertEqual(gc.sweep_blobs(0), 0)
+        reader = PooledSqliteSaver(self.path, compression={})
+        try:
+            self.assertEqual(self._read(reader, "b"), self.BIG_RESULT)
+        finally:
+            reader.pool.close()
+
+
+class CheckpointGCTests(TransactionTestCase):
+    """checkpoint 保留策略：每个会话只留最新几个、过期 / 孤儿会话整段删除、没人引用的 blob 清掉，在线写入不受影响"""
+
+    BIG_RESULT = CheckpointBlobTests.BIG_RESULT
+
+    def setUp(self):
+        import time
+
+        from chat.checkpoint import PooledSqliteSaver
+        from chat.maintenance import CheckpointGC
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "checkpoints.db")
+        self.saver = PooledSqliteSaver(self.path, compression={}, flush_interval=60)
+        self.addCleanup(self.saver.pool.close)
+        self.addCleanup(self.saver.flush)
+        self.gc = CheckpointGC(self.saver, {"BLOB_MIN_AGE": 0})
+        self.now = time.time()
+
+    def _put(self, thread_id, at, content="24a 主干构建成功", flush=True):
+        """在 at 时刻写一个 checkpoint (带一条 pending write)，返回它的 checkpoint_id"""
+        from langchain_core.messages import ToolMessage
+        from langgraph.checkpoint.base import empty_checkpoint
+
+        from chat.maintenance import checkpoint_id_at
+
+        checkpoint = empty_checkpoint()
+        checkpoint["id"] = checkpoint_id_at(at)
+        checkpoint["channel_values"] = {
+            "messages": [ToolMessage(content=content, name="query_component_details", tool_call_id="call_1")],
+        }
+        config = self.saver.put({"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}}, checkpoint, {}, {})
+        self.saver.put_writes(config, [("messages", "pending")], task_id="task-1")
+        if flush:
+            self.saver.flush()
+        return checkpoint["id"]
+
+    def _rows(self, table):
+        self.saver.flush()
+        with self.saver.pool.connection() as conn:
+            return conn.execute(
+                f"SELECT thread_id, checkpoint_id FROM {table} ORDER BY thread_id, checkpoint_id"
+            ).fetchall()
+
+    def _run(self, **kwargs):
+        return self.gc.run(**{"keep": 0, "idle_days": 0, "orphans": False, "vacuum": False, **kwargs})
+
+    def test_prune_keeps_latest_checkpoints_and_their_writes(self):
+        ids = {thread: [self._put(thread, self.now - 60 + i) for i in range(5)] for thread in ("a", "b")}
+        report = self._run(keep=2)
+
+        kept = [(thread, cid) for thread in ("a", "b") for cid in ids[thread][-2:]]
+        self.assertEqual(self._rows("checkpoints"), kept)
+        self.assertEqual(self._rows("writes"), kept)
+        self.assertEqual(report.threads, 2)
+        self.assertEqual(report.checkpoints_deleted, 6)
+        self.assertEqual(report.writes_deleted, 6)
+        latest = self.saver.get_tuple({"configurable": {"thread_id": "a"}})
+        self.assertEqual(latest.checkpoint["id"], ids["a"][-1])
+
+    def test_idle_threads_expire_with_their_sessions(self):
+        from chat.models import ChatMessage, ChatSession
+
+        for thread, age_days in (("idle", 40), ("active", 1)):
+            ChatSession.objects.create(session_id=thread, user_id="alice")
+            ChatMessage.objects.create(session_id=thread, message_id="m1", role="user", content="24a 构建状态")
+            self._put(thread, self.now - age_days * 86400 - 60)
+            self._put(thread, self.now - age_days * 86400)
+
+        self.assertEqual(self.gc.idle_thread_ids(30), ["idle"])
+        report = self._run(idle_days=30, delete_sessions=True)
+
+        self.assertEqual({thread for thread, _ in self._rows("checkpoints")}, {"active"})
+        self.assertEqual({thread for thread, _ in self._rows("writes")}, {"active"})
+        self.assertEqual((report.threads_expired, report.checkpoints_deleted, report.sessions_deleted), (1, 2, 1))
+        self.assertEqual(list(ChatSession.objects.values_list("session_id", flat=True)), ["active"])
+        self.assertFalse(ChatMessage.objects.filter(session_id="idle").exists())
+
+    def test_orphan_threads_are_deleted(self):
+        from chat.models import ChatSession
+
+        ChatSession.objects.create(session_id="kept", user_id="alice")
+        for thread in ("kept", "orphan"):
+            self._put(thread, self.now)
+
+        report = self._run(orphans=True)
+        self.assertEqual(report.orphans_deleted, 1)
+        self.assertEqual([thread for thread, _ in self._rows("checkpoints")], ["kept"])
+
+    def test_sweep_removes_only_unreferenced_blobs(self):
+        self._put("dead", self.now - 60, content=self.BIG_RESULT + "旧版本")
+        self._put("live", self.now - 60, content=self.BIG_RESULT)
+        self.saver.delete_thread("dead")
+        # 还在写缓冲区里、没有落盘的 checkpoint 引用的 blob 也不能删
+        self._put("pending", self.now, content=self.BIG_RESULT + "新版本", flush=False)
+        self.assertTrue(self.saver._pending)
+
+        report = self._run()
+        self.assertEqual(report.blobs_deleted, 1)
+        with self.saver.pool.connection() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0], 2)
+
+    def test_sweep_alongside_live_writer(self):
+        from chat.checkpoint import PooledSqliteSaver
+
+        # 在线对话删掉上一个会话、再写同样的大工具结果 (中间有一段时间这个 blob 没人引用)，GC 同时反复清理 blob
+        writer_done = threading.Event()
+        errors = []
+
+        def writer():
+            try:
+                for i in range(40):
+                    if i:
+                        self.saver.delete_thread(f"w{i - 1}")
+                    self._put(f"w{i}", self.now + i, content=self.BIG_RESULT, flush=False)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                writer_done.set()
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        sweeps = 0
+        while not writer_done.is_set() or sweeps == 0:
+            self.gc.sweep_blobs(0)
+            sweeps += 1
+        thread.join()
+        self.assertEqual(errors, [])
+
+        self.saver.flush()
+        reader = PooledSqliteSaver(self.path, compression={})
+        try:
+            latest = reader.get_tuple({"configurable": {"thread_id": "w39"}})
+            self.assertEqual(latest.checkpoint["channel_values"]["messages"][0].content, self.BIG_RESULT)
+        finally:
+            reader.pool.close()
+
+
+class SessionRunLockTests(SimpleTestCase):
+    """两个 worker 进程同时对同一个会话各发起几轮对话，运行权把它们排成一队，一条消息都不丢"""
+
+    def test_parallel_turns_on_one_session_keep_every_message(self):
+        from chat.checkpoint import PooledSqliteSaver
+
+        ctx = multiprocessing.get_context("spawn")
+        session_id = "parallel-session"
+        total = 2 * PARALLEL_TURNS_PER_WORKER
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "agent_chat_history.db")
+            env = {
+                "AGENT_DEPLOYMENT": "multi",
+                "AGENT_CHECKPOINT_PATH": path,
+                "AGENT_SHARED_CACHE_DIR": os.path.join(tmp, "shared_cache"),
+                "AGENT_ADMISSION_PATH": os.path.join(tmp, "agent_admission.db"),
+                # 只测会话运行权：同一个 IP 的并发流上限 / 限速不参与
+                "AGENT_ADMISSION_ENABLED": "0",
+                "AGENT_ANSWER_CACHE_ENABLED": "0",
+                "AGENT_SESSION_LOCK_MODE": "queue",
+            }
+            ready = [ctx.Event() for _ in range(2)]
+            go = ctx.Event()
+            errors = ctx.Queue()
+            workers = [
+                ctx.Process(target=_parallel_turns_worker, args=(i, tmp, session_id, ready[i], go, errors))
+                for i in range(2)
+            ]
+            with mock.patch.dict(os.environ, env):
+                for process in workers:
+                    process.start()
+            for event in ready:
+                event.wait(120)
+            go.set()
+            for process in workers:
+                process.join(120)
+            failures = []
+            while not errors.empty():
+                failures.append(errors.get())
+            self.assertEqual(failures, [])
+            self.assertEqual([p.exitcode for p in workers], [0, 0])
+
+            saver = PooledSqliteSaver(path, compression={})
+            try:
+                config = {"configurable": {"thread_id": session_id}}
+                messages = saver.get_tuple(config).checkpoint["channel_values"]["messages"]
+                # 每一轮: 提问 -> 工具调用 -> 工具结果 -> 回答，没有哪一轮被别的轮覆盖
+                self.assertEqual(len(messages), 4 * total)
+                self.assertEqual(
+                    sorted(m.content for m in messages if m.type == "human"),
+                    sorted(f"worker{w} 第 {i} 轮" for w in range(2) for i in range(PARALLEL_TURNS_PER_WORKER)),
+                )
+                # 轮与轮之间没有交错：每个提问后面紧跟着它自己的三条消息
+                for start in range(0, len(messages), 4):
+                    turn = messages[start:start + 4]
+                    self.assertEqual([m.type for m in turn], ["human", "ai", "tool", "ai"])
+                    worker = turn[0].content.split(" ")[0]
+                    self.assertEqual(turn[3].content, f"{worker} 的回复")
+
+                checkpoints = list(saver.list(config))
+                parents = [c.parent_config["configurable"]["checkpoint_id"] for c in checkpoints if c.parent_config]
+                self.assertEqual(len(parents), len(set(parents)))
+                self.assertEqual(sum(c.metadata["source"] == "input" for c in checkpoints), total)
+            finally:
+                saver.pool.close()
+
+
+class ToolResultCacheTests(SimpleTestCase):
+    """工具结果缓存：同一个 key 的并发请求合并，失败结果不缓存，发起方被取消时不连累其他会话"""
+
+    def _wait_coalesced(self, cache, tool_name, count):
+        for _ in range(200):
+            if cache.stats.snapshot()["tools"].get(tool_name, {}).get("coalesced", 0) >= count:
+                return
+            threading.Event().wait(0.01)
+        self.fail("等待方没有合并到在途的请求上")
+
+    def test_concurrent_identical_calls_query_once(self):
+        from chat.tools.cache import ToolResultCache
+
+        cache = ToolResultCache({"DEFAULT_TTL": 60})
+        release = threading.Event()
+        calls = []
+
+        def query(ver):
+            calls.append(ver)
+            release.wait(5)
+            return f"{ver.strip()} 构建成功"
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                cache.call("check_trunk_build_status", query, (), {"ver": " 24a "})
+            ))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        self._wait_coalesced(cache, "check_trunk_build_status", 3)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(results, ["24a 构建成功"] * 4)
+        self.assertEqual(calls, [" 24a "])
+        # 参数规范化之后是同一个 key，后面的调用直接命中
+        self.assertEqual(cache.call("check_trunk_build_status", query, (), {"ver": "24a"}), "24a 构建成功")
+        stats = cache.stats.snapshot()["tools"]["check_trunk_build_status"]
+        self.assertEqual((stats["misses"], stats["coalesced"], stats["local_hits"]), (1, 3, 1))
+
+    def test_failures_are_not_cached(self):
+        from chat.tools.cache import ToolResultCache
+        from chat.tools.http_client import FAILURE_PREFIX
+
+        cache = ToolResultCache({"DEFAULT_TTL": 60})
+        replies = [f"{FAILURE_PREFIX}cid-service 超时", "24a 构建成功"]
+
+        def query(ver):
+            return replies.pop(0)
+
+        self.assertTrue(cache.call("check_trunk_build_status", query, (), {"ver": "24a"}).startswith(FAILURE_PREFIX))
+        self.assertEqual(cache.call("check_trunk_build_status", query, (), {"ver": "24a"}), "24a 构建成功")
+        self.assertEqual(cache.call("check_trunk_build_status", query, (), {"ver": "24a"}), "24a 构建成功")
+
+    def test_waiter_retries_when_leader_is_cancelled(self):
+        from chat.cancellation import CancelToken, RunCancelled, bind_cancel_token, current_cancel_token
+        from chat.tools.cache import ToolResultCache
+
+        cache = ToolResultCache({"DEFAULT_TTL": 60})
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def query(ver):
+            calls.append(ver)
+            started.set()
+            release.wait(5)
+            current_cancel_token().raise_if_cancelled()
+            return f"{ver} 构建成功"
+
+        leader_token, waiter_token = CancelToken("leader"), CancelToken("waiter")
+        results = {}
+
+        def run(name, token):
+            with bind_cancel_token(token):
+                try:
+                    results[name] = cache.call("check_trunk_build_status", query, (), {"ver": "24a"})
+                except RunCancelled as e:
+                    results[name] = e
+
+        leader = threading.Thread(target=run, args=("leader", leader_token))
+        leader.start()
+        started.wait(5)
+        waiter = threading.Thread(target=run, args=("waiter", waiter_token))
+        waiter.start()
+        self._wait_coalesced(cache, "check_trunk_build_status", 1)
+        leader_token.cancel()
+        release.set()
+        leader.join(5)
+        waiter.join(5)
+
+        self.assertIsInstance(results["leader"], RunCancelled)
+        self.assertEqual(results["waiter"], "24a 构建成功")
+        self.assertEqual(calls, ["24a", "24a"])
+
+    def test_cancelled_waiter_propagates_leader_cancellation(self):
+        from chat.cancellation import CancelToken, RunCancelled, bind_cancel_token
+        from chat.tools.cache import ToolResultCache
+
+        cache = ToolResultCache({"DEFAULT_TTL": 60})
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def query(ver):
+            calls.append(ver)
+            started.set()
+            release.wait(5)
+            raise RunCancelled("client_disconnected")
+
+        token = CancelToken("waiter")
+        results = {}
+
+        def waiter():
+            with bind_cancel_token(token):
+                try:
+                    results["waiter"] = cache.call("check_trunk_build_status", query, (), {"ver": "24a"})
+                except RunCancelled as e:
+                    results["waiter"] = e
+
+        leader = threading.Thread(target=lambda: self.assertRaises(
+            RunCancelled, cache.call, "check_trunk_build_status", query, (), {"ver": "24a"}
+        ))
+        leader.start()
+        started.wait(5)
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        self._wait_coalesced(cache, "check_trunk_build_status", 1)
+        token.cancel()
+        release.set()
+        leader.join(5)
+        thread.join(5)
+
+        self.assertIsInstance(results["waiter"], RunCancelled)
+        self.assertEqual(calls, ["24a"])
+
+
+class AnswerCacheTests(SimpleTestCase):
+    """语义答案缓存：按签名和问法命中，过期不回放，工具查询失败的回答不缓存"""
+
+    def setUp(self):
+        from chat.answer_cache import AnswerCache
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = AnswerCache({"PATH": os.path.join(tmp.name, "answer_cache.db")})
+        self.addCleanup(self.cache.pool.close)
+
+    def test_store_and_lookup_by_signature_and_wording(self):
+        key = self.cache.key_for("24a 主干构建状态", None)
+        self.cache.store(key, "24a 主干构建状态", "24a 主干构建成功", key.tools)
+
+        cached = self.cache.lookup(self.cache.key_for("帮我查一下 24a 的主干构建状态", None))
+        self.assertEqual(cached.answer, "24a 主干构建成功")
+        self.assertEqual(cached.tools, ["check_trunk_build_status"])
+        # 版本不同，工具调用的签名就不同
+        self.assertIsNone(self.cache.lookup(self.cache.key_for("25a 主干构建状态", None)))
+        # 快速路由解析不出来的问题不缓存
+        self.assertIsNone(self.cache.key_for("24a 主干构建为什么失败", None))
+
+    def test_stale_answer_is_not_replayed(self):
+        import time
+
+        key = self.cache.key_for("24a 主干构建状态", None)
+        self.cache.store(key, "24a 主干构建状态", "24a 主干构建成功", key.tools)
+        with mock.patch("chat.answer_cache.time.time", return_value=time.time() + key.ttl + 1):
+            self.assertIsNone(self.cache.lookup(key))
+        self.assertIsNone(self.cache.lookup(key))
+        self.assertEqual(self.cache.stats.snapshot()["stale"], 1)
+
+    def test_disabled_fast_path_disables_cache(self):
+        from chat.graph import route_fast_path
+
+        with mock.patch.object(route_fast_path, "enabled", False):
+            self.assertIsNone(self.cache.key_for("24a 主干构建状态", None))
+
+    def test_recorder_skips_failed_tool_results(self):
+        from langchain_core.messages import AIMessageChunk, ToolMessage
+
+        from chat.answer_cache import AnswerRecorder
+        from chat.tools.http_client import FAILURE_PREFIX
+
+        key = self.cache.key_for("24a 主干构建状态", None)
+        recorder = AnswerRecorder(self.cache, key, "24a 主干构建状态")
+        recorder.feed(ToolMessage(
+            content=f"{FAILURE_PREFIX}cid-service 超时", name="check_trunk_build_status", tool_call_id="call_1",
+        ))
+        recorder.feed(AIMessageChunk(content="暂时查不到 24a 的构建状态"))
+        recorder.finish()
+        self.assertEqual(self.cache.stats.snapshot()["stores"], 0)
+        self.assertIsNone(self.cache.lookup(key))
+
+
+    def test_answer_expires_with_the_cached_tool_result(self):
+        import time
+
+        from langchain_core.messages import AIMessageChunk, ToolMessage
+
+        from chat.answer_cache import AnswerRecorder
+        from chat.tools.cache import ToolResultCache
+
+        key = self.cache.key_for("24a 主干构建状态", None)
+        tool_cache = ToolResultCache({"TTLS": {"check_trunk_build_status": key.ttl}})
+
+        def query(ver):
+            return f"{ver} 主干构建成功"
+
+        now = time.time()
+        # 工具结果是 key.ttl - 10 秒之前查到的，10 秒后过期
+        with mock.patch("chat.tools.cache.time.time", return_value=now - key.ttl + 10):
+            tool_cache.call("check_trunk_build_status", query, (), {"ver": "24a"})
+
+        recorder = AnswerRecorder(self.cache, key, "24a 主干构建状态")
+        with recorder.tracking():
+            result = tool_cache.call("check_trunk_build_status", query, (), {"ver": "24a"})
+        recorder.feed(ToolMessage(content=result, name="check_trunk_build_status", tool_call_id="call_1"))
+        recorder.feed(AIMessageChunk(content=result))
+        recorder.finish()
+
+        with mock.patch("chat.answer_cache.time.time", return_value=now + 5):
+            self.assertEqual(self.cache.lookup(key).answer, "24a 主干构建成功")
+        with mock.patch("chat.answer_cache.time.time", return_value=now + 11):
+            self.assertIsNone(self.cache.lookup(key))
+
+
+class FastPathRouterTests(SimpleTestCase):
+    """快速路由的版本号：明确说了就覆盖上下文版本，不明确时交给 LLM"""
+
+    def setUp(self):
+        from chat.graph import route_fast_path
+
+        self.router = route_fast_path.router
+
+    def _ver(self, text, default_ver="29a"):
+        route = self.router.route(text, default_ver=default_ver)
+        return route and [call["args"]["ver"] for call in route.tool_calls]
+
+    def test_explicit_version_overrides_context(self):
+        self.assertEqual(self._ver("24a 构建状态"), ["24a"])
+        self.assertEqual(self._ver("24A 构建状态"), ["24a"])
+        self.assertEqual(self._ver("构建状态"), ["29a"])
+        self.assertEqual(self._ver("构建状态", default_ver="29A"), ["29a"])
+
+    def test_unclear_version_falls_back_to_llm(self):
+        # 说了两个不同的版本
+        self.assertIsNone(self.router.route("24a 和 25a 的构建状态", default_ver="29a"))
+        # 版本号只出现在分支名里
+        self.assertIsNone(self.router.route("iWare release/24a 配套信息", default_ver="29a"))
+        self.assertIsNone(self.router.route("hert_bugfix_24a 镜像", default_ver="29a"))
+        self.assertEqual(self._ver("24A iWare release/24a 配套信息"), ["24a"])
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    """准入控制：令牌桶限速、并发流上限，被拒的请求不占名额也不扣令牌"""
+
+    def _controller(self, **conf):
+        from chat.admission import InMemoryAdmissionBackend, AdmissionController
+
+        conf = {"MAX_WAIT": 0, **conf}
+        return AdmissionController(InMemoryAdmissionBackend(), conf)
+
+    def test_user_bucket_limits_rate_per_user(self):
+        from chat.admission import AdmissionRejected
+
+        controller = self._controller(USER_BUCKET={"CAPACITY": 2, "PER_SECOND": 0.01})
+        for _ in range(2):
+            controller.admit("alice").release()
+        with self.assertRaises(AdmissionRejected) as ctx:
+            controller.admit("alice")
+        self.assertEqual(ctx.exception.reason, "user_rate")
+        # 攒够一个令牌要 (1 - 剩余) / 0.01 秒
+        self.assertGreater(ctx.exception.retry_after, 90)
+        self.assertEqual(ctx.exception.retry_after_header, str(int(ctx.exception.retry_after) + 1))
+        # 别的用户有自己的桶
+        controller.admit("bob").release()
+
+    def test_concurrency_rejection_does_not_spend_a_token(self):
+        from chat.admission import AdmissionRejected
+
+        controller = self._controller(USER_BUCKET={"CAPACITY": 2, "PER_SECOND": 0.01}, USER_MAX_STREAMS=1)
+        lease = controller.admit("alice")
+        for _ in range(3):
+            with self.assertRaises(AdmissionRejected) as ctx:
+                controller.admit("alice")
+            self.assertEqual(ctx.exception.reason, "concurrency")
+        lease.release()
+        controller.admit("alice").release()
+        self.assertEqual(controller.backend.active("streams:global"), 0)
+
+    def test_rate_rejection_releases_the_stream_slot(self):
+        from chat.admission import AdmissionRejected
+
+        controller = self._controller(USER_BUCKET={"CAPACITY": 1, "PER_SECOND": 0.01})
+        controller.admit("alice").release()
+        with self.assertRaises(AdmissionRejected):
+            controller.admit("alice")
+        self.assertEqual(controller.backend.active("streams:user:alice"), 0)
+
+    def test_invalid_bucket_is_rejected(self):
+        from django.core.exceptions import ImproperlyConfigured
+
+        with self.assertRaises(ImproperlyConfigured):
+            self._controller(USER_BUCKET={"CAPACITY": 20, "PER_SECOND": 0})
+        with self.assertRaises(ImproperlyConfigured):
+            self._controller(GLOBAL_BUCKET={"CAPACITY": 0, "PER_SECOND": 20})
+
+    def test_lease_keeper_survives_errors(self):
+        controller = self._controller(LEASE_TTL=0.3)
+        live_leases = controller._live_leases
+        calls = []
+
+        def flaky_live_leases():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError("Set changed size during iteration")
+            return live_leases()
+
+        renewed = threading.Event()
+        with mock.patch.object(controller, "_live_leases", side_effect=flaky_live_leases), \
+                mock.patch.object(controller.backend, "renew", side_effect=lambda *args: renewed.set()), \
+                self.assertLogs("chat.admission", level="ERROR"):
+            lease = controller.admit("alice")
+            self.assertTrue(renewed.wait(2))
+        lease.release()
+
+    def test_view_releases_slot_when_setup_fails(self):
+        from django.test import Client
+
+        controller = self._controller()
+        with mock.patch("chat.views.ChatSession") as sessions, \
+                mock.patch("chat.views.get_admission", return_value=controller), \
+                mock.patch("chat.views.resolve_version", side_effect=RuntimeError("版本解析失败")):
+            sessions.objects.filter.return_value.first.return_value = None
+            with self.assertRaises(RuntimeError):
+                Client().post(
+                    "/api/chat",
+                    json.dumps({"query": "24a 构建状态", "session_id": "setup-failure"}),
+                    content_type="application/json",
+                )
+        self.assertEqual(controller.backend.active("streams:global"), 0)
+
+
+class ChatEndpointLeaseTests(SimpleTestCase):
+    """聊天接口在开始推流之前出错 / 参数不全时，不占准入名额和会话运行权"""
+
+    def setUp(self):
+        from chat.admission import AdmissionController, InMemoryAdmissionBackend
+        from chat.session_lock import SessionRunLock
+
+        self.controller = AdmissionController(InMemoryAdmissionBackend(), {"MAX_WAIT": 0})
+        self.session_lock = SessionRunLock(self.controller)
+        for target, value in (("chat.views.get_admission", self.controller), ("chat.views.get_session_lock", self.session_lock)):
+            patcher = mock.patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch("chat.views.ChatSession")
+        self.sessions = sessions = patcher.start().objects.filter.return_value
+        sessions.first.return_value = None
+        sessions.afirst = mock.AsyncMock(return_value=None)
+        self.addCleanup(patcher.stop)
+
+    def _post(self, path, body):
+        from django.test import Client
+
+        return Client().post(path, json.dumps(body), content_type="application/json")
+
+    def test_missing_session_id_is_rejected_before_any_lease(self):
+        for path in ("/api/chat", "/api/chat/async"):
+            response = self._post(path, {"query": "24a 构建状态"})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.controller.stats.snapshot()["admitted"], 0)
+
+    def test_setup_failure_releases_run_lease(self):
+        for path in ("/api/chat", "/api/chat/async"):
+            with mock.patch("chat.views.resolve_version", side_effect=RuntimeError("版本解析失败")), \
+                    mock.patch("chat.views.aresolve_version", side_effect=RuntimeError("版本解析失败")):
+                with self.assertRaises(RuntimeError):
+                    self._post(path, {"query": "24a 构建状态", "session_id": "setup-failure"})
+            self.assertEqual(self.controller.backend.active("streams:global"), 0)
+            self.assertEqual(self.controller.backend.active("session:setup-failure"), 0)
+
+
+    def test_async_title_submit_runs_off_the_event_loop(self):
+        threads = {}
+
+        def submit(session_id, query):
+            threads["submit"] = threading.get_ident()
+            return True
+
+        def resolve(session, version):
+            threads["loop"] = threading.get_ident()
+            raise RuntimeError("版本解析失败")
+
+        self.sessions.afirst.return_value = mock.Mock(title="新对话", user_id="alice")
+        with mock.patch("chat.views.title_queue.submit", side_effect=submit) as submitted, \
+                mock.patch("chat.views.aresolve_version", side_effect=resolve):
+            with self.assertRaises(RuntimeError):
+                self._post("/api/chat/async", {"query": "24a 构建状态", "session_id": "untitled"})
+        submitted.assert_called_once_with("untitled", "24a 构建状态")
+        # 提交要到共享缓存认领会话 (同步 I/O)，不能在事件循环线程里做
+        self.assertNotEqual(threads["submit"], threads["loop"])
+
+
+class SseEncodingTests(SimpleTestCase):
+    """SSE 推流：连续的回答片段合并成帧，其他事件不打乱顺序，空闲时发心跳"""
+
+    def _decode(self, frames):
+        from chat.sse import HEARTBEAT_FRAME
+
+        return [json.loads(f[len(b"data: "):]) for f in frames if f != HEARTBEAT_FRAME]
+
+    def test_coalescer_throttles_answer_fragments(self):
+        from chat.sse import FrameCoalescer
+
+        coalescer = FrameCoalescer(flush_interval=0.016, max_chars=8)
+        # 第一个片段立即发出，间隔内的片段先攒着
+        self.assertEqual(self._decode(coalescer.push({"type": "answer", "content": "构建"}, 0.0)),
+                         [{"type": "answer", "content": "构建"}])
+        self.assertEqual(coalescer.push({"type": "answer", "content": "成"}, 0.005), [])
+        self.assertEqual(coalescer.push({"type": "answer", "content": "功"}, 0.010), [])
+        self.assertEqual(coalescer.flush_due(0.012), [])
+        self.assertEqual(self._decode(coalescer.flush_due(0.016)), [{"type": "answer", "content": "成功"}])
+        # 攒够 max_chars 个字不等间隔
+        self.assertEqual(coalescer.push({"type": "answer", "content": "1234"}, 0.017), [])
+        self.assertEqual(self._decode(coalescer.push({"type": "answer", "content": "5678"}, 0.018)),
+                         [{"type": "answer", "content": "12345678"}])
+        # 其他事件先把攒着的回答发出去
+        coalescer.push({"type": "answer", "content": "，"}, 0.019)
+        self.assertEqual(self._decode(coalescer.push({"type": "tool", "content": "check_trunk_build_status"}, 0.020)),
+                         [{"type": "answer", "content": "，"}, {"type": "tool", "content": "check_trunk_build_status"}])
+
+    def _payloads(self):
+        yield {"type": "tool", "content": "check_trunk_build_status"}
+        for ch in "24a 主干构建成功":
+            yield {"type": "answer", "content": ch}
+        # 等工具 / LLM 的空档
+        threading.Event().wait(0.2)
+        yield {"type": "answer", "content": "。"}
+
+    async def _apayloads(self):
+        import asyncio
+
+        yield {"type": "tool", "content": "check_trunk_build_status"}
+        for ch in "24a 主干构建成功":
+            yield {"type": "answer", "content": ch}
+        await asyncio.sleep(0.2)
+        yield {"type": "answer", "content": "。"}
+
+    def _check(self, frames):
+        from chat.sse import HEARTBEAT_FRAME
+
+        self.assertIn(HEARTBEAT_FRAME, frames)
+        events = self._decode(frames)
+        self.assertEqual(events[0], {"type": "tool", "content": "check_trunk_build_status"})
+        self.assertEqual("".join(e["content"] for e in events[1:]), "24a 主干构建成功。")
+        self.assertLess(len(events) - 1, len("24a 主干构建成功。"))
+
+    def test_encode_stream_coalesces_and_sends_heartbeats(self):
+        from chat.sse import encode_stream
+
+        conf = {"FLUSH_INTERVAL": 0.05, "MAX_CHARS": 64, "HEARTBEAT": 0.05}
+        self._check(list(encode_stream(self._payloads(), conf)))
+
+    def test_aencode_stream_coalesces_and_sends_heartbeats(self):
+        import asyncio
+
+        from chat.sse import aencode_stream
+
+        async def collect():
+            conf = {"FLUSH_INTERVAL": 0.05, "MAX_CHARS": 64, "HEARTBEAT": 0.05}
+            return [frame async for frame in aencode_stream(self._apayloads(), conf)]
+
+        self._check(asyncio.run(collect()))
+
+
+class SessionListPaginationTests(TestCase):
+    """会话列表的游标分页：同一时刻创建的会话也不重复、不漏"""
+
+    def setUp(self):
+        from django.utils import timezone
+
+        from chat.models import ChatSession
+
+        now = timezone.now()
+        for i in range(7):
+            ChatSession.objects.create(session_id=f"s{i}", user_id="alice", title=f"会话 {i}")
+        ChatSession.objects.create(session_id="other", user_id="bob")
+        # 编号越大越早创建；s0~s3 是同一时刻创建的，跨了两页，靠 session_id 区分先后
+        for i in range(7):
+            ChatSession.objects.filter(session_id=f"s{i}").update(created_at=now - timezone.timedelta(minutes=max(i, 3)))
+
+    def test_pages_walk_every_session_once(self):
+        seen, cursor = [], None
+        while True:
+            params = {"user_id": "alice", "limit": 3, **({"cursor": cursor} if cursor else {})}
+            body = self.client.get("/api/sessions/list", params).json()
+            seen += [row["session_id"] for row in body["data"]]
+            cursor = body["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(seen, ["s3", "s2", "s1", "s0", "s4", "s5", "s6"])
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get("/api/sessions/list", {"user_id": "alice", "cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+
+    def test_ops_search_is_prefix_unless_contains_requested(self):
+        from chat.models import ChatSession
+
+        ChatSession.objects.create(session_id="ops", user_id="sysalice")
+
+        def search(**params):
+            body = self.client.get("/api/ops/sessions", {"page_size": 20, **params}).json()
+            return sorted(row["user_id"] for row in body["data"]["list"])
+
+        self.assertEqual(search(user_id="ali"), ["alice"] * 7)
+        self.assertEqual(search(user_id="ali", match="contains"), ["alice"] * 7 + ["sysalice"])
+        body = self.client.get("/api/ops/sessions", {"user_id": "ali", "match": "regex"}).json()
+        self.assertEqual(body["code"], 400)
+
+
+class TranscriptProjectionTests(TransactionTestCase):
+    """聊天记录投影：每轮只记用户提问和 AI 回答，历史接口按 id 倒着翻页"""
+
+    def test_turns_are_projected_and_paged(self):
+        from langgraph.checkpoint.memory import InMemorySaver
+
+        from chat.graph import build_agent
+        from chat.testing import StubChatModel
+        from chat.transcript import history_page
+
+        agent = build_agent(StubChatModel(reply="构建成功"), InMemorySaver())
+        config = {"configurable": {"thread_id": "transcript"}}
+        for turn in range(3):
+            agent.invoke({"messages": [("user", f"第 {turn} 轮")]}, config)
+
+        # 工具调用和工具结果不进投影
+        page = history_page("transcript", limit=4)
+        self.assertEqual(
+            [(m["role"], m["content"]) for m in page["messages"]],
+            [("user", "第 1 轮"), ("ai", "构建成功"), ("user", "第 2 轮"), ("ai", "构建成功")],
+        )
+        self.assertTrue(page["has_more"])
+        earlier = history_page("transcript", before=page["next_before"], limit=4)
+        self.assertEqual([m["content"] for m in earlier["messages"]], ["第 0 轮", "构建成功"])
+        self.assertFalse(earlier["has_more"])
+        self.assertIsNone(earlier["next_before"])
+
+    def test_legacy_session_is_backfilled_from_checkpoint(self):
+        from langgraph.checkpoint.memory import InMemorySaver
+
+        from chat.graph import build_agent
+        from chat.models import ChatMessage
+        from chat.testing import StubChatModel
+        from chat.transcript import backfill_from_checkpoint, history_page
+
+        agent = build_agent(StubChatModel(reply="构建成功"), InMemorySaver())
+        config = {"configurable": {"thread_id": "legacy"}}
+        agent.invoke({"messages": [("user", "第 0 轮")]}, config)
+        # 投影上线前的老会话：表里没有记录
+        ChatMessage.objects.filter(session_id="legacy").delete()
+        backfill_from_checkpoint(agent, "legacy")
+        backfill_from_checkpoint(agent, "legacy")
+        self.assertEqual([m["content"] for m in history_page("legacy")["messages"]], ["第 0 轮", "构建成功"])
+
+
+class EndToEndLoadSmokeTests(SimpleTestCase):
+    """端到端压测脚本 (benchmarks/bench_e2e.py) 小规模跑一遍：mock LLM + cid-service 替身下每一轮都能跑完"""
+
+    def test_bench_e2e_runs_without_errors(self):
+        import subprocess
+        import sys
+
+        from django.conf import settings
+
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "e2e.json")
+            subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_e2e", "--users", "2", "--turns", "2",
+                 "--ttft-ms", "5", "--token-ms", "1", "--tool-latency-ms", "1", "--output", output],
+                cwd=settings.BASE_DIR, capture_output=True, check=True, timeout=120,
+            )
+            with open(output, encoding="utf-8") as f:
+                level = json.load(f)["levels"][0]
+        self.assertEqual((level["turns"], level["errors"]), (4, 0), level["error_samples"])
+        self.assertGreater(level["mock_llm"]["requests"], 0)
+        self.assertGreater(level["cid_service"]["requests"], 0)
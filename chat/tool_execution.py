@@ -0,0 +1,163 @@
+"""
+工具调用的并发上限与超时
+
+模型一次返回多个 tool_calls 时 (例如同时查 iware 和 rtos 的配套信息)，create_agent 会把它们作为并行任务派发，
+同步链路在线程池里、异步链路在事件循环里同时执行，结果按 tool_calls 原来的顺序写回。
+这里在此基础上再加两条约束：
+- 按后端限流：同一个后端 (默认所有工具都是 cid-service) 同时在途的调用数不超过上限，避免一个大问题把后端打满
+- 单次调用超时：排队 + 执行超过时限直接返回一条 status="error" 的 ToolMessage，让模型继续回答，而不是整轮卡住
+
+这样一轮的耗时取决于最慢的那个工具，而不是所有工具耗时之和。配置见 settings.AGENT_TOOL_EXECUTION。
+前端断开时 (chat/cancellation.py) 同步链路不再等工具结果，直接抛 RunCancelled；异步链路随 task 一起取消。
+"""
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from typing import Optional
+
+from langchain.agents.middleware import AgentMiddleware
+from langchain_core.messages import ToolMessage
+
+from chat.cancellation import current_cancel_token
+from chat.config import get_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOOL_EXECUTION = {
+    # 单次工具调用的时限 (秒)，包含排队等待后端名额的时间
+    "TIMEOUT": 20,
+    # 按工具名单独配置时限
+    "TOOL_TIMEOUTS": {},
+    # 每个后端同时在途的调用数上限
+    "BACKEND_LIMITS": {"cid-service": 8},
+    # 工具名 -> 后端名，没配置的工具归到 DEFAULT_BACKEND
+    "TOOL_BACKENDS": {},
+    "DEFAULT_BACKEND": "cid-service",
+    # 没在 BACKEND_LIMITS 里配置的后端使用的上限
+    "DEFAULT_LIMIT": 8,
+}
+
+TIMEOUT_MESSAGE = "工具 {name} 调用超时 (超过 {timeout}s 未返回)，本次没有查到结果。请告诉用户该查询暂时超时，可以稍后重试。"
+
+
+class ToolExecutionMiddleware(AgentMiddleware):
+    def __init__(self, conf: Optional[dict] = None):
+        super().__init__()
+        conf = {**DEFAULT_TOOL_EXECUTION, **(conf or {})}
+        self.timeout = conf["TIMEOUT"]
+        self.tool_timeouts = conf["TOOL_TIMEOUTS"]
+        self.backend_limits = conf["BACKEND_LIMITS"]
+        self.tool_backends = conf["TOOL_BACKENDS"]
+        self.default_backend = conf["DEFAULT_BACKEND"]
+        self.default_limit = conf["DEFAULT_LIMIT"]
+
+        self._semaphores = {}
+        self._async_semaphores = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        # 同步链路：工具放到这个线程池里执行，调用方线程只等到超时为止。
+        # 每个后端的信号量保证了在途调用数，线程池大小给够所有后端的名额即可
+        max_workers = sum(self.backend_limits.values()) + self.default_limit
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool-call")
+
+    # --- 配置查询 ---
+    def backend_for(self, tool_name: str) -> str:
+        return self.tool_backends.get(tool_name, self.default_backend)
+
+    def limit_for(self, backend: str) -> int:
+        return self.backend_limits.get(backend, self.default_limit)
+
+    def timeout_for(self, tool_name: str) -> float:
+        return self.tool_timeouts.get(tool_name, self.timeout)
+
+    def _semaphore(self, backend: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            semaphore = self._semaphores.get(backend)
+            if semaphore is None:
+                semaphore = self._semaphores[backend] = threading.BoundedSemaphore(self.limit_for(backend))
+            return semaphore
+
+    def _async_semaphore(self, backend: str) -> asyncio.Semaphore:
+        # asyncio.Semaphore 绑定事件循环，按循环各建一份
+        semaphores = self._async_semaphores.setdefault(asyncio.get_running_loop(), {})
+        semaphore = semaphores.get(backend)
+        if semaphore is None:
+            semaphore = semaphores[backend] = asyncio.Semaphore(self.limit_for(backend))
+        return semaphore
+
+    @staticmethod
+    def _timeout_message(request, timeout) -> ToolMessage:
+        call = request.tool_call
+        logger.warning("⏱️ [tool] %s 超时 (%ss)，返回错误结果", call["name"], timeout)
+        return ToolMessage(
+            content=TIMEOUT_MESSAGE.format(name=call["name"], timeout=timeout),
+            name=call["name"],
+            tool_call_id=call["id"],
+            status="error",
+        )
+
+    def wrap_tool_call(self, request, handler):
+        name = request.tool_call["name"]
+        timeout = self.timeout_for(name)
+        deadline = time.monotonic() + timeout
+        semaphore = self._semaphore(self.backend_for(name))
+        token = current_cancel_token()
+        if not semaphore.acquire(timeout=timeout):
+            return self._timeout_message(request, timeout)
+        if token is not None and token.cancelled:
+            semaphore.release()
+            token.raise_if_cancelled()
+
+        # 带上当前线程的 contextvars (graph 运行配置、回调等)，工具在线程池里才能拿到
+        context = contextvars.copy_context()
+
+        def run():
+            try:
+                return context.run(handler, request)
+            finally:
+                # 超时后调用方不再等结果，但名额要等工具真正结束才释放，后端在途数才准确
+                semaphore.release()
+
+        future = self._executor.submit(run)
+        try:
+            return self._result(future, max(0.0, deadline - time.monotonic()), token)
+        except FuturesTimeoutError:
+            return self._timeout_message(request, timeout)
+
+    @staticmethod
+    def _result(future, timeout: float, token):
+        """等工具结果，本轮被取消时立即抛 RunCancelled (工具自己在途的 HTTP 请求由 http_client 关掉)"""
+        if token is None:
+            return future.result(timeout=timeout)
+        wake = threading.Event()
+        future.add_done_callback(lambda _: wake.set())
+        unregister = token.on_cancel(wake.set)
+        try:
+            wake.wait(timeout)
+        finally:
+            unregister()
+        token.raise_if_cancelled()
+        return future.result(timeout=0)
+
+    async def awrap_tool_call(self, request, handler):
+        name = request.tool_call["name"]
+        timeout = self.timeout_for(name)
+        semaphore = self._async_semaphore(self.backend_for(name))
+
+        async def run():
+            async with semaphore:
+                return await handler(request)
+
+        try:
+            return await asyncio.wait_for(run(), timeout)
+        except asyncio.TimeoutError:
+            return self._timeout_message(request, timeout)
+
+
+def build_tool_execution() -> ToolExecutionMiddleware:
+    """按 settings.AGENT_TOOL_EXECUTION 创建工具执行中间件"""
+    return ToolExecutionMiddleware(get_setting("AGENT_TOOL_EXECUTION", {}))
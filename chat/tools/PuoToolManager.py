@@ -1,3 +1,4 @@
+from contextvars import ContextVar
 from typing import Literal, List, Optional
 
 import requests
@@ -6,11 +7,59 @@ from pydantic import Field
 
 from requests import RequestException
 
+from chat.tools.cache import tool_result_cache
+from chat.tools.http_client import get_async_http_client, get_http_client
+
+# 为 True 时 _send_post_request_with_retry 不发请求，只把 (url, payload) 交出来给异步版去发
+_defer_request = ContextVar("puo_defer_request", default=False)
+
+
+class _PendingRequest:
+    def __init__(self, url, payload, headers, max_retries):
+        self.url = url
+        self.payload = payload
+        self.headers = headers
+        self.max_retries = max_retries
+
 
 class PuoToolManager:
     @staticmethod
     def _send_post_request_with_retry(url, payload, headers=None, max_retries=5):
-       return "已查询到数据,这里是模拟场景，你可以随机编数据"
+        """
+        调用 cid-service 接口 (共享连接池 + 超时 + 指数退避重试，见 chat/tools/http_client.py)
+        重试用完仍失败时返回错误说明文本，由 LLM 转告用户
+        """
+        if _defer_request.get():
+            return _PendingRequest(url, payload, headers, max_retries)
+        return get_http_client().post_json(url, payload, headers=headers, max_retries=max_retries)
+
+    @staticmethod
+    async def _asend_post_request_with_retry(url, payload, headers=None, max_retries=5):
+        """_send_post_request_with_retry 的异步版，重试语义一致，给 graph.astream 用"""
+        return await get_async_http_client().post_json(url, payload, headers=headers, max_retries=max_retries)
+
+    @staticmethod
+    def _attach_coroutine(tool_obj):
+        """
+        给同步工具补上异步实现：复用同一个工具函数拼 url / payload，
+        只把最后的 HTTP 请求换成异步客户端，这样 astream 下工具调用不会占用线程池
+        """
+        func = tool_obj.func
+
+        async def coroutine(*args, **kwargs):
+            token = _defer_request.set(True)
+            try:
+                pending = func(*args, **kwargs)
+            finally:
+                _defer_request.reset(token)
+            if not isinstance(pending, _PendingRequest):
+                return pending
+            return await PuoToolManager._asend_post_request_with_retry(
+                pending.url, pending.payload, headers=pending.headers, max_retries=pending.max_retries
+            )
+
+        tool_obj.coroutine = coroutine
+        return tool_obj
 
 
 
@@ -220,4 +269,10 @@ class PuoToolManager:
             cls.query_component_details,
             cls.query_product_details,
 
-        ]
\ No newline at end of file
+        ]
+
+
+# 先补异步实现，再给同步 / 异步两套实现都套上结果缓存 (见 chat/tools/cache.py)
+for _tool in PuoToolManager.get_tools_list():
+    PuoToolManager._attach_coroutine(_tool)
+    tool_result_cache.wrap(_tool)
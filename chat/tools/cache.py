@@ -0,0 +1,364 @@
+"""
+工具结果缓存 (TTL + LRU + 并发请求合并)
+
+PuoToolManager 里的工具都是只读查询，很多用户会对同一个 ver 问同样的问题，没必要每次都打到 cid-service：
+- key = 工具名 + 规范化后的参数 (去掉首尾/多余空白、空参数，按参数名排序)
+- 每个工具单独配置 TTL (构建状态这类变化快的短一些，MR / 配套信息长一些)，TTL <= 0 表示不缓存
+- 两级缓存：进程内 LRU；可选共享层 (Django cache，例如 Redis)，多个 worker 之间共享结果
+- 同一个 key 同时有多个请求在查时，只有第一个真正发请求，其余的等它的结果 (请求合并)
+- 查询失败的结果 (http_client 返回的错误说明) 不缓存
+- 命中 / 未命中 / 合并次数按工具统计，运维接口 /api/ops/tool-cache 可以看，用来调 TTL
+- track_result_expiry() 收集一段运行里用到的结果什么时候过期，答案缓存 (chat/answer_cache.py) 按最早的那个让答案过期
+
+配置见 settings.PUO_TOOL_CACHE。
+"""
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Optional
+
+from chat.cancellation import RunCancelled, current_cancel_token
+from chat.config import get_setting
+from chat.tools.http_client import is_failure
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOOL_CACHE = {
+    "ENABLED": True,
+    # 进程内最多缓存多少条结果，超出按 LRU 淘汰
+    "MAX_ENTRIES": 2048,
+    # 没有单独配置的工具使用的 TTL (秒)
+    "DEFAULT_TTL": 300,
+    # 按工具名单独配置 TTL (秒)
+    "TTLS": {},
+    # 共享缓存层使用的 Django cache 别名 (settings.CACHES 里的 key)，None 表示只用进程内缓存
+    "SHARED_CACHE": None,
+    "KEY_PREFIX": "puo_tool",
+}
+
+_MISS = object()
+
+_result_expiries: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("tool_result_expiries", default=None)
+
+
+@contextmanager
+def track_result_expiry():
+    """
+    收集这段运行里经过缓存的工具结果的过期时间 (yield 出收集用的列表)
+    工具线程池会带上调用方的 contextvars，线程里的调用也会记到同一个列表里
+    """
+    expiries = []
+    reset = _result_expiries.set(expiries)
+    try:
+        yield expiries
+    finally:
+        _result_expiries.reset(reset)
+
+
+def normalize_args(args: tuple, kwargs: dict) -> str:
+    """规范化工具参数：字符串折叠空白，丢掉空值，按参数名排序后序列化"""
+    normalized = {}
+    for name, value in kwargs.items():
+        if isinstance(value, str):
+            value = " ".join(value.split())
+        if value is None or value == "":
+            continue
+        normalized[name] = value
+    if args:
+        normalized["__args__"] = list(args)
+    return json.dumps(normalized, sort_keys=True, ensure_ascii=False, default=str)
+
+
+class ToolCacheStats:
+    """按工具统计命中情况 (每个进程各自统计)"""
+
+    FIELDS = ("local_hits", "shared_hits", "misses", "coalesced", "uncached_failures")
+
+    def __init__(self):
+        self._counters = defaultdict(lambda: dict.fromkeys(self.FIELDS, 0))
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def incr(self, tool_name: str, field: str):
+        with self._lock:
+            self._counters[tool_name][field] += 1
+
+    def evicted(self):
+        with self._lock:
+            self.evictions += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            tools = {}
+            for name, counters in self._counters.items():
+                hits = counters["local_hits"] + counters["shared_hits"] + counters["coalesced"]
+                total = hits + counters["misses"]
+                tools[name] = {**counters, "hit_rate": round(hits / total, 4) if total else None}
+            return {"evictions": self.evictions, "tools": tools}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self.evictions = 0
+
+
+class ToolResultCache:
+    def __init__(self, conf: Optional[dict] = None):
+        conf = {**DEFAULT_TOOL_CACHE, **(conf or {})}
+        self.enabled = conf["ENABLED"]
+        self.max_entries = conf["MAX_ENTRIES"]
+        self.default_ttl = conf["DEFAULT_TTL"]
+        self.ttls = conf["TTLS"]
+        self.shared_alias = conf["SHARED_CACHE"]
+        self.key_prefix = conf["KEY_PREFIX"]
+        self.stats = ToolCacheStats()
+        # key -> (过期时间, 结果)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # 正在查询中的 key：同步调用用 concurrent Future，异步调用按事件循环各一份 asyncio Future
+        self._inflight = {}
+        self._ainflight = weakref.WeakKeyDictionary()
+
+    def ttl_for(self, tool_name: str) -> float:
+        return self.ttls.get(tool_name, self.default_ttl)
+
+    def make_key(self, tool_name: str, args: tuple, kwargs: dict) -> str:
+        digest = hashlib.sha1(normalize_args(args, kwargs).encode("utf-8")).hexdigest()
+        return f"{self.key_prefix}:{tool_name}:{digest}"
+
+    # --- 进程内 LRU ---
+    def _local_get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISS
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return _MISS
+            self._entries.move_to_end(key)
+            return value
+
+    def _local_set(self, key, expires_at, value):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.evicted()
+
+    # --- 共享层 (Django cache) ---
+    @property
+    def shared(self):
+        if not self.shared_alias:
+            return None
+        from django.core.cache import caches
+
+        return caches[self.shared_alias]
+
+    def _lookup_local(self, tool_name, key):
+        value = self._local_get(key)
+        if value is not _MISS:
+            self.stats.incr(tool_name, "local_hits")
+        return value
+
+    def _fill_from_shared(self, tool_name, key, entry):
+        if entry is None:
+            return _MISS
+        expires_at, value = entry
+        self._local_set(key, expires_at, value)
+        self.stats.incr(tool_name, "shared_hits")
+        return value
+
+    def _lookup(self, tool_name, key):
+        value = self._lookup_local(tool_name, key)
+        if value is not _MISS or self.shared is None:
+            return value
+        try:
+            entry = self.shared.get(key)
+        except Exception as e:
+            # 共享缓存挂了不影响查询，退化成只用进程内缓存
+            logger.warning("⚠️ [tool-cache] 共享缓存读取失败: %s", e)
+            entry = None
+        return self._fill_from_shared(tool_name, key, entry)
+
+    async def _alookup(self, tool_name, key):
+        value = self._lookup_local(tool_name, key)
+        if value is not _MISS or self.shared is None:
+            return value
+        try:
+            entry = await self.shared.aget(key)
+        except Exception as e:
+            logger.warning("⚠️ [tool-cache] 共享缓存读取失败: %s", e)
+            entry = None
+        return self._fill_from_shared(tool_name, key, entry)
+
+    def _store_local(self, tool_name, key, ttl, value):
+        """写进程内缓存，返回要写到共享层的 (过期时间, 结果)，不需要缓存时返回 None"""
+        self.stats.incr(tool_name, "misses")
+        if is_failure(value):
+            self.stats.incr(tool_name, "uncached_failures")
+            return None
+        entry = (time.time() + ttl, value)
+        self._local_set(key, *entry)
+        return entry if self.shared is not None else None
+
+    def _store(self, tool_name, key, ttl, value):
+        entry = self._store_local(tool_name, key, ttl, value)
+        if entry is not None:
+            try:
+                self.shared.set(key, entry, timeout=ttl)
+            except Exception as e:
+                logger.warning("⚠️ [tool-cache] 共享缓存写入失败: %s", e)
+
+    async def _astore(self, tool_name, key, ttl, value):
+        entry = self._store_local(tool_name, key, ttl, value)
+        if entry is not None:
+            try:
+                await self.shared.aset(key, entry, timeout=ttl)
+            except Exception as e:
+                logger.warning("⚠️ [tool-cache] 共享缓存写入失败: %s", e)
+
+    def _track_expiry(self, key, ttl):
+        """记下这次拿到的结果什么时候过期：命中的是缓存里的旧结果时，按它写入时的过期时间算"""
+        expiries = _result_expiries.get()
+        if expiries is None:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+        expiries.append(entry[0] if entry is not None else time.time() + ttl)
+
+    # --- 同步入口 ---
+    def call(self, tool_name: str, func, args: tuple, kwargs: dict):
+        ttl = self.ttl_for(tool_name)
+        if not self.enabled or ttl <= 0:
+            return func(*args, **kwargs)
+
+        key = self.make_key(tool_name, args, kwargs)
+        value = self._call(tool_name, key, ttl, func, args, kwargs)
+        self._track_expiry(key, ttl)
+        return value
+
+    def _call(self, tool_name, key, ttl, func, args, kwargs):
+        value = self._lookup(tool_name, key)
+        if value is not _MISS:
+            return value
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            self.stats.incr(tool_name, "coalesced")
+            try:
+                return future.result()
+            except RunCancelled:
+                token = current_cancel_token()
+                if token is not None and token.cancelled:
+                    raise
+            # 发起请求的那一方被取消了 (它的客户端断开)，不是自己这一轮，自己再查一次
+            return func(*args, **kwargs)
+
+        try:
+            value = func(*args, **kwargs)
+            self._store(tool_name, key, ttl, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    # --- 异步入口 (语义同 call) ---
+    async def acall(self, tool_name: str, coroutine, args: tuple, kwargs: dict):
+        ttl = self.ttl_for(tool_name)
+        if not self.enabled or ttl <= 0:
+            return await coroutine(*args, **kwargs)
+
+        key = self.make_key(tool_name, args, kwargs)
+        value = await self._acall(tool_name, key, ttl, coroutine, args, kwargs)
+        self._track_expiry(key, ttl)
+        return value
+
+    async def _acall(self, tool_name, key, ttl, coroutine, args, kwargs):
+        value = await self._alookup(tool_name, key)
+        if value is not _MISS:
+            return value
+
+        loop = asyncio.get_running_loop()
+        inflight = self._ainflight.setdefault(loop, {})
+        future = inflight.get(key)
+        if future is not None:
+            self.stats.incr(tool_name, "coalesced")
+            try:
+                # shield: 某个等待方被取消时不影响其他等待方
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+            # 发起请求的那一方被取消了 (例如客户端断开)，自己再查一次
+            return await coroutine(*args, **kwargs)
+
+        future = inflight[key] = loop.create_future()
+        try:
+            value = await coroutine(*args, **kwargs)
+            await self._astore(tool_name, key, ttl, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有其他等待方时，避免 "Future exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            inflight.pop(key, None)
+
+    def wrap(self, tool_obj):
+        """给工具的同步 / 异步实现都套上缓存"""
+        name = tool_obj.name
+        func, coroutine = tool_obj.func, tool_obj.coroutine
+
+        def cached_func(*args, **kwargs):
+            return self.call(name, func, args, kwargs)
+
+        tool_obj.func = cached_func
+        if coroutine is not None:
+            async def cached_coroutine(*args, **kwargs):
+                return await self.acall(name, coroutine, args, kwargs)
+
+            tool_obj.coroutine = cached_coroutine
+        return tool_obj
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            entries = len(self._entries)
+        return {
+            "pid": os.getpid(),
+            "enabled": self.enabled,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "shared_cache": self.shared_alias,
+            **self.stats.snapshot(),
+        }
+
+
+tool_result_cache = ToolResultCache(get_setting("PUO_TOOL_CACHE", {}))
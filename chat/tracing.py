@@ -0,0 +1,199 @@
+"""
+结构化追踪 (OpenTelemetry) + 日志
+
+替代原来到处 print 的调试方式：
+- span: 模型调用 (agent.model_call)、每次工具调用 (agent.tool_call)、checkpoint 批量写入 (checkpoint.flush)、
+  SSE 推流 (sse.stream)，带 token 用量、工具状态、首帧耗时等属性
+- 采样：按 trace 比例采样 (ParentBased + TraceIdRatioBased)，同一次请求里的 span 要么都采要么都不采
+- 导出：otlp (opentelemetry-exporter-otlp-proto-http) / console / none
+- 关闭时 span() 直接返回一个共享的空上下文，不创建任何对象，热路径上几乎没有开销
+- 普通日志统一走 logging (logger 名为 chat.*)，级别在 settings.LOGGING 里配置，
+  完整 prompt 只在 DEBUG 级别打印
+
+配置见 settings.AGENT_TRACING。
+"""
+import contextlib
+import logging
+import time
+
+from langchain.agents.middleware import AgentMiddleware, ModelRequest
+from langchain_core.messages import ToolMessage
+from opentelemetry import trace
+
+from chat.config import get_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRACING = {
+    "ENABLED": False,
+    # 采样比例 (0 ~ 1)
+    "SAMPLE_RATE": 0.1,
+    # otlp / console / None
+    "EXPORTER": "otlp",
+    # OTLP HTTP 接收地址，None 时使用 OTEL_EXPORTER_OTLP_ENDPOINT 环境变量或默认的 http://localhost:4318
+    "OTLP_ENDPOINT": None,
+    "SERVICE_NAME": "ai-agent-django",
+}
+
+# 关闭 / 未采样时复用同一个空 span：set_attribute / add_event 都是空操作
+_NOOP_SPAN = contextlib.nullcontext(trace.INVALID_SPAN)
+
+_tracer = None
+
+
+def _build_exporter(conf: dict):
+    exporter = conf["EXPORTER"]
+    if exporter == "console":
+        from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+
+        return ConsoleSpanExporter()
+    if exporter == "otlp":
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            logger.warning("未安装 opentelemetry-exporter-otlp-proto-http，追踪数据不会导出")
+            return None
+        return OTLPSpanExporter(endpoint=conf["OTLP_ENDPOINT"]) if conf["OTLP_ENDPOINT"] else OTLPSpanExporter()
+    return None
+
+
+def configure_tracing(conf: dict = None):
+    """按配置初始化 TracerProvider；ENABLED=False 时什么都不做，span() 全部是空操作"""
+    global _tracer
+    conf = {**DEFAULT_TRACING, **(conf if conf is not None else get_setting("AGENT_TRACING", {}))}
+    if not conf["ENABLED"]:
+        _tracer = None
+        return None
+
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": conf["SERVICE_NAME"]}),
+        sampler=ParentBased(TraceIdRatioBased(conf["SAMPLE_RATE"])),
+    )
+    exporter = _build_exporter(conf)
+    if exporter is not None:
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+    _tracer = provider.get_tracer("chat")
+    logger.info("追踪已开启: exporter=%s, sample_rate=%s", conf["EXPORTER"], conf["SAMPLE_RATE"])
+    return provider
+
+
+def tracing_enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str, **attributes):
+    """
+    用法: with span("agent.tool_call", tool="query_mr_info") as s: ...; s.set_attribute(...)
+    值为 None 的属性会被丢掉 (OpenTelemetry 不接受 None)
+    """
+    if _tracer is None:
+        return _NOOP_SPAN
+    return _tracer.start_as_current_span(name, attributes={k: v for k, v in attributes.items() if v is not None})
+
+
+# =================================================================
+# Agent 中间件：模型调用 / 工具调用的 span
+# =================================================================
+def _record_model_response(s, response):
+    from chat.usage import extract_usage
+
+    if not s.is_recording():
+        return
+    message = response.result[-1] if response.result else None
+    if message is None:
+        return
+    for key, value in extract_usage(message).items():
+        s.set_attribute(f"llm.{key}", value)
+    s.set_attribute("llm.tool_calls", len(getattr(message, "tool_calls", None) or []))
+
+
+def _record_tool_result(s, result):
+    if s.is_recording() and isinstance(result, ToolMessage):
+        s.set_attribute("tool.status", result.status)
+        s.set_attribute("tool.result_chars", len(str(result.content)))
+
+
+class TracingMiddleware(AgentMiddleware):
+    """模型调用和工具调用各开一个 span；追踪关闭时直接透传"""
+
+    def wrap_model_call(self, request: ModelRequest, handler):
+        if _tracer is None:
+            return handler(request)
+        with span("agent.model_call", messages=len(request.messages)) as s:
+            response = handler(request)
+            _record_model_response(s, response)
+            return response
+
+    async def awrap_model_call(self, request: ModelRequest, handler):
+        if _tracer is None:
+            return await handler(request)
+        with span("agent.model_call", messages=len(request.messages)) as s:
+            response = await handler(request)
+            _record_model_response(s, response)
+            return response
+
+    def wrap_tool_call(self, request, handler):
+        if _tracer is None:
+            return handler(request)
+        with span("agent.tool_call", tool=request.tool_call["name"]) as s:
+            result = handler(request)
+            _record_tool_result(s, result)
+            return result
+
+    async def awrap_tool_call(self, request, handler):
+        if _tracer is None:
+            return await handler(request)
+        with span("agent.tool_call", tool=request.tool_call["name"]) as s:
+            result = await handler(request)
+            _record_tool_result(s, result)
+            return result
+
+
+trace_agent = TracingMiddleware()
+
+
+# =================================================================
+# SSE 推流
+# =================================================================
+class SSEStreamTrace:
+    """
+    记录一次 SSE 推流：首帧耗时、帧数、总字节数
+    views 里在每次 yield 之前调用 frame()，追踪关闭时只是几次属性判断
+    """
+
+    def __init__(self, s):
+        self.span = s
+        self.start = time.perf_counter()
+        self.frames = 0
+        self.bytes = 0
+
+    def frame(self, data: str):
+        if not self.span.is_recording():
+            return
+        if self.frames == 0:
+            self.span.set_attribute("sse.first_frame_ms", round((time.perf_counter() - self.start) * 1000, 1))
+        self.frames += 1
+        self.bytes += len(data)
+
+    def finish(self):
+        if self.span.is_recording():
+            self.span.set_attribute("sse.frames", self.frames)
+            self.span.set_attribute("sse.bytes", self.bytes)
+
+
+@contextlib.contextmanager
+def sse_stream_span(session_id: str, path: str):
+    with span("sse.stream", session_id=session_id, path=path) as s:
+        stream_trace = SSEStreamTrace(s)
+        try:
+            yield stream_trace
+        finally:
+            stream_trace.finish()
+
+
+configure_tracing()
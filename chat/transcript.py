@@ -0,0 +1,170 @@
+"""
+聊天记录投影 (transcript)
+
+历史接口以前是 graph.get_state(config)：把最新 checkpoint 连同所有工具调用、工具结果整个反序列化出来，
+再在 Python 里过滤出 human / ai 消息一次性返回，会话越长越慢。
+
+现在在写入时就维护一份精简投影 (ChatMessage 表，只有用户提问和 AI 的文字回答)：
+- before_agent: 记录本轮的用户提问 (即使本轮运行失败，提问也会出现在历史里)
+- after_agent: 记录本轮 AI 的回答 (只记有文字内容的，只含 tool_calls 的中间消息不记)
+- 老会话在第一次运行或第一次打开时，从 checkpoint 里整体回填一次，之后就只增量写入
+- 按 (session_id, message_id) 去重，重复写入是安全的
+
+历史接口按 id 游标分页 (before / limit)，打开长会话和打开短会话的开销一样。
+"""
+import logging
+from typing import List, Optional
+
+from langchain.agents.middleware import AgentMiddleware
+from langchain_core.messages import BaseMessage
+
+from chat.usage import current_thread_id
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+ROLES = {"human": "user", "ai": "ai"}
+
+
+def _content(message: BaseMessage) -> str:
+    return message.content if isinstance(message.content, str) else message.text
+
+
+def project_messages(session_id: str, messages: List[BaseMessage]) -> list:
+    """把 LangGraph 消息转成 ChatMessage (不落库)，只保留有文字内容的用户提问和 AI 回答"""
+    from chat.models import ChatMessage
+
+    rows = []
+    for message in messages:
+        role = ROLES.get(message.type)
+        if role is None or not message.id:
+            continue
+        content = _content(message)
+        if not content:
+            continue
+        rows.append(ChatMessage(session_id=session_id, message_id=message.id, role=role, content=content))
+    return rows
+
+
+def _turn_start(messages: List[BaseMessage]) -> int:
+    """本轮 (最后一条用户提问开始) 在消息列表里的起始位置"""
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i].type == "human":
+            return i
+    return 0
+
+
+def record_messages(session_id: str, messages: List[BaseMessage]) -> None:
+    from chat.models import ChatMessage
+
+    rows = project_messages(session_id, messages)
+    if rows:
+        ChatMessage.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+async def arecord_messages(session_id: str, messages: List[BaseMessage]) -> None:
+    from chat.models import ChatMessage
+
+    rows = project_messages(session_id, messages)
+    if rows:
+        await ChatMessage.objects.abulk_create(rows, ignore_conflicts=True)
+
+
+class TranscriptMiddleware(AgentMiddleware):
+    """每轮运行前后把用户提问和 AI 回答写进 ChatMessage 投影"""
+
+    @staticmethod
+    def _before(state, exists: bool) -> List[BaseMessage]:
+        messages = state["messages"]
+        if not exists:
+            # 投影里还没有这个会话：老会话，把 checkpoint 里已有的历史一起回填
+            return messages
+        start = _turn_start(messages)
+        return messages[start:start + 1]
+
+    def before_agent(self, state, runtime):
+        from chat.models import ChatMessage
+
+        session_id = current_thread_id()
+        if not session_id:
+            return None
+        try:
+            exists = ChatMessage.objects.filter(session_id=session_id).exists()
+            record_messages(session_id, self._before(state, exists))
+        except Exception as e:
+            # 投影只影响历史展示，写失败不能影响本轮对话
+            logger.exception("❌ [transcript] 记录用户提问失败: %s", e)
+        return None
+
+    async def abefore_agent(self, state, runtime):
+        from chat.models import ChatMessage
+
+        session_id = current_thread_id()
+        if not session_id:
+            return None
+        try:
+            exists = await ChatMessage.objects.filter(session_id=session_id).aexists()
+            await arecord_messages(session_id, self._before(state, exists))
+        except Exception as e:
+            logger.exception("❌ [transcript] 记录用户提问失败: %s", e)
+        return None
+
+    def after_agent(self, state, runtime):
+        session_id = current_thread_id()
+        if not session_id:
+            return None
+        messages = state["messages"]
+        try:
+            record_messages(session_id, messages[_turn_start(messages):])
+        except Exception as e:
+            logger.exception("❌ [transcript] 记录 AI 回答失败: %s", e)
+        return None
+
+    async def aafter_agent(self, state, runtime):
+        session_id = current_thread_id()
+        if not session_id:
+            return None
+        messages = state["messages"]
+        try:
+            await arecord_messages(session_id, messages[_turn_start(messages):])
+        except Exception as e:
+            logger.exception("❌ [transcript] 记录 AI 回答失败: %s", e)
+        return None
+
+
+record_transcript = TranscriptMiddleware()
+
+# update_state 时以 “Agent 已经跑完” 的身份写入 (写完之后没有待执行的节点)，答案缓存回放和取消收尾都用它
+AFTER_AGENT_NODE = f"{TranscriptMiddleware.__name__}.after_agent"
+
+
+def backfill_from_checkpoint(graph, session_id: str) -> None:
+    """投影里没有记录的老会话：从 checkpoint 回填一次 (只在第一次打开时付一次反序列化的代价)"""
+    state = graph.get_state({"configurable": {"thread_id": session_id}})
+    if state and state.values:
+        record_messages(session_id, state.values.get("messages", []))
+
+
+def history_page(session_id: str, before: Optional[int] = None, limit: int = DEFAULT_PAGE_SIZE) -> dict:
+    """
+    按 id 游标倒着翻页：返回 before 之前 (不传则是最新) 的 limit 条消息，页内按时间正序
+    next_before 传回来就是上一页，为 None 表示已经到最早的一条
+    """
+    from chat.models import ChatMessage
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    queryset = ChatMessage.objects.filter(session_id=session_id)
+    if before is not None:
+        queryset = queryset.filter(id__lt=before)
+    # 多取一条用来判断还有没有更早的消息
+    rows = list(queryset.order_by("-id").values("id", "role", "content")[: limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return {
+        "messages": rows,
+        "has_more": has_more,
+        "next_before": rows[0]["id"] if has_more else None,
+    }
@@ -0,0 +1,93 @@
+"""
+Token 用量统计 (按会话累计)
+
+重点关注前缀缓存命中的 prompt token 数：System Prompt 固定在请求开头之后，
+同一会话后续每次调用都应该有大段前缀命中缓存，命中率可以在运维接口里直接看到。
+"""
+from langchain.agents.middleware import AgentMiddleware, ModelRequest
+from langchain_core.messages import AIMessage
+from langgraph.config import get_config
+
+
+def extract_usage(message: AIMessage) -> dict:
+    """
+    从模型返回的消息里取出 token 用量
+    - usage_metadata: langchain 统一格式，cache_read 对应 OpenAI / DeepSeek 的 prompt_tokens_details.cached_tokens
+    - response_metadata["token_usage"]: 非流式调用时的原始用量，DeepSeek 额外给了 prompt_cache_hit_tokens
+    """
+    usage = getattr(message, "usage_metadata", None) or {}
+    raw = (getattr(message, "response_metadata", None) or {}).get("token_usage") or {}
+
+    prompt_tokens = usage.get("input_tokens") or raw.get("prompt_tokens") or 0
+    completion_tokens = usage.get("output_tokens") or raw.get("completion_tokens") or 0
+    cache_hit_tokens = (
+        (usage.get("input_token_details") or {}).get("cache_read")
+        or raw.get("prompt_cache_hit_tokens")
+        or 0
+    )
+    return {
+        "prompt_tokens": prompt_tokens,
+        "prompt_cache_hit_tokens": cache_hit_tokens,
+        "completion_tokens": completion_tokens,
+    }
+
+
+def current_thread_id():
+    """当前 graph 运行对应的会话 ID (thread_id)"""
+    try:
+        return get_config().get("configurable", {}).get("thread_id")
+    except RuntimeError:
+        # 不在 graph 运行上下文里 (例如单独调用模型)，不统计
+        return None
+
+
+def _usage_updates(response):
+    from django.db.models import F
+
+    usage = {"prompt_tokens": 0, "prompt_cache_hit_tokens": 0, "completion_tokens": 0}
+    for message in response.result:
+        if isinstance(message, AIMessage):
+            for key, value in extract_usage(message).items():
+                usage[key] += value
+    if not any(usage.values()):
+        return None
+    return {key: F(key) + value for key, value in usage.items()}
+
+
+class PromptCacheUsageMiddleware(AgentMiddleware):
+    """每次模型调用结束后，把 token 用量累加到对应会话 (ChatSession) 上"""
+
+    def wrap_model_call(self, request: ModelRequest, handler):
+        response = handler(request)
+        thread_id = current_thread_id()
+        updates = _usage_updates(response)
+        if thread_id and updates:
+            from chat.models import ChatSession
+
+            ChatSession.objects.filter(session_id=thread_id).update(**updates)
+        return response
+
+    async def awrap_model_call(self, request: ModelRequest, handler):
+        response = await handler(request)
+        thread_id = current_thread_id()
+        updates = _usage_updates(response)
+        if thread_id and updates:
+            from chat.models import ChatSession
+
+            await ChatSession.objects.filter(session_id=thread_id).aupdate(**updates)
+        return response
+
+
+track_prompt_cache_usage = PromptCacheUsageMiddleware()
+
+
+def usage_summary(session) -> dict:
+    """给运维接口用的用量汇总"""
+    prompt_tokens = session.prompt_tokens or 0
+    hit_tokens = session.prompt_cache_hit_tokens or 0
+    return {
+        "prompt_tokens": prompt_tokens,
+        "prompt_cache_hit_tokens": hit_tokens,
+        "completion_tokens": session.completion_tokens or 0,
+        "prompt_cache_hit_rate": round(hit_tokens / prompt_tokens, 4) if prompt_tokens else None,
+    }
@@ -1,15 +1,22 @@
+import asyncio
 import json
-import threading
+import logging
+from contextlib import nullcontext
 from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 
-from .global_context import set_current_version
-from .graph import graph
-from .llm import generate_and_update_title
-# 引入你的 graph 和 agent
-# 确保 src/agent/graph.py 里用的是 SqliteSaver (同步版)
-
+# Agent (以及它依赖的 langchain / openai) 在第一次请求时才构建，见 chat/agents.py
+# 这里只导入不依赖 langchain 的模块，manage.py 命令加载 URL 配置时不用付导入 Agent 的开销
+from .admission import AdmissionRejected, get_admission
+from .agents import aget_graph, get_graph
+from .context import aresolve_version, normalize_version, resolve_version
 from .models import ChatSession
+from .pagination import InvalidPage, keyset_page, page_size
+from .session_lock import SessionBusy, get_session_lock
+from .sse import DONE_FRAME, aencode_stream, chunk_payload, encode_stream, error_frame
+from .tasks import title_queue
+
+logger = logging.getLogger(__name__)
 
 
 # 辅助函数：解析 JSON body
@@ -17,6 +24,91 @@ def parse_body(request):
     return json.loads(request.body.decode('utf-8'))
 
 
+# 前端还没起名字的会话标题，命中这些才会触发后台自动改名
+UNTITLED_TITLES = ["New Chat", "新对话", "未命名会话"]
+
+
+# 辅助函数：把推给前端的事件编码成 SSE 帧并推流 (同步/异步两条链路共用，编码、合并、心跳见 chat/sse.py)
+# 没推完就被关掉 (前端断开) 时取消本轮运行，见 chat/cancellation.py；推流结束时归还准入名额 (chat/admission.py)
+def sse_stream(session_id, path, payloads, cancel_token=None, lease=None):
+    from .tracing import sse_stream_span
+
+    finished = False
+    with sse_stream_span(session_id, path) as stream_trace:
+        try:
+            for frame in encode_stream(payloads):
+                stream_trace.frame(frame)
+                yield frame
+
+            finished = True
+            yield DONE_FRAME
+        except Exception as e:
+            finished = True
+            logger.exception("Stream Error: %s", e)
+            yield error_frame(e)
+        finally:
+            if not finished and cancel_token is not None:
+                cancel_token.cancel("client_disconnected")
+            if lease is not None:
+                lease.release()
+
+
+async def asse_stream(session_id, path, payloads, cancel_token=None, lease=None):
+    from .tracing import sse_stream_span
+
+    finished = False
+    with sse_stream_span(session_id, path) as stream_trace:
+        try:
+            async for frame in aencode_stream(payloads):
+                stream_trace.frame(frame)
+                yield frame
+
+            finished = True
+            yield DONE_FRAME
+        except Exception as e:
+            finished = True
+            logger.exception("Stream Error: %s", e)
+            yield error_frame(e)
+        finally:
+            if not finished and cancel_token is not None:
+                cancel_token.cancel("client_disconnected")
+            if lease is not None:
+                await lease.arelease()
+
+
+# 辅助函数：准入控制按谁计数 —— 会话所属的用户，没有会话记录时按客户端 IP
+def admission_user(request, session):
+    if session is not None and session.user_id:
+        return session.user_id
+    return f"ip:{request.META.get('REMOTE_ADDR')}"
+
+
+# 辅助函数：没通过准入 (限速 / 并发满了 / 排队满了) 时快速返回 429
+def too_many_requests(e: AdmissionRejected):
+    response = JsonResponse({"error": "请求太频繁，请稍后再试", "reason": e.reason}, status=429)
+    response['Retry-After'] = e.retry_after_header
+    return response
+
+
+# 辅助函数：同一个会话上一轮还没跑完 (session_lock 的 reject 模式)
+def session_busy(e: SessionBusy):
+    response = JsonResponse({"error": str(e), "reason": "session_busy"}, status=409)
+    response['Retry-After'] = e.retry_after_header
+    return response
+
+
+# 辅助函数：流式响应统一加上禁用缓存的响应头
+def sse_response(stream):
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+
+    # 1. 禁用缓存
+    response['Cache-Control'] = 'no-cache'
+    # 2. 告诉 Nginx/代理服务器不要缓冲 (X-Accel-Buffering)
+    response['X-Accel-Buffering'] = 'no'
+
+    return response
+
+
 # ==========================================
 # 1. 会话管理接口 (CRUD)
 # ==========================================
@@ -37,11 +129,22 @@ def create_session(request):
 
 
 def list_sessions(request):
+    """
+    当前用户的会话列表，按创建时间倒序游标分页
+    ?user_id=xxx&limit=50             第一页
+    ?user_id=xxx&limit=50&cursor=xxx  下一页，cursor 取上一页返回的 next_cursor (为 null 表示没有更多)
+    """
     if request.method == 'GET':
         user_id = request.GET.get('user_id')
-        # values() 返回的是 QuerySet，需要转成 list
-        sessions = list(ChatSession.objects.filter(user_id=user_id).order_by('-created_at').values())
-        return JsonResponse({"data": sessions})
+        try:
+            page = keyset_page(
+                ChatSession.objects.filter(user_id=user_id).values(),
+                request.GET.get('cursor'),
+                page_size(request.GET.get('limit')),
+            )
+        except InvalidPage as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        return JsonResponse({"data": page["rows"], "next_cursor": page["next_cursor"]})
 
 
 @csrf_exempt
@@ -61,6 +164,7 @@ def rename_session(request):
 def delete_session(request):
     if request.method == 'POST':
         data = parse_body(request)
+        # 聊天记录和 checkpoint 由 post_delete 信号级联删除 (chat/signals.py)
         ChatSession.objects.filter(session_id=data['session_id']).delete()
         return JsonResponse({"status": "success"})
 
@@ -70,102 +174,241 @@ def delete_session(request):
 # ==========================================
 
 def get_history(request):
+    """
+    分页读取聊天记录 (只有用户提问和 AI 回答，来自 ChatMessage 投影，不再反序列化整个 checkpoint)
+    ?session_id=xxx&limit=50           最新的 50 条
+    ?session_id=xxx&limit=50&before=id 更早的一页，id 取上一页返回的 next_before
+    """
+    from .transcript import DEFAULT_PAGE_SIZE, backfill_from_checkpoint, history_page
+
     session_id = request.GET.get('session_id')
-    config = {"configurable": {"thread_id": session_id}}
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_PAGE_SIZE))
+        before = request.GET.get('before')
+        before = int(before) if before else None
+    except ValueError:
+        return JsonResponse({"error": "limit / before 必须是整数"}, status=400)
 
     try:
-        # 使用同步的 get_state，完美适配 SqliteSaver
-        state = graph.get_state(config)
-        if not state or not state.values:
-            return JsonResponse({"messages": []})
-
-        messages = state.values.get("messages", [])
-        history_data = []
-        for msg in messages:
-            if hasattr(msg, "type") and msg.type in ["human", "ai"]:
-                history_data.append({
-                    "role": "user" if msg.type == "human" else "ai",
-                    "content": msg.content
-                })
-        return JsonResponse({"messages": history_data})
+        page = history_page(session_id, before=before, limit=limit)
+        if before is None and not page["messages"]:
+            # 投影上线前的老会话：从 checkpoint 回填一次
+            backfill_from_checkpoint(get_graph(), session_id)
+            page = history_page(session_id, limit=limit)
+        return JsonResponse(page)
     except Exception as e:
-        print(f"Error getting history: {e}")
-        return JsonResponse({"messages": []})
+        logger.exception("Error getting history: %s", e)
+        return JsonResponse({"messages": [], "has_more": False, "next_before": None})
 
 
 # ==========================================
 # 3. 核心流式聊天接口 (同步版)
 # ==========================================
 
-# 辅助函数：在线程中运行，用于后台生成标题
-def run_background_rename(session_id, query):
-    # 这里需要处理一下 Django 的数据库连接上下文，但在简单的 sqlite 场景下直接调用通常没问题
-    # 更好的做法是引入 asyncio.run 如果 generate_and_update_title 是 async 的
-    # 这里假设 generate_and_update_title 内部已经处理好了 (参考之前的实现)
-    import asyncio
-    try:
-        asyncio.run(generate_and_update_title(session_id, query))
-    except Exception as e:
-        print(f"后台改名任务失败: {e}")
-
-
 @csrf_exempt
 def chat_endpoint(request):
+    from .answer_cache import AnswerRecorder, get_answer_cache
+    from .cancellation import CancellationHandler, CancelToken, RunCancelled, bind_cancel_token, settle_cancelled_run
+
     if request.method == 'POST':
         data = json.loads(request.body)
         query = data.get('query')
         session_id = data.get('session_id')
+        # 没有 session_id 的请求不能跑：运行权按会话加锁，所有这种请求会排在同一个 "session:None" 上
+        if not session_id:
+            return JsonResponse({"error": "缺少 session_id"}, status=400)
+        try:
+            requested_version = normalize_version(data.get('version'))
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
 
-        # --- 后台改名逻辑 (使用线程) ---
+        session = ChatSession.objects.filter(session_id=session_id).first()
+        # --- 准入控制：令牌桶限速 + 并发流上限，不通过直接 429 (chat/admission.py) ---
         try:
-            session = ChatSession.objects.get(session_id=session_id)
-            if session.title in ["New Chat", "新对话", "未命名会话"]:
-                # 启动一个新线程去跑 LLM 生成标题，不阻塞当前聊天
-                t = threading.Thread(target=generate_and_update_title, args=(session_id, query))
-                t.start()
-        except ChatSession.DoesNotExist:
-            pass
-        set_current_version("29a")
-        # --- 流式生成器 (同步) ---
-        def event_stream():
+            lease = get_admission().admit(admission_user(request, session))
+        except AdmissionRejected as e:
+            return too_many_requests(e)
+        # --- 同一个会话同时只跑一轮 (chat/session_lock.py)：拿不到运行权时 reject 模式直接 409，queue 模式到流里排队 ---
+        try:
+            run_lease = get_session_lock().try_acquire(session_id)
+        except SessionBusy as e:
+            if lease is not None:
+                lease.release()
+            return session_busy(e)
+
+        try:
+            # --- 后台改名逻辑 (交给有界的标题队列) ---
+            if session is not None and session.title in UNTITLED_TITLES:
+                # 放进后台队列由 worker 线程攒批生成标题，不阻塞当前聊天；队列满了就等下一句再试
+                title_queue.submit(session_id, query)
+            # 本次运行的版本：请求参数 -> 会话上次的版本 -> 默认值 (见 chat/context.py)
+            context = resolve_version(session, requested_version)
+            graph = get_graph()
+
+            # --- 答案缓存：别人刚问过的同一个确定性查询，直接回放答案 (chat/answer_cache.py) ---
+            answer_cache = get_answer_cache()
+            cache_key = answer_cache.key_for(query, context.user_context_version)
+            cached = answer_cache.lookup(cache_key) if cache_key else None
+        except BaseException:
+            # 还没开始推流就出错了：占用的名额和运行权马上还回去，不用等租约过期
+            if lease is not None:
+                lease.release()
+            if run_lease is not None:
+                run_lease.release()
+            raise
+
+        if cached is not None:
+            def replay_payloads():
+                with get_session_lock().hold(session_id, run_lease):
+                    answer_cache.record_turn(graph, session_id, query, cached)
+                yield from answer_cache.replay_payloads(cached)
+
+            return sse_response(sse_stream(session_id, request.path, replay_payloads(), lease=lease))
+        recorder = AnswerRecorder(answer_cache, cache_key, query) if cache_key else None
+        # 答案要写进缓存时，收集本轮用到的工具结果什么时候过期
+        tracking = recorder.tracking() if recorder is not None else nullcontext()
+        # 前端断开时取消本轮运行 (chat/cancellation.py)
+        cancel_token = CancelToken(session_id)
+
+        # --- 推给前端的事件 (同步，在 chat/sse.py 的后台线程里迭代) ---
+        def payloads():
             inputs = {
                 "messages": [("user", query)]
             }
             config = {
                 "configurable": {
                     "thread_id": session_id,
-                    "user_context_version": "29a"
                 },
-                 #
+                "callbacks": [CancellationHandler(cancel_token)],
             }
 
-            # 【关键修改】使用 graph.stream (同步方法)
-            # 这里的 stream_mode="messages" 配合 v0.2+ 的 LangGraph
             try:
-                for chunk, metadata in graph.stream(inputs, config=config, stream_mode="messages"):
+                # 运行权一直持有到 checkpoint 收尾结束，下一轮才能开始
+                with get_session_lock().hold(session_id, run_lease, cancel_token):
+                    # 【关键修改】使用 graph.stream (同步方法)
+                    # 这里的 stream_mode="messages" 配合 v0.2+ 的 LangGraph
+                    stream = graph.stream(inputs, config=config, context=context, stream_mode="messages")
+                    try:
+                        with bind_cancel_token(cancel_token), tracking:
+                            for chunk, metadata in stream:
+                                if recorder is not None:
+                                    recorder.feed(chunk)
+                                payload = chunk_payload(chunk)
+                                if payload:
+                                    yield payload
+                    finally:
+                        stream.close()
+                        if cancel_token.cancelled:
+                            settle_cancelled_run(graph, {"configurable": {"thread_id": session_id}})
+            except RunCancelled:
+                return
+
+            if recorder is not None:
+                recorder.finish()
+
+        # Django 的 StreamingHttpResponse 完全支持同步生成器
+        # 注意：只适合 WSGI 部署，ASGI 下 Django 会先把同步生成器整个读完再发，请走 chat_endpoint_async
+        return sse_response(sse_stream(session_id, request.path, payloads(), cancel_token, lease))
 
-                    if chunk.type == "AIMessageChunk" and chunk.content:
-                        payload = json.dumps({"type": "answer", "content": chunk.content}, ensure_ascii=False)
-                        yield f"data: {payload}\n\n"
 
-                    elif chunk.type == "tool":
-                        payload = json.dumps({"type": "tool", "content": chunk.name}, ensure_ascii=False)
-                        yield f"data: {payload}\n\n"
+# ==========================================
+# 4. 核心流式聊天接口 (异步版, ASGI 专用)
+# ==========================================
+# 同步版每个在途会话都要占住一个 worker 线程，直到 LLM 和工具全部跑完；
+# 异步版用 graph.astream 驱动，等待 LLM/工具时只挂起协程，一个进程可以同时挂几千条流。
+# 需要用 myproject/asgi.py 启动 (例如 uvicorn myproject.asgi:application)，
+# 走 WSGI 的话 Django 会把异步生成器整个读完再返回，就失去流式效果了。
 
-                yield "data: [DONE]\n\n"
-            except Exception as e:
-                print(f"Stream Error: {e}")
-                err_payload = json.dumps({"type": "error", "content": str(e)}, ensure_ascii=False)
-                yield f"data: {err_payload}\n\n"
+@csrf_exempt
+async def chat_endpoint_async(request):
+    from .answer_cache import AnswerRecorder, get_answer_cache
+    from .cancellation import CancellationHandler, CancelToken, RunCancelled, asettle_cancelled_run, bind_cancel_token
 
-        # Django 的 StreamingHttpResponse 完全支持同步生成器
-        # return StreamingHttpResponse(event_stream(), content_type='text/event-stream')
-        # --- 【关键修改】添加响应头 ---
-        response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    if request.method == 'POST':
+        data = json.loads(request.body)
+        query = data.get('query')
+        session_id = data.get('session_id')
+        if not session_id:
+            return JsonResponse({"error": "缺少 session_id"}, status=400)
+        try:
+            requested_version = normalize_version(data.get('version'))
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
 
-        # 1. 禁用缓存
-        response['Cache-Control'] = 'no-cache'
-        # 2. 告诉 Nginx/代理服务器不要缓冲 (X-Accel-Buffering)
-        response['X-Accel-Buffering'] = 'no'
+        session = await ChatSession.objects.filter(session_id=session_id).afirst()
+        try:
+            lease = await get_admission().aadmit(admission_user(request, session))
+        except AdmissionRejected as e:
+            return too_many_requests(e)
+        try:
+            run_lease = await get_session_lock().atry_acquire(session_id)
+        except SessionBusy as e:
+            if lease is not None:
+                await lease.arelease()
+            return session_busy(e)
+
+        try:
+            # --- 后台改名逻辑 (异步 ORM 查询，改名本身交给标题队列的 worker 线程) ---
+            if session is not None and session.title in UNTITLED_TITLES:
+                # 提交时要到共享缓存里认领会话 (同步 cache I/O)，放到线程里做，不卡事件循环
+                await asyncio.to_thread(title_queue.submit, session_id, query)
+            context = await aresolve_version(session, requested_version)
+
+            agent = await aget_graph()
+
+            answer_cache = get_answer_cache()
+            cache_key = answer_cache.key_for(query, context.user_context_version)
+            cached = await asyncio.to_thread(answer_cache.lookup, cache_key) if cache_key else None
+        except BaseException:
+            if lease is not None:
+                await lease.arelease()
+            if run_lease is not None:
+                await run_lease.arelease()
+            raise
+
+        if cached is not None:
+            async def replay_payloads():
+                async with get_session_lock().ahold(session_id, run_lease):
+                    await answer_cache.arecord_turn(agent, session_id, query, cached)
+                for payload in answer_cache.replay_payloads(cached):
+                    yield payload
+
+            return sse_response(asse_stream(session_id, request.path, replay_payloads(), lease=lease))
+        recorder = AnswerRecorder(answer_cache, cache_key, query) if cache_key else None
+        tracking = recorder.tracking() if recorder is not None else nullcontext()
+        cancel_token = CancelToken(session_id)
+
+        # --- 推给前端的事件 (异步，前端断开时所在的 task 被取消，LLM 流和 aiohttp 请求随之中止) ---
+        async def payloads():
+            inputs = {
+                "messages": [("user", query)]
+            }
+            config = {
+                "configurable": {
+                    "thread_id": session_id,
+                },
+                "callbacks": [CancellationHandler(cancel_token)],
+            }
 
-        return response
\ No newline at end of file
+            async with get_session_lock().ahold(session_id, run_lease):
+                try:
+                    with bind_cancel_token(cancel_token), tracking:
+                        async for chunk, metadata in agent.astream(inputs, config=config, context=context, stream_mode="messages"):
+                            if recorder is not None:
+                                recorder.feed(chunk)
+                            payload = chunk_payload(chunk)
+                            if payload:
+                                yield payload
+                except RunCancelled:
+                    return
+                except asyncio.CancelledError:
+                    cancel_token.cancel("client_disconnected")
+                    raise
+                finally:
+                    if cancel_token.cancelled:
+                        await asettle_cancelled_run(agent, {"configurable": {"thread_id": session_id}})
+
+            if recorder is not None:
+                await asyncio.to_thread(recorder.finish)
+
+        return sse_response(asse_stream(session_id, request.path, payloads(), cancel_token, lease))
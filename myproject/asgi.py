@@ -5,6 +5,12 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+
+The streaming chat endpoint for this entry point is ``/api/chat/async``
+(``chat.views.chat_endpoint_async``), which drives the agent with
+``astream`` so a single worker can hold many concurrent streams, e.g.::
+
+    uvicorn myproject.asgi:application --workers 2
 """
 
 import os
@@ -14,3 +20,10 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myproject.settings")
 
 application = get_asgi_application()
+
+# Agent 默认在第一个请求时才构建 (chat/agents.py)；AGENT_WARMUP=1 时在 worker 启动阶段就构建好。
+# gunicorn --preload 时这里跑在 fork 之前的主进程里，worker 仍会各自重新构建，应改在 post_fork 钩子里调用 warm_up()
+if os.getenv("AGENT_WARMUP") == "1":
+    from chat.agents import warm_up
+
+    warm_up()
@@ -12,9 +12,16 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+from dotenv import load_dotenv
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# 项目根目录下的 .env (DEEPSEEK_API_KEY 等)，在读取下面这些环境变量之前加载
+# 以前放在 chat/graph.py 里，导入 Agent 时才加载，settings 里读到的环境变量不包括 .env
+load_dotenv(BASE_DIR / ".env")
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -64,9 +71,6 @@ CSRF_TRUSTED_ORIGINS = [
     'http://127.0.0.1:8080',
 ]
 
-# 允许异步 (Django 3.1+ 支持，但为了保险起见)
-os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
-
 ROOT_URLCONF = "myproject.urls"
 
 TEMPLATES = [
@@ -101,6 +105,246 @@ DATABASES = {
 }
 
 
+# LangGraph 对话状态存储 (Checkpointer)
+# 写法仿照 CACHES：BACKEND 是存储器类的路径，OPTIONS 原样传给构造函数
+# 单元测试 / 压测可以换成 "langgraph.checkpoint.memory.InMemorySaver"
+AGENT_CHECKPOINTER = {
+    "BACKEND": "chat.checkpoint.PooledSqliteSaver",
+    "OPTIONS": {
+        "path": BASE_DIR / "agent_chat_history.db",
+        # 最多同时打开的 SQLite 连接数
+        "pool_size": 8,
+        # 每一步的 checkpoint 先进缓冲区，攒够 batch_size 行或超过 flush_interval 秒合并成一个事务写入
+        "batch_size": 32,
+        "flush_interval": 0.05,
+        # 覆盖默认 PRAGMA (journal_mode=WAL, synchronous=NORMAL, mmap_size=256MB ...)
+        "pragmas": {},
+        # checkpoint 压缩序列化 (chat/serde.py)：zstd 压缩，超过 BLOB_MIN_SIZE 字符的工具结果按内容哈希去重存 blobs 表
+        # 训练字典: python manage.py train_checkpoint_dict；设为 None 时新数据按原来的格式写，已经压缩的数据照样能读
+        "compression": {
+            "LEVEL": 3,
+            "MIN_SIZE": 512,
+            "BLOB_MIN_SIZE": 4096,
+        },
+    },
+}
+
+# 发给 LLM 的历史窗口 (chat/history.py)
+# 完整历史仍然保存在 checkpoint 里，这里只限制每次请求带多少历史
+AGENT_HISTORY_WINDOW = {
+    # 历史消息超过 MAX_TOKENS 时，从最早的一轮开始裁掉，直到不超过 TARGET_TOKENS
+    "MAX_TOKENS": 6000,
+    "TARGET_TOKENS": 4000,
+    # 本地分词器 (tiktoken 编码名)，None 表示按字符数估算
+    "TOKENIZER": "cl100k_base",
+    # 被裁掉的对话是否压缩成滚动摘要放在窗口最前面 (窗口起点移动时额外调用一次 LLM)
+    "SUMMARY": False,
+}
+
+# 工具调用的 cid-service 接口 (chat/tools/http_client.py)
+PUO_SERVICE = {
+    # 不为 None 时工具不发真实请求，直接返回这段文本；接入真实服务时改为 None
+    "MOCK_RESPONSE": "已查询到数据,这里是模拟场景，你可以随机编数据",
+    # 覆盖工具里写死的服务地址，例如本地 stub: "http://127.0.0.1:8765"
+    "BASE_URL": os.getenv("PUO_SERVICE_BASE_URL"),
+    # (连接超时, 读超时)，单位秒
+    "TIMEOUT": (3.05, 10),
+    # 慢接口单独放宽读超时 (key 为 URL 最后一段)
+    "ENDPOINT_TIMEOUTS": {
+        "inquire_ver_merge": (3.05, 30),
+        "read_file_components": (3.05, 20),
+        "read_file_matching": (3.05, 20),
+    },
+    "POOL_SIZE": 50,
+    # 最多尝试次数 (含第一次)，两次之间按 0.2s * 2^n 封顶 5s 做带随机抖动的退避
+    "MAX_RETRIES": 5,
+    "BACKOFF_BASE": 0.2,
+    "BACKOFF_MAX": 5.0,
+}
+
+# 工具结果缓存 (chat/tools/cache.py)，命中情况见 /api/ops/tool-cache
+PUO_TOOL_CACHE = {
+    "ENABLED": True,
+    "MAX_ENTRIES": 2048,
+    "DEFAULT_TTL": 300,
+    # 按工具单独配置 TTL (秒)：构建 / 推送 / 合入状态变化快，配套信息和 MR 基本不变
+    "TTLS": {
+        "check_trunk_build_status": 30,
+        "query_version_push_status": 60,
+        "query_component_merge_status": 60,
+        "menu_hert_node_on_rn": 120,
+        "query_version_basic_info": 600,
+        "query_version_by_multimode": 600,
+        "query_merge_info_between_versions": 600,
+        "query_mr_info": 600,
+        "query_component_details": 600,
+        "query_product_details": 600,
+    },
+    # 多 worker 共享结果时填 settings.CACHES 里的别名 (例如配置了 Redis 的 "default")
+    "SHARED_CACHE": None,
+}
+
+# 语义答案缓存 (chat/answer_cache.py)：快速路由能确定性解析的重复问题直接回放上一次的回答，
+# 新鲜度跟随 PUO_TOOL_CACHE 里对应工具的 TTL，命中率见 /api/ops/answer-cache
+AGENT_ANSWER_CACHE = {
+    "ENABLED": os.getenv("AGENT_ANSWER_CACHE_ENABLED", "1") == "1",
+    "PATH": BASE_DIR / "answer_cache.db",
+    # 同一组工具调用下，问法 (抹掉实体后的字符 n-gram 向量) 的余弦相似度不低于这个值才算同一个问题
+    "MIN_SIMILARITY": 0.8,
+    "MAX_ENTRIES": 5000,
+}
+
+# SSE 推流 (chat/sse.py)：连续的回答片段节流合并成帧，空闲时发心跳防止代理断开
+AGENT_SSE = {
+    # 两个回答帧之间至少间隔多少秒 (第一个片段不等)，0 表示每个片段单独一帧
+    "FLUSH_INTERVAL": 0.016,
+    "MAX_CHARS": 64,
+    # 超过这么多秒没有输出就发一行 ": ping" 注释，要小于 Nginx 等代理的 proxy_read_timeout
+    "HEARTBEAT": 15.0,
+}
+
+# 聊天接口的准入控制 (chat/admission.py)：每个用户 / 全局的令牌桶 + 同时在推的流数上限，不通过返回 429 + Retry-After
+# BACKEND 写法仿照 CACHES；默认进程内计数，多 worker 部署时换成共享后端 (见下面的 AGENT_DEPLOYMENT)
+AGENT_ADMISSION = {
+    "ENABLED": os.getenv("AGENT_ADMISSION_ENABLED", "1") == "1",
+    "BACKEND": "chat.admission.InMemoryAdmissionBackend",
+    "OPTIONS": {},
+    # CAPACITY: 允许的突发请求数；PER_SECOND: 每秒补充的令牌 (0.5 即每个用户平均每分钟 30 次)
+    "USER_BUCKET": {"CAPACITY": 20, "PER_SECOND": 0.5},
+    "GLOBAL_BUCKET": {"CAPACITY": 200, "PER_SECOND": 20},
+    "USER_MAX_STREAMS": 3,
+    "GLOBAL_MAX_STREAMS": 100,
+    # 并发满了时每个 worker 最多排队 QUEUE_SIZE 个请求、每个最多等 MAX_WAIT 秒，超出的直接 429
+    "QUEUE_SIZE": 32,
+    "MAX_WAIT": 3.0,
+    # 流名额的租约有效期 (秒)，worker 崩溃后最多这么久自动释放
+    "LEASE_TTL": 60,
+}
+
+# 同一个会话同时只跑一轮 (chat/session_lock.py)，运行权是准入控制后端里的租约，多 worker 部署时跨进程生效
+AGENT_SESSION_LOCK = {
+    # 上一轮还没结束时: queue 在流里排队等 (最多 WAIT 秒)；reject 直接返回 409
+    "MODE": os.getenv("AGENT_SESSION_LOCK_MODE", "queue"),
+    "WAIT": 120,
+    # worker 崩溃后运行权最多这么久自动释放 (运行期间自动续期)
+    "LEASE_TTL": 30,
+}
+
+# 工具调用的并发上限与超时 (chat/tool_execution.py)
+# 同一条 AI 消息里的多个工具调用并行执行，同一后端最多同时 N 个，单次调用超时返回报错的 ToolMessage
+AGENT_TOOL_EXECUTION = {
+    "TIMEOUT": 20,
+    "TOOL_TIMEOUTS": {
+        "query_merge_info_between_versions": 40,
+    },
+    "BACKEND_LIMITS": {"cid-service": 8},
+    "DEFAULT_BACKEND": "cid-service",
+}
+
+# 确定性快速路由 (chat/router.py)：意图明确的查询跳过 LLM 选工具这一步，命中率见 /api/ops/fast-path
+AGENT_FAST_PATH = {
+    "ENABLED": True,
+}
+
+# checkpoint 保留策略与清理 (chat/maintenance.py)，也可以 cron 跑: python manage.py gc_checkpoints
+AGENT_CHECKPOINT_GC = {
+    # 进程内定时清理，多 worker 部署时建议关掉改用 cron
+    "ENABLED": os.getenv("AGENT_CHECKPOINT_GC_ENABLED") == "1",
+    "INTERVAL": 3600,
+    # 每个会话只保留最新的几个 checkpoint (恢复对话只需要最新的一个)
+    "KEEP_LATEST": 3,
+    # 超过 N 天没有新消息的会话删除 checkpoint (聊天记录仍然保留)
+    "IDLE_DAYS": 30,
+    "DELETE_IDLE_SESSIONS": False,
+    "DELETE_ORPHANS": False,
+    # 清理已经没有 checkpoint 引用的工具结果 blob (写入不到 BLOB_MIN_AGE 秒的不动)
+    "SWEEP_BLOBS": True,
+    "BLOB_MIN_AGE": 3600,
+}
+
+# 主对话模型 (chat/graph.py)，BASE_URL 可以指向任意 OpenAI 兼容服务，压测时指向 benchmarks/mock_llm.py
+AGENT_LLM = {
+    "MODEL": os.getenv("AGENT_LLM_MODEL", "deepseek-chat"),
+    "BASE_URL": os.getenv("AGENT_LLM_BASE_URL", "https://api.deepseek.com"),
+    "API_KEY_ENV": "DEEPSEEK_API_KEY",
+    "TEMPERATURE": 0,
+}
+
+# 请求和会话都没有指定版本时，提示里使用的上下文版本 (chat/context.py)；None 表示让 LLM 追问用户
+AGENT_DEFAULT_VERSION = os.getenv("AGENT_DEFAULT_VERSION", "29a")
+
+# 自动起标题用的模型 (chat/llm.py)，和主对话分开配置，可以换成更便宜的模型
+AGENT_TITLE_LLM = {
+    "MODEL": os.getenv("TITLE_LLM_MODEL", "deepseek-chat"),
+    "BASE_URL": os.getenv("TITLE_LLM_BASE_URL", "https://api.deepseek.com"),
+    "API_KEY_ENV": "DEEPSEEK_API_KEY",
+    "MAX_TOKENS_PER_TITLE": 32,
+}
+
+# 起标题的后台队列 (chat/tasks.py)：固定 worker 数 + 有界队列，同时到达的新会话攒成一批调用一次 LLM
+AGENT_TITLE_WORKER = {
+    "WORKERS": 2,
+    "QUEUE_SIZE": 256,
+    "BATCH_SIZE": 8,
+    "BATCH_WAIT": 0.2,
+}
+
+# 部署模式: single (默认，单个 worker 进程) / multi (gunicorn -w N、多台机器)
+# multi 模式下存储器、工具结果缓存、标题队列的去重都换成各 worker 共享的后端:
+#   * 配置了 AGENT_POSTGRES_DSN 时用 Postgres 存储器 (chat/checkpoint_postgres.py，需要额外安装依赖)；
+#     没配置时用本机共享的 SQLite 文件 (AGENT_CHECKPOINT_PATH)，只适合单机多 worker / 测试，
+#     关掉批量写缓冲 (batch_size=1)，每一步写入立即落盘，别的 worker 接着处理同一个会话时能读到
+#   * 配置了 AGENT_REDIS_URL 时用 Redis 做共享缓存和准入计数，没配置时用本机目录 (AGENT_SHARED_CACHE_DIR) 的文件缓存
+#     和本机共享的 SQLite 准入计数 (AGENT_ADMISSION_PATH)
+#   * 进程内的定时 checkpoint 清理 (AGENT_CHECKPOINT_GC) 多个 worker 会重复执行，建议保持关闭改用 cron
+AGENT_DEPLOYMENT = os.getenv("AGENT_DEPLOYMENT", "single")
+
+if AGENT_DEPLOYMENT == "multi":
+    if os.getenv("AGENT_POSTGRES_DSN"):
+        AGENT_CHECKPOINTER = {
+            "BACKEND": "chat.checkpoint_postgres.PooledPostgresSaver",
+            "OPTIONS": {
+                "dsn": os.getenv("AGENT_POSTGRES_DSN"),
+                "pool_size": 8,
+            },
+        }
+    else:
+        AGENT_CHECKPOINTER = {
+            **AGENT_CHECKPOINTER,
+            "OPTIONS": {
+                **AGENT_CHECKPOINTER["OPTIONS"],
+                "path": os.getenv("AGENT_CHECKPOINT_PATH", AGENT_CHECKPOINTER["OPTIONS"]["path"]),
+                "batch_size": 1,
+            },
+        }
+
+    if os.getenv("AGENT_REDIS_URL"):
+        _SHARED_CACHE = {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv("AGENT_REDIS_URL"),
+        }
+    else:
+        _SHARED_CACHE = {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.getenv("AGENT_SHARED_CACHE_DIR", str(BASE_DIR / ".shared_cache")),
+        }
+    CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "shared": _SHARED_CACHE,
+    }
+    PUO_TOOL_CACHE["SHARED_CACHE"] = "shared"
+    AGENT_TITLE_WORKER["SHARED_CACHE"] = "shared"
+
+    if os.getenv("AGENT_REDIS_URL"):
+        AGENT_ADMISSION["BACKEND"] = "chat.admission.RedisAdmissionBackend"
+        AGENT_ADMISSION["OPTIONS"] = {"url": os.getenv("AGENT_REDIS_URL")}
+    else:
+        AGENT_ADMISSION["BACKEND"] = "chat.admission.SqliteAdmissionBackend"
+        AGENT_ADMISSION["OPTIONS"] = {"path": os.getenv("AGENT_ADMISSION_PATH", str(BASE_DIR / "agent_admission.db"))}
+elif AGENT_DEPLOYMENT != "single":
+    raise ImproperlyConfigured(f"AGENT_DEPLOYMENT 只能是 single 或 multi，当前是 {AGENT_DEPLOYMENT!r}")
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -141,3 +385,29 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# 结构化追踪 (OpenTelemetry)，见 chat/tracing.py。关闭时没有任何开销
+AGENT_TRACING = {
+    "ENABLED": os.getenv("AGENT_TRACING_ENABLED") == "1",
+    # 按 trace 采样的比例
+    "SAMPLE_RATE": float(os.getenv("AGENT_TRACING_SAMPLE_RATE", "0.1")),
+    # otlp / console
+    "EXPORTER": os.getenv("AGENT_TRACING_EXPORTER", "otlp"),
+    "OTLP_ENDPOINT": os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"),
+    "SERVICE_NAME": "ai-agent-django",
+}
+
+# 日志：chat.* 默认 INFO；设置 AGENT_LOG_LEVEL=DEBUG 可以看到完整 prompt 和快速路由命中明细
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "default": {"format": "%(asctime)s %(levelname)s [%(name)s] %(message)s"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "default"},
+    },
+    "loggers": {
+        "chat": {"handlers": ["console"], "level": os.getenv("AGENT_LOG_LEVEL", "INFO"), "propagate": False},
+    },
+}
@@ -13,10 +13,30 @@ urlpatterns = [
     # 聊天功能
     path('api/history', views.get_history),
     path('api/chat', views.chat_endpoint),
+    # 异步流式聊天 (ASGI 部署时使用，协议与 api/chat 完全一致)
+    path('api/chat/async', views.chat_endpoint_async),
 
     # 1. 会话列表查询 (支持搜索用户)
     path('api/ops/sessions', ops_views.ops_session_list),
 
     # 2. 全链路追踪 (查看工具调用详情)
     path('api/ops/trace/<str:session_id>', ops_views.ops_session_trace),
+
+    # 3. 工具结果缓存命中情况
+    path('api/ops/tool-cache', ops_views.ops_tool_cache),
+
+    # 4. 快速路由命中率
+    path('api/ops/fast-path', ops_views.ops_fast_path),
+
+    # 5. 自动起标题：本地生成占比 / 省掉的 LLM 调用
+    path('api/ops/titles', ops_views.ops_titles),
+
+    # 6. 语义答案缓存：命中率 / 命中答案的新鲜程度
+    path('api/ops/answer-cache', ops_views.ops_answer_cache),
+
+    # 7. 前端断开后取消的运行 / 省下的 token
+    path('api/ops/cancellations', ops_views.ops_cancellations),
+
+    # 8. 准入控制：限速 / 并发上限拒绝的请求
+    path('api/ops/admission', ops_views.ops_admission),
 ]
\ No newline at end of file
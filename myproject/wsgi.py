@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myproject.settings")
 
 application = get_wsgi_application()
+
+# Agent 默认在第一个请求时才构建 (chat/agents.py)；AGENT_WARMUP=1 时在 worker 启动阶段就构建好。
+# gunicorn --preload 时这里跑在 fork 之前的主进程里，worker 仍会各自重新构建，应改在 post_fork 钩子里调用 warm_up()
+if os.getenv("AGENT_WARMUP") == "1":
+    from chat.agents import warm_up
+
+    warm_up()